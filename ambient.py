@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+'''
+    File name: ambient.py
+    Python Version: 3.7
+
+    Ambient (bias) lighting: reads raw rgb24 video frames from a file, a pipe or a V4L2
+    device, reduces the ZONE# areas of play.ini to one color each and streams them to
+    their device or group through the play server, e.g.
+    ffmpeg -i movie.mkv -f rawvideo -pix_fmt rgb24 -s 320x180 - | ./ambient.py --size 320x180
+'''
+import argparse
+import sys
+import time
+from argparse import RawTextHelpFormatter
+import numpy as np
+from playclient import ZoneSender, CachedConfig
+
+def read_frames(source, width, height):
+    """ Yields the frames of a raw rgb24 source as (height, width, 3) arrays of one reused buffer """
+    buf = bytearray(width * height * 3)
+    view = memoryview(buf)
+    frame = np.frombuffer(buf, dtype=np.uint8).reshape(height, width, 3)
+    while True:
+        got = 0
+        while got < len(buf):
+            size = source.readinto(view[got:])
+            if not size:
+                return
+            got += size
+        yield frame
+
+class AmbientPipeline(object):
+    """
+    Reduces frames to one color per zone. Frames are downscaled by striding (a view, not a
+    copy) so only one pixel out of scale² is ever converted or summed, and the zone colors
+    are smoothed over time: smoothing is the weight kept by the previous colors.
+    """
+    def __init__(self, zones, width, height, scale=8, mode="average", smoothing=0.5):
+        self.scale = scale
+        self.mode = mode
+        self.smoothing = smoothing
+        self.state = None
+        rows = len(range(0, height, scale))
+        cols = len(range(0, width, scale))
+        self.slices = []
+        for left, top, right, bottom in zones:
+            ys = slice(int(top * rows), max(int(bottom * rows), int(top * rows) + 1))
+            xs = slice(int(left * cols), max(int(right * cols), int(left * cols) + 1))
+            self.slices.append((ys, xs))
+
+    def process(self, frame):
+        """ Returns the smoothed zone colors of a frame as hex values (00RRGGBB) """
+        small = frame[::self.scale, ::self.scale]
+        if self.mode == "dominant":
+            colors = np.array([self.dominant(small[ys, xs]) for ys, xs in self.slices])
+        else:
+            colors = np.array([small[ys, xs].mean(axis=(0, 1)) for ys, xs in self.slices])
+        if self.state is None:
+            self.state = colors
+        else:
+            self.state += (1 - self.smoothing) * (colors - self.state)
+        return ["00{:02x}{:02x}{:02x}".format(*rgb) for rgb in np.rint(self.state).astype(int)]
+
+    @staticmethod
+    def dominant(pixels):
+        """ Mean color of the most populated 3 bits per channel bin, black bars losing ties """
+        pixels = pixels.reshape(-1, 3)
+        bins = (pixels >> 5).astype(np.uint16)
+        index = bins[:, 0] << 6 | bins[:, 1] << 3 | bins[:, 2]
+        counts = np.bincount(index, minlength=512)
+        if counts[0] < len(index):
+            counts[0] = 0
+        return pixels[index == counts.argmax()].mean(axis=0)
+
+def read_zones(config):
+    """ Returns the areas and (target, is_group) of the ZONE# sections """
+    areas = []
+    targets = []
+    i = 0
+    while "ZONE" + str(i) in config:
+        zone = config["ZONE" + str(i)]
+        areas.append([float(value) for value in zone["AREA"].split(",")])
+        targets.append(ZoneSender.target(zone))
+        i += 1
+    return areas, targets
+
+""" Script executed directly """
+if __name__ == "__main__":
+    PLAYCONFIG = CachedConfig('play.ini')
+    AMBIENT = PLAYCONFIG['AMBIENT'] if 'AMBIENT' in PLAYCONFIG else {}
+
+    parser = argparse.ArgumentParser(description='Ambient lighting from raw rgb24 video frames',
+                                     formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--source', metavar='file', type=str, default='-',
+                        help="Raw rgb24 frames: file, named pipe or V4L2 device ('-' for stdin)")
+    parser.add_argument('--size', metavar='WxH', type=str, default=AMBIENT.get('SIZE', '320x180'),
+                        help='Frame size (default: SIZE of [AMBIENT] or 320x180)')
+    parser.add_argument('--mode', type=str, choices=['average', 'dominant'],
+                        default=AMBIENT.get('MODE', 'average'), help='Zone color reduction')
+    parser.add_argument('--benchmark', action='store_true', default=False,
+                        help='Process the source as fast as possible without streaming, report the fps')
+    args = parser.parse_args()
+
+    width, height = [int(value) for value in args.size.lower().split("x")]
+    areas, targets = read_zones(PLAYCONFIG)
+    if not areas:
+        print("No ZONE# section in play.ini")
+        sys.exit(1)
+    pipeline = AmbientPipeline(areas, width, height, int(AMBIENT.get('SCALE', '4')), args.mode,
+                               float(AMBIENT.get('SMOOTHING', '0.5')))
+    sender = None if args.benchmark else ZoneSender(PLAYCONFIG, targets,
+                                                    float(AMBIENT.get('RATE', '10')))
+
+    if args.source == '-':
+        source = sys.stdin.buffer
+    else:
+        source = open(args.source, 'rb', buffering=0)
+    frames = 0
+    sent = 0
+    busy = 0.0
+    start = time.monotonic()
+    try:
+        for frame in read_frames(source, width, height):
+            began = time.perf_counter()
+            colors = pipeline.process(frame)
+            busy += time.perf_counter() - began
+            frames += 1
+            if sender is not None and sender.push(colors):
+                sent += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if sender is not None:
+            sender.close()
+        source.close()
+    elapsed = time.monotonic() - start
+    if frames:
+        print("{} frames in {:.2f}s ({:.1f} fps read), {:.2f} ms per frame processing "
+              "({:.0f} fps capacity), {} frames streamed" \
+              .format(frames, elapsed, frames / elapsed, busy / frames * 1000,
+                      frames / busy if busy else 0, sent))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+    File name: audioreactive.py
+    Python Version: 3.7
+
+    Music-reactive lights: reads PCM audio from a WAV file or a raw s16le pipe, computes
+    the energy of the BAND# frequency bands of play.ini over sliding windows and streams
+    each band level as the brightness of its color to its device or group, e.g.
+    arecord -f cd -t raw | ./audioreactive.py
+'''
+import argparse
+import sys
+import time
+import wave
+import queue
+import threading
+from argparse import RawTextHelpFormatter
+import numpy as np
+from playclient import ZoneSender, CachedConfig
+
+class PcmSource(object):
+    """ Reads mono float samples from a WAV file or a raw s16le stream """
+    def __init__(self, path, rate=44100, channels=2):
+        self.wav = None
+        if path == '-':
+            self.stream = sys.stdin.buffer
+        elif path.lower().endswith('.wav'):
+            self.wav = wave.open(path, 'rb')
+            if self.wav.getsampwidth() != 2:
+                raise ValueError("Only 16 bits WAV files are supported")
+            rate = self.wav.getframerate()
+            channels = self.wav.getnchannels()
+        else:
+            self.stream = open(path, 'rb')
+        self.rate = rate
+        self.channels = channels
+
+    def read(self, count):
+        """ Returns up to count samples, an empty array at the end of the source """
+        if self.wav is not None:
+            data = self.wav.readframes(count)
+        else:
+            data = self.stream.read(count * 2 * self.channels)
+        data = data[:len(data) - len(data) % (2 * self.channels)]
+        samples = np.frombuffer(data, dtype='<i2').reshape(-1, self.channels)
+        return samples.mean(axis=1) / 32768.0
+
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+        else:
+            self.stream.close()
+
+class BandAnalyzer(object):
+    """
+    Turns sliding windows of samples into one level (0 to 1) per band. Band energies are
+    a single product of the FFT power spectrum with a bands x bins mask, normalized by a
+    slowly decaying peak. A band whose energy jumps over beat times its recent average
+    flashes to full level, and levels fall back with the smoothing weight (instant attack).
+    """
+    def __init__(self, bands, rate, window=1024, hop=512, smoothing=0.6, beat=1.5):
+        self.window = window
+        self.hop = hop
+        self.smoothing = smoothing
+        self.beat = beat
+        self.samples = np.zeros(window)
+        self.hann = np.hanning(window)
+        freqs = np.fft.rfftfreq(window, 1.0 / rate)
+        self.mask = np.array([(freqs >= low) & (freqs < high) for low, high in bands], dtype=float)
+        self.peak = np.full(len(bands), 1e-6)
+        self.history = np.zeros((max(int(rate / hop), 1), len(bands)))
+        self.count = 0
+        self.levels = np.zeros(len(bands))
+        self.beats = np.zeros(len(bands), dtype=bool)
+
+    def process(self, hop):
+        """ Slides the window by a hop of samples and returns the band levels """
+        self.samples[:-len(hop)] = self.samples[len(hop):]
+        self.samples[-len(hop):] = hop
+        power = np.abs(np.fft.rfft(self.samples * self.hann)) ** 2
+        energy = self.mask.dot(power)
+        self.peak = np.maximum(self.peak * 0.999, energy)
+        average = self.history.mean(axis=0)
+        self.beats = (energy > np.maximum(self.beat * average, 0.1 * self.peak)) \
+                     & (self.count >= len(self.history))
+        self.history[self.count % len(self.history)] = energy
+        self.count += 1
+        level = np.sqrt(energy / self.peak)
+        level[self.beats] = 1.0
+        self.levels = np.maximum(level, self.levels * self.smoothing)
+        return self.levels
+
+def scale_colors(colors, levels):
+    """ Scales the WWRRGGBB band colors by their levels """
+    return ["".join("{:02x}".format(int(int(color[i:i + 2], 16) * level)) for i in range(0, 8, 2))
+            for color, level in zip(colors, levels)]
+
+def read_bands(config):
+    """ Returns the (low, high) frequencies, colors and (target, is_group) of the BAND# sections """
+    bands = []
+    colors = []
+    targets = []
+    i = 0
+    while "BAND" + str(i) in config:
+        band = config["BAND" + str(i)]
+        bands.append((float(band["LOW"]), float(band["HIGH"])))
+        colors.append(band.get("COLOR", "00ffffff"))
+        targets.append(ZoneSender.target(band))
+        i += 1
+    return bands, colors, targets
+
+class AudioProducer(threading.Thread):
+    """
+    Reads and analyzes the audio in its own thread, so a slow analysis never holds the
+    sender: frames are queued with the time their last sample was read and the consumer
+    drops the ones older than the latency budget. Files are paced to real time unless
+    benchmarking.
+    """
+    def __init__(self, source, analyzer, colors, realtime=True):
+        threading.Thread.__init__(self, daemon=True)
+        self.source = source
+        self.analyzer = analyzer
+        self.colors = colors
+        self.realtime = realtime
+        self.frames = queue.Queue(maxsize=4)
+        self.processed = 0
+        self.busy = 0.0
+        self.busy_max = 0.0
+
+    def run(self):
+        start = time.monotonic()
+        position = 0
+        try:
+            while True:
+                hop = self.source.read(self.analyzer.hop)
+                if not len(hop):
+                    break
+                position += len(hop)
+                if self.realtime and self.source.wav is not None:
+                    due = start + position / self.source.rate
+                    if due > time.monotonic():
+                        time.sleep(due - time.monotonic())
+                read_at = time.monotonic()
+                began = time.perf_counter()
+                colors = scale_colors(self.colors, self.analyzer.process(hop))
+                spent = time.perf_counter() - began
+                self.busy += spent
+                self.busy_max = max(self.busy_max, spent)
+                self.processed += 1
+                try:
+                    self.frames.put_nowait((read_at, colors))
+                except queue.Full: #the oldest frame is the least useful one
+                    self.frames.get_nowait()
+                    self.frames.put_nowait((read_at, colors))
+        finally:
+            self.frames.put(None)
+
+""" Script executed directly """
+if __name__ == "__main__":
+    PLAYCONFIG = CachedConfig('play.ini')
+    AUDIO = PLAYCONFIG['AUDIO'] if 'AUDIO' in PLAYCONFIG else {}
+
+    parser = argparse.ArgumentParser(description='Music-reactive lights from PCM audio',
+                                     formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--source', metavar='file', type=str, default='-',
+                        help="WAV file, or raw s16le file or pipe ('-' for stdin)")
+    parser.add_argument('--rate', metavar='hz', type=int, default=int(AUDIO.get('RATE', '44100')),
+                        help='Sample rate of raw sources (default: RATE of [AUDIO] or 44100)')
+    parser.add_argument('--channels', metavar='n', type=int, default=int(AUDIO.get('CHANNELS', '2')),
+                        help='Channels of raw sources (default: CHANNELS of [AUDIO] or 2)')
+    parser.add_argument('--benchmark', action='store_true', default=False,
+                        help='Analyze the source as fast as possible without streaming, report the fps and delay')
+    args = parser.parse_args()
+
+    bands, band_colors, targets = read_bands(PLAYCONFIG)
+    if not bands:
+        print("No BAND# section in play.ini")
+        sys.exit(1)
+    source = PcmSource(args.source, args.rate, args.channels)
+    fps = float(AUDIO.get('FPS', '30'))
+    window = int(AUDIO.get('WINDOW', '1024'))
+    hop = max(int(source.rate / fps), 1)
+    budget = float(AUDIO.get('LATENCY', '100')) / 1000
+    analyzer = BandAnalyzer(bands, source.rate, max(window, hop), hop,
+                            float(AUDIO.get('SMOOTHING', '0.6')), float(AUDIO.get('BEAT', '1.5')))
+    producer = AudioProducer(source, analyzer, band_colors, not args.benchmark)
+    sender = None if args.benchmark else ZoneSender(PLAYCONFIG, targets, fps)
+
+    start = time.monotonic()
+    sent = 0
+    late = 0
+    delay = 0.0
+    producer.start()
+    try:
+        while True:
+            frame = producer.frames.get()
+            if frame is None:
+                break
+            read_at, colors = frame
+            age = time.monotonic() - read_at
+            if sender is None:
+                continue
+            if age > budget:
+                late += 1
+                continue
+            if sender.push(colors):
+                sent += 1
+                delay += time.monotonic() - read_at
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if sender is not None:
+            sender.close()
+        source.close()
+    elapsed = time.monotonic() - start
+    if producer.processed:
+        window_delay = analyzer.window / 2.0 / source.rate * 1000
+        analysis = producer.busy / producer.processed * 1000
+        print("{} frames in {:.2f}s ({:.1f} fps), analysis {:.2f} ms per frame ({:.2f} ms max), "
+              "window delay {:.1f} ms: {:.1f} ms added delay" \
+              .format(producer.processed, elapsed, producer.processed / elapsed, analysis,
+                      producer.busy_max * 1000, window_delay, window_delay + analysis))
+        if sender is not None:
+            print("{} frames streamed, {} over the {:.0f} ms latency budget, {:.2f} ms from read "
+                  "to send".format(sent, late, budget * 1000, delay / sent * 1000 if sent else 0))
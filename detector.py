@@ -7,10 +7,12 @@ import time
 import datetime
 
 DETECTION_HOUR = 18
+PREPARE_LEAD = 60 #seconds before DETECTION_HOUR to connect to the lights of a delayed start
 DEVICE_MAC = ["40:4E:36:87:0B:51", "40:4E:36:87:0B:89"]
 DEVICE_STATUS = [0]*len(DEVICE_MAC)
 STATUS = 0
 DELAYED_START = 0
+PREPARED = 0
 
 class LightManager(object):
     """ Methods for instanciating and managing BLE lightbulbs """
@@ -54,10 +56,18 @@ while True:
             os.system('./playclient.py --off --notime --priority 3')
             STATUS = 0
             DELAYED_START = 0
+            PREPARED = 0
+        if DELAYED_START == 1 and PREPARED == 0 and datetime.datetime.now() >= \
+           datetime.datetime.now().replace(hour=DETECTION_HOUR, minute=0, second=0) \
+           - datetime.timedelta(seconds=PREPARE_LEAD):
+            LightManager.debugger("DELAYED STATE coming, preparing lights", 0)
+            os.system('./playclient.py --prepare --group passage --hold {}'.format(PREPARE_LEAD + 60))
+            PREPARED = 1
         if datetime.datetime.now().hour == DETECTION_HOUR and DELAYED_START == 1:
             LightManager.debugger("DELAYED STATE with actual state {}, turned on".format(DEVICE_STATUS), 0)
             os.system('./playclient.py --on --group passage')
             DELAYED_START = 0
+            PREPARED = 0
         if STATUS == 0 and 1 in DEVICE_STATUS:
             if datetime.datetime.now().hour < DETECTION_HOUR:
                 LightManager.debugger("Scheduling state change, with actual state {}" \
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+'''
+    File name: journaltool.py
+    Python Version: 3.7
+
+    Queries the state journal written by ./play.py --server --journal: device states at
+    any point in time, accepted requests and their outcomes, and per-device history.
+'''
+import argparse
+import datetime
+import configparser
+import sys
+from argparse import RawTextHelpFormatter
+from play import StateJournal
+
+def parse_time(value):
+    """ Parses 'YYYY-MM-DD HH:MM[:SS]' or a unix timestamp """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"):
+        try:
+            return datetime.datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("Invalid time {}".format(value))
+
+def format_time(timestamp):
+    """ Formats a journal timestamp """
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+""" Script executed directly """
+if __name__ == "__main__":
+    PLAYCONFIG = configparser.ConfigParser()
+    PLAYCONFIG.read('play.ini')
+
+    parser = argparse.ArgumentParser(description='Play server state journal tool',
+                                     formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--dir', metavar='dir', type=str, default=None,
+                        help='Journal directory (default: JOURNAL_DIR of play.ini)')
+    parser.add_argument('--at', metavar='time', type=parse_time, default=None,
+                        help="Rebuild the device states at 'YYYY-MM-DD HH:MM[:SS]' (default: now)")
+    parser.add_argument('--requests', action='store_true', default=False,
+                        help='List the accepted requests and their outcomes')
+    parser.add_argument('--device', metavar='devid', type=int, default=None,
+                        help='List the state transitions of a device')
+    parser.add_argument('--since', metavar='time', type=parse_time, default=None,
+                        help='Only list records after this time')
+    args = parser.parse_args()
+
+    directory = args.dir or PLAYCONFIG['SERVER']['JOURNAL_DIR']
+
+    if args.requests or args.device is not None:
+        outcomes = {}
+        if args.requests:
+            for record in StateJournal.records(directory):
+                if record["k"] == "end":
+                    outcomes[record["r"]] = record["x"]
+        for record in StateJournal.records(directory):
+            if (args.since is not None and record["t"] < args.since) \
+               or (args.at is not None and record["t"] > args.at):
+                continue
+            if args.requests and record["k"] == "req":
+                print("{} request {} priority {} colors {} -> {}" \
+                      .format(format_time(record["t"]), record["r"], record["p"], record["c"],
+                              outcomes.get(record["r"], "pending")))
+            elif args.device is not None and record["k"] == "set" and record["d"] == args.device:
+                print("{} request {} device {}: {} -> {} ({})" \
+                      .format(format_time(record["t"]), record["r"], record["d"], record["o"],
+                              record["n"], record["x"]))
+        sys.exit()
+
+    states = StateJournal.replay(directory, args.at)
+    if states is None:
+        print("No journal records in {} up to that time".format(directory))
+        sys.exit(1)
+    for devid, state in enumerate(states):
+        print("{} - {}".format(devid, state))
@@ -12,23 +12,33 @@ import os
 import os.path
 import sys
 import argparse
-import sched
 import time
 import datetime
 import socket
 import threading
 import functools
-import configparser
 import traceback
 import json
 import signal
 import queue
+import math
+import colorsys
+import heapq
+import itertools
+import collections
+import select
+import struct
 from argparse import RawTextHelpFormatter, Namespace
-from multiprocessing.pool import ThreadPool
-import bluepy.btle as ble
 from __main__ import *
+from playconstants import EFFECTS
+# numpy, multiprocessing.pool, configparser and bluepy are imported where they are
+# used: the client path of this script starts without them (see load_bluepy), and the
+# server falls back to colorsys conversions when numpy is not installed
+ble = None
 
 JOURNALING = False #do not edit - use the --journal option
+SIMULATE = False #do not edit - use the --simulate option
+PLAYCONFIG_FILE = 'play.ini' #do not edit - use the --config option
 
 ###
 
@@ -36,19 +46,46 @@ def connect_ble(_f):
     """ Wrapper for functions which requires an active BLE connection using bluepy """
     @functools.wraps(_f)
     def _conn_wrap(self, *args):
-        if self._connection is None:
-            try:
-                LightManager.debugger("CONnecting to device ({}) {}".format(self.device_type,
-                                                                            self.device), 0)
-                connection = ble.Peripheral(self.device)
-                self._connection = connection.withDelegate(self)
-            except Exception as ex:
-                LightManager.debugger("Device ({}) {} connection failed. Exception: {}" \
-                                      .format(self.device_type, self.device, ex), 1)
-                self._connection = None
+        if self._connection is None and not self.breaker_open():
+            self.connect()
         return _f(self, *args)
     return _conn_wrap
 
+def send_frame(sock, payload):
+    """ Sends a length-prefixed frame (4 ASCII digits + utf-8 payload) in a single call """
+    data = payload.encode('utf-8')
+    if len(data) > 9999:
+        raise ValueError("Frame of {} bytes exceeds the protocol limit".format(len(data)))
+    sock.sendall(('%04d' % len(data)).encode('utf-8') + data)
+
+def recv_exact(sock, size):
+    """ Reads exactly size bytes from the socket, None if the peer hung up """
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    """ Reads a complete length-prefixed frame, None if the peer hung up """
+    header = recv_exact(sock, 4)
+    if header is None:
+        return None
+    data = recv_exact(sock, int(header.decode('utf-8')))
+    if data is None:
+        return None
+    return data.decode('utf-8')
+
+def load_bluepy():
+    """ Imports bluepy on the first device connection, simulated servers never need it """
+    global ble
+    if ble is None:
+        import bluepy.btle
+        ble = bluepy.btle
+    return ble
+
 ###
 # CONSTANTS
 LIGHT_SKIP = "-1"
@@ -58,27 +95,62 @@ LIGHT_ON = "1"
 
 class LightServer(object):
     """ Handles server-side request reception and handling """
-    def __init__(self, lm, host, port):
+    def __init__(self, lm, host, port, federation=None, colors=None, capture=None):
         self.host = host
         self.port = port
+        self.federation = federation
+        self.capture = capture
+        self.admission = AdmissionControl(lm.config, lm.scheduler)
+        self.udp = None
+        if lm.config.get('SERVER', 'UDP_PORT', fallback=None):
+            self.udp = UdpIngest(lm, self.admission, host, int(lm.config['SERVER']['UDP_PORT']),
+                                 float(lm.config.get('SERVER', 'UDP_STREAM_TIMEOUT', fallback='5')), capture)
+        self.http = HttpApi(self, lm) if lm.config.getboolean('SERVER', 'HTTP_API', fallback=False) else None
+        self.websockets = WebSocketHub(self, lm,
+                                       float(lm.config.get('SERVER', 'WS_PING_INTERVAL', fallback='20')),
+                                       int(lm.config.get('SERVER', 'WS_QUEUE', fallback='32')),
+                                       float(lm.config.get('SERVER', 'WS_PUSH_INTERVAL', fallback='0.25'))) \
+                          if self.http is not None else None
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.host, self.port))
-        self.sched_disconnect = sched.scheduler(time.time, time.sleep)
-        self.scheduled_disconnect = None
+        self.disconnect_delay = float(lm.config.get('SERVER', 'DISCONNECT_DELAY', fallback='60'))
+        self._disconnect_timer = None
+        self._disconnect_lock = threading.Lock()
+        self.mediacenter = None
+        if lm.config.has_section('KODI'):
+            kodi = lm.config['KODI']
+            self.mediacenter = MediaCenter(kodi['HOST'], int(kodi.get('PORT', '8080')), kodi.get('USER'),
+                                           kodi.get('PASSWORD'), float(kodi.get('TIMEOUT', '5')))
+        tv = lm.config['TV'] if lm.config.has_section('TV') else {}
+        self.television = Television(tv.get('WOL_MAC'), tv.get('WOL_ADDRESS', '255.255.255.255'),
+                                     tv.get('CEC_DEVICE', '0'),
+                                     (self.mediacenter.host, self.mediacenter.port)
+                                     if self.mediacenter is not None else None,
+                                     float(tv.get('POLL_INTERVAL', '0.5')), float(tv.get('READY_TIMEOUT', '30')))
         signal.signal(signal.SIGTERM, self.remove_server)
-        lm.set_colors([LIGHT_ON] * len(lm.devices))
-        lm.run()
+        self.profiler = DaemonProfiler(self, lm, lm.config.get('SERVER', 'JOURNAL_DIR', fallback='.'),
+                                       float(lm.config.get('SERVER', 'PROFILE_SECONDS', fallback='30')))
+        self.profiler.install()
+        lm.run(RequestContext.build(colors or [LIGHT_ON] * len(lm.devices), 1))
 
     def listen(self):
         """ Starts the server """
         LightManager.debugger('Server started', 0)
-        # Cleanup connection to allow new sock.accepts faster as sched is blocking
         self.disconnect_devices()
+        if self.mediacenter is not None:
+            self.mediacenter.submit("JSONRPC.Ping") #opens the channel ahead of the first TV request
+        if self.udp is not None:
+            self.udp.start()
         self.sock.listen(5)
         while True:
             client, address = self.sock.accept()
             LightManager.debugger("Connected with {}:{}".format(address[0], address[1]), 0)
+            if not self.admission.admit_client():
+                LightManager.debugger("Too many clients, refusing {}".format(address[0]), 1)
+                self._send_busy(client, "Too many clients", 1)
+                client.close()
+                continue
             client.settimeout(30)
             threading.Thread(target=self.listen_client, args=(client, address)).start()
 
@@ -87,28 +159,44 @@ class LightServer(object):
         streamingdev = False
         streaminggrp = False
         streaming_id = None
+        conn = None
         try:
+            # legacy frames start with their length digits, HTTP requests with a method
+            if self.http is not None and not client.recv(1, socket.MSG_PEEK).isdigit():
+                self.http.serve(client, address)
+                return
+            if self.capture is not None:
+                conn = self.capture.open(address)
             while True:
-                msize = int(client.recv(4).decode('utf-8'))
-                if self.scheduled_disconnect is not None:
-                    self.sched_disconnect.cancel(self.scheduled_disconnect)
-                    self.scheduled_disconnect = None
-                #LightManager.debugger("Set message size {}".format(msize), 0)
-                data = client.recv(msize)
+                data = self._recv(client, conn)
+                if data is None:
+                    break
+                received = time.monotonic()
+                self._cancel_disconnect()
                 if data:
-                    if data.decode('utf-8') == "getstate":
+                    if data == "getstate":
                         LightManager.debugger('Sending lightserver status', 0)
-                        client.send(str.encode(str(lm.get_state())))
+                        if self.federation is not None:
+                            client.send(str.encode(json.dumps(self.federation.get_state())))
+                        else:
+                            client.send(str.encode(json.dumps(lm.get_status())))
+                        self._capture_reply(conn, received, "ok")
+                        break
+                    if data == "session":
+                        LightManager.debugger('Starting persistent session', 0)
+                        client.settimeout(None)
+                        client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                        self.listen_session(client, address, conn)
                         break
-                    if data.decode('utf-8') == "stream":
+                    if data == "stream":
                         LightManager.debugger('Starting streaming mode', 0)
                         streamingdev = True
                         continue
-                    if data.decode('utf-8') == "streamgroup":
+                    if data == "streamgroup":
                         LightManager.debugger('Starting group streaming mode', 0)
                         streaminggrp = True
                         continue
-                    if data.decode('utf-8') == "nostream":
+                    if data == "nostream":
                         LightManager.debugger('Ending streaming mode', 0)
                         streamingdev = False
                         streaminggrp = False
@@ -116,31 +204,42 @@ class LightServer(object):
                         break
                     if streamingdev:
                         if streaming_id is None:
-                            streaming_id = int(data.decode('utf-8'))
+                            streaming_id = int(data)
                             LightManager.debugger('Set streaming devid to {}' \
                                                   .format(streaming_id), 0)
                             continue
+                        color, ended = self._throttle_stream(client, address[0], [streaming_id],
+                                                             data, conn)
                         LightManager.debugger("Sending request to devid {} for color: {}" \
-                                              .format(streaming_id, data.decode('utf-8')), 0)
-                        lm.set_light_stream(streaming_id, data.decode('utf-8'), False)
+                                              .format(streaming_id, color), 0)
+                        lm.set_light_stream(streaming_id, color, False)
+                        if ended:
+                            break
                         continue
                     if streaminggrp:
                         if streaming_id is None:
-                            streaming_id = data.decode('utf-8')
+                            streaming_id = data
                             LightManager.debugger('Set streaming group to {}' \
                                                   .format(streaming_id), 0)
                             continue
+                        color, ended = self._throttle_stream(client, address[0],
+                                                             [i for i, dev in enumerate(lm.devices)
+                                                              if dev.group == streaming_id],
+                                                             data, conn)
                         LightManager.debugger("Sending request to group '{}' for color: {}" \
-                                              .format(streaming_id, data.decode('utf-8')), 0)
-                        lm.set_light_stream(streaming_id, data.decode('utf-8'), True)
+                                              .format(streaming_id, color), 0)
+                        lm.set_light_stream(streaming_id, color, True)
+                        if ended:
+                            break
                         continue
                     try:
-                        args = self._sanitize(json.loads(data.decode('utf-8')))
+                        args = self._sanitize(json.loads(data))
                     except: #fallback - data is not formatted
                         LightManager.debugger("Error - improperly formatted JSON", 2)
                         break
                     LightManager.debugger('Change of lights requested with args: ' + str(args), 0)
-                    self._validate_and_execute_req(args)
+                    result = self.execute_request(args, address[0])
+                    self._capture_reply(conn, received, result["status"])
                     break
 
         except socket.timeout:
@@ -154,87 +253,262 @@ class LightServer(object):
 
         finally:
             LightManager.debugger('Closing connection.', 0)
-            lm.set_lock(0)
-            lm.reinit()
             client.close()
-            self.scheduled_disconnect = self.sched_disconnect.enter(60, 1, 
-                                                                    self.disconnect_devices, ())
-            self.sched_disconnect.run()
+            if conn is not None:
+                self.capture.close(conn)
+            self.admission.release_client()
+            self._schedule_disconnect()
+
+    def listen_session(self, client, address, conn=None):
+        """ Handles framed requests on a persistent connection, answering each one """
+        while True:
+            data = self._recv(client, conn)
+            if data is None:
+                LightManager.debugger('Session closed by peer', 0)
+                return
+            received = time.monotonic()
+            self._cancel_disconnect()
+            status = "ok"
+            command = self.session_command(data)
+            if command is not None:
+                answer = command[1]
+                if isinstance(answer, dict) and answer.get("status") == "error":
+                    status = "error"
+                send_frame(client, json.dumps(answer))
+            else:
+                try:
+                    args = self._sanitize(json.loads(data))
+                except ValueError:
+                    LightManager.debugger("Error - improperly formatted JSON", 2)
+                    args = None
+                    status = "error"
+                    send_frame(client, json.dumps({"status": status,
+                                                   "message": "Improperly formatted JSON"}))
+                if args is not None:
+                    LightManager.debugger('Session request with args: ' + str(args), 0)
+                    result = self.execute_request(args, address[0])
+                    status = result["status"]
+                    send_frame(client, json.dumps(result))
+            self._capture_reply(conn, received, status)
+
+    def session_command(self, data):
+        """
+        Answers the session commands of framed sessions and WebSockets alike: getstate, describe,
+        udpstats, commitstats, profile ... and simulate ... on simulated servers. Returns the
+        command name and its answer, None if data is not a session command (a JSON request)
+        """
+        name = data.split(" ", 1)[0]
+        if data == "getstate":
+            return name, self.federation.get_state() if self.federation is not None else lm.get_status()
+        if data == "describe":
+            return name, lm.describe()
+        if data == "udpstats":
+            return name, self.udp.stats() if self.udp is not None else []
+        if data == "commitstats":
+            return name, lm.commit_stats
+        if name == "profile":
+            return name, self.profiler.command(data)
+        if SIMULATE and name == "simulate":
+            return name, SimulatedPeripheral.control(data[len("simulate"):])
+        return None
+
+    def _recv(self, client, conn):
+        data = recv_frame(client)
+        if data is not None and conn is not None:
+            self.capture.frame(conn, data)
+        return data
+
+    def _capture_reply(self, conn, received, status):
+        if conn is not None:
+            self.capture.reply(conn, received, status)
+
+    def execute_request(self, args, client=None):
+        """ Runs a sanitized request locally and, as a coordinator, on the owning nodes """
+        retry_after = self.admission.admit_request(client, args["priority"])
+        if retry_after:
+            LightManager.debugger("Server busy, request from {} rejected".format(client), 1)
+            return {"status": "busy", "message": "Server busy, retry later",
+                    "retry_after": round(retry_after, 2)}
+        if self.federation is None:
+            return self._validate_and_execute_req(args)
+        return self.federation.execute(args, self._validate_and_execute_req, self._expand_scenes)
+
+    def _throttle_stream(self, client, address, targets, color, conn=None):
+        """
+        Waits for a stream frame to be admitted, replacing it with any newer frame received
+        meanwhile: stale frames are dropped rather than queued for the radio.
+        Returns the frame to send and whether the client ended the stream.
+        """
+        while True:
+            wait = self.admission.admit_frame(address, targets)
+            if not wait:
+                return color, False
+            time.sleep(wait)
+            while select.select([client], [], [], 0)[0]:
+                data = self._recv(client, conn)
+                if data is None or data == "nostream":
+                    return color, True
+                color = data
+
+    def _send_busy(self, client, message, retry_after):
+        try:
+            send_frame(client, json.dumps({"status": "busy", "message": message,
+                                           "retry_after": retry_after}))
+        except OSError:
+            pass
+
+    def _schedule_disconnect(self):
+        # a single timer, rearmed by every client: client threads end instead of waiting for it
+        with self._disconnect_lock:
+            if self._disconnect_timer is not None:
+                self._disconnect_timer.cancel()
+            self._disconnect_timer = threading.Timer(self.disconnect_delay, self.disconnect_devices)
+            self._disconnect_timer.daemon = True
+            self._disconnect_timer.start()
+
+    def _cancel_disconnect(self):
+        with self._disconnect_lock:
+            if self._disconnect_timer is not None:
+                self._disconnect_timer.cancel()
+                self._disconnect_timer = None
 
     def disconnect_devices(self):
         """ Disconnects all configured devices """
-        self.scheduled_disconnect = None
         LightManager.debugger("Server unused. Disconnecting devices.", 0)
         for _dev in lm.devices:
-            _dev.disconnect()
+            if not _dev.prepared():
+                _dev.disconnect()
 
     def remove_server(self, signal, frame):
         """ Shuts down server and cleans resources """
         LightManager.debugger("Closing down server and lights.", 0)
-        lm.skip_time(0)
-        lm.set_colors([LIGHT_OFF] * len(lm.devices))
-        lm.run()
+        lm.run(RequestContext.build([LIGHT_OFF] * len(lm.devices), 3, False))
+        if lm.journal is not None:
+            lm.journal.close()
+        if self.capture is not None:
+            self.capture.stop()
+        if self.mediacenter is not None:
+            self.mediacenter.close()
         time.sleep(3)
         self.sock.close()
 
     def _validate_and_execute_req(self, args):
         LightManager.debugger("Validating arguments", 0)
+        if args["batch"] is not None:
+            if any([args["hexvalues"], args["playbulb"], args["milight"], args["on"], args["off"],
+                    args["toggle"], args["tvon"], args["tvoff"], args["tvrestart"], args["prepare"],
+                    args["effect"]]):
+                return self._reject("Cannot combine a batch or scene with other light or TV options")
+            return self._execute_batch(args)
         if args["hexvalues"] and (args["playbulb"] or args["milight"]):
-            LightManager.debugger("Got color hexvalues for milights and/or playbulbs \
-                                   and/or both devices in the same request, which is not \
-                                   supported. Use '{} -h' for help. Quitting".format(sys.argv[0]),
-                                 2)
-            return
+            return self._reject("Got color hexvalues for milights and/or playbulbs \
+                                 and/or both devices in the same request, which is not \
+                                 supported. Use '{} -h' for help. Quitting".format(sys.argv[0]))
         if args["tvon"] and args["tvoff"]:
-            LightManager.debugger("Cannot ON and OFF the TV in the same request. Quitting.", 2)
-            return         
+            return self._reject("Cannot ON and OFF the TV in the same request. Quitting.")
+        if args["prepare"]:
+            LightManager.debugger("Preparing connections for the next request", 0)
+            count = lm.prepare(args["group"], args["subgroup"], args["hold"])
+            return self._result("Prepared {} devices".format(count))
+        if args["effect"] is not None:
+            return self._start_effect(args)
         if len(args["hexvalues"]) != len(lm.devices) and not any([args["notime"], args["off"], args["on"], 
                                                                   args["playbulb"], args["milight"], 
                                                                   args["toggle"], args["tvon"], 
                                                                   args["tvoff"], args["tvrestart"]]):
-            LightManager.debugger("Got {} color hexvalues, {} expected. Use '{} -h' for help. Quitting" \
-                                  .format(len(args["hexvalues"]), len(lm.devices), sys.argv[0]), 2)
-            return
+            return self._reject("Got {} color hexvalues, {} expected. Use '{} -h' for help. Quitting" \
+                                .format(len(args["hexvalues"]), len(lm.devices), sys.argv[0]))
+        kodi = None
         if args["tvon"]:
             LightManager.debugger("Setting TV on", 0)
-            self._set_tv(1)
-            return #Do not accept any more requests for now.
+            lights = None
+            if any([args["hexvalues"], args["playbulb"], args["milight"], args["on"], args["off"],
+                    args["toggle"]]):
+                lights = functools.partial(self._validate_and_execute_req, dict(args, tvon=False))
+            tv, result = self._set_tv(1, lights)
+            if tv["status"] != "ok":
+                message = "TV not ready within {} seconds".format(self.television.ready_timeout)
+                if result is None:
+                    result = self._reject(message)
+                else:
+                    result["message"] = "{}. {}".format(message, result["message"])
+                    result["status"] = "error"
+            elif result is None:
+                result = self._result("TV set on")
+            result["tv"] = tv
+            return result
         if args["tvoff"]:
             LightManager.debugger("Setting TV off", 0)
-            self._set_tv(0)
+            kodi = self._set_tv(0)
         if args["tvrestart"]:
             LightManager.debugger("Rebooting KODI", 0)
-            self._set_tv(2)
-            return
-        if args["priority"]:
-            lm.priority = args["priority"]
+            kodi = self._set_tv(2)
+            result = self._result("KODI restarted" if kodi["status"] == "ok"
+                                  else "KODI restart failed: {}".format(kodi["message"]),
+                                  "ok" if kodi["status"] == "ok" else "error")
+            result["kodi"] = kodi
+            return result
         if args["hexvalues"]:
             LightManager.debugger("Received color hexvalues length {} for {} devices" \
                                   .format(len(args["hexvalues"]), len(lm.devices)), 0)
-            lm.set_colors(args["hexvalues"])
+            colors = args["hexvalues"]
         else:
+            colors = [LIGHT_SKIP] * len(lm.devices)
             if args["playbulb"] is not None:
                 LightManager.debugger("Received playbulb change request", 0)
-                lm.set_typed_colors(args["playbulb"], "Playbulb")
+                colors = lm.typed_colors(colors, args["playbulb"], "Playbulb")
             if args["milight"] is not None:
                 LightManager.debugger("Received milight change request", 0)
-                lm.set_typed_colors(args["milight"], "Milight")
+                colors = lm.typed_colors(colors, args["milight"], "Milight")
             if args["off"]:
                 LightManager.debugger("Received OFF change request", 0)
-                lm.set_colors([LIGHT_OFF] * len(lm.devices))
+                colors = [LIGHT_OFF] * len(lm.devices)
             if args["on"]:
                 LightManager.debugger("Received ON change request", 0)
-                lm.set_colors([LIGHT_ON] * len(lm.devices))
+                colors = [LIGHT_ON] * len(lm.devices)
             if args["toggle"]:
                 LightManager.debugger("Received TOGGLE change request", 0)
-                lm.set_colors(lm.get_toggle())
-        if args["notime"] or args["off"]:
-            lm.skip_time(0)
+                colors = lm.get_toggle()
         if args["group"] is not None:
-            lm.get_group(args["group"], args["subgroup"])
+            colors = lm.select_group(colors, args["group"], args["subgroup"])
         LightManager.debugger("Arguments are OK", 0)
-        lm.run()
-        return
+        outcome = lm.run(RequestContext.build(colors, args["priority"],
+                                              not (args["notime"] or args["off"])))
+        result = self._result("Change of lights {}".format(outcome), self._outcome_status(outcome))
+        if kodi is not None:
+            result["kodi"] = kodi
+            if kodi["status"] != "ok":
+                result["status"] = "error"
+        return result
+
+    def _start_effect(self, args):
+        if args["effect"] not in EFFECTS:
+            return self._reject("Unknown effect {}, expected one of {}".format(args["effect"], ", ".join(EFFECTS)))
+        if len(args["hexvalues"]) > 1 or any([args["playbulb"], args["milight"], args["on"], args["off"],
+                                              args["toggle"]]):
+            return self._reject("An effect takes a single color and no other light option")
+        speed = int(args["speed"])
+        if not 1 <= speed <= 255:
+            return self._reject("Effect speed {} out of the 1 to 255 range".format(speed))
+        LightManager.debugger("Received {} effect request".format(args["effect"]), 0)
+        colors = [args["hexvalues"][0] if args["hexvalues"] else LIGHT_ON] * len(lm.devices)
+        if args["group"] is not None:
+            colors = lm.select_group(colors, args["group"], args["subgroup"])
+        outcome = lm.start_effect(RequestContext.build(colors, args["priority"], not args["notime"]),
+                                  args["effect"], speed)
+        return self._result("Effect {} {}".format(args["effect"], outcome), self._outcome_status(outcome))
+
+    @staticmethod
+    def _outcome_status(outcome):
+        # partial: the devices left alone are unreachable (open circuit breaker), the others changed
+        return {"incomplete": "error", "partial": "partial"}.get(outcome, "ok")
+
+    def _result(self, message, status="ok"):
+        return {"status": status, "message": message, "state": lm.get_state()}
+
+    def _reject(self, message):
+        LightManager.debugger(message, 2)
+        return self._result(message, "error")
 
     def _sanitize(self, args):
         if "hexvalues" not in args:
@@ -269,6 +543,20 @@ class LightServer(object):
             args["group"] = None
         if "subgroup" not in args:
             args["subgroup"] = None
+        if "prepare" not in args:
+            args["prepare"] = False
+        if "batch" not in args or args["batch"] is None:
+            args["batch"] = None
+            if args.get("scene") is not None:
+                args["batch"] = [{"op": "scene", "name": args["scene"]}]
+        elif type(args["batch"]).__name__ == "str":
+            args["batch"] = json.loads(args["batch"])
+        if "hold" not in args:
+            args["hold"] = None
+        if "effect" not in args:
+            args["effect"] = None
+        if "speed" not in args or args["speed"] is None:
+            args["speed"] = 20
         if type(args["playbulb"]).__name__ == "str":
             LightManager.debugger('Converting values to lists for playbulb', 0)
             args["playbulb"] = args["playbulb"].replace("'", "").split(',')
@@ -277,25 +565,1221 @@ class LightServer(object):
             args["milight"] = args["milight"].replace("'", "").split(',')
         return args
 
-    def _set_tv(self, value):
+    def _execute_batch(self, args):
+        """ Validates a batch of operations once, then runs its execution plan """
+        try:
+            ops = self._expand_scenes(args["batch"], 0)
+            stages = self._compile_batch(ops)
+        except (ValueError, TypeError, KeyError) as ex:
+            return self._reject("Invalid batch: {}".format(ex))
+        LightManager.debugger("Running batch of {} steps in {} stages".format(len(ops), len(stages)), 0)
+        steps = [{"op": op["op"], "status": "ok"} for op in ops]
+        for stage in stages:
+            if stage["delay"]:
+                time.sleep(stage["delay"])
+                continue
+            tv_threads = [threading.Thread(target=self._run_tv_step, args=(value, steps[index]))
+                          for index, value in stage["tv"]]
+            for _thread in tv_threads:
+                _thread.start()
+            if stage["frame"] is not None:
+                outcome = lm.run_frame(stage["frame"], args["priority"], not args["notime"])
+                for index in stage["lights"]:
+                    steps[index]["message"] = outcome
+                    steps[index]["status"] = self._outcome_status(outcome)
+            for _thread in tv_threads:
+                _thread.join()
+        status = "ok"
+        if any(step["status"] == "partial" for step in steps):
+            status = "partial"
+        if any(step["status"] == "error" for step in steps):
+            status = "error"
+        result = self._result("Batch of {} steps completed".format(len(ops)), status)
+        result["steps"] = steps
+        return result
+
+    def _expand_scenes(self, ops, depth):
+        if depth > 4:
+            raise ValueError("scenes nested too deeply")
+        expanded = []
+        for op in ops:
+            if op.get("op") == "scene":
+                if op.get("name") not in lm.scenes:
+                    raise ValueError("unknown scene {}".format(op.get("name")))
+                expanded.extend(self._expand_scenes(lm.scenes[op["name"]], depth + 1))
+            else:
+                expanded.append(op)
+        return expanded
+
+    def _compile_batch(self, ops):
+        """
+        Compiles the operations into stages run one after the other. Delays separate stages,
+        light operations of a stage are merged into a single frame (later operations win on
+        the devices they share) and TV operations run alongside, one TV operation per stage.
+        """
+        stages = []
+        stage = {"frame": None, "lights": [], "tv": [], "delay": 0}
+        planned = {} #device -> color it will have when the operation runs
+        for index, op in enumerate(ops):
+            kind = op.get("op")
+            if kind == "delay":
+                seconds = float(op.get("seconds", 0))
+                if not 0 <= seconds <= 300:
+                    raise ValueError("delay of {} seconds out of range".format(seconds))
+                stages.append(stage)
+                stages.append({"frame": None, "lights": [], "tv": [], "delay": seconds})
+                stage = {"frame": None, "lights": [], "tv": [], "delay": 0}
+            elif kind == "tv":
+                value = {"off": 0, "on": 1, "restart": 2}[op.get("value")]
+                if stage["tv"]:
+                    stages.append(stage)
+                    stage = {"frame": None, "lights": [], "tv": [], "delay": 0}
+                stage["tv"].append((index, value))
+            elif kind in ("set", "on", "off", "toggle"):
+                targets = self._batch_targets(op)
+                if stage["frame"] is None:
+                    stage["frame"] = [LIGHT_SKIP] * len(lm.devices)
+                if kind == "set":
+                    color = str(op["color"])
+                    for i in targets:
+                        if not lm.colorengine.valid(color, lm.devices[i].device_type):
+                            raise ValueError("color {} not supported by device {}".format(color, i))
+                elif kind == "toggle":
+                    color = LIGHT_ON if all(lm.devices[i].convert(planned.get(i, lm.get_state(i)))
+                                            == lm.devices[i].convert(LIGHT_OFF) for i in targets) else LIGHT_OFF
+                else:
+                    color = LIGHT_ON if kind == "on" else LIGHT_OFF
+                for i in targets:
+                    stage["frame"][i] = color
+                    planned[i] = color
+                stage["lights"].append(index)
+            else:
+                raise ValueError("unknown operation {}".format(kind))
+        stages.append(stage)
+        return [s for s in stages if s["frame"] is not None or s["tv"] or s["delay"]]
+
+    def _batch_targets(self, op):
+        if op.get("devices") is not None:
+            targets = [int(i) for i in op["devices"]]
+            if any(not 0 <= i < len(lm.devices) for i in targets):
+                raise ValueError("unknown device in {}".format(op["devices"]))
+            return targets
+        targets = [i for i, dev in enumerate(lm.devices)
+                   if (op.get("group") is None or dev.group == op["group"])
+                   and (op.get("subgroup") is None or dev.subgroup == op["subgroup"])]
+        if not targets:
+            raise ValueError("no device in group {} subgroup {}".format(op.get("group"), op.get("subgroup")))
+        return targets
+
+    def _run_tv_step(self, value, step):
+        outcome = self._set_tv(value)
+        if value == 1:
+            step["tv"] = outcome = outcome[0]
+        else:
+            step["kodi"] = outcome
+        if outcome["status"] != "ok":
+            step["status"] = "error"
+
+    def _set_tv(self, value, lights=None):
+        """
+        Drives the TV through HDMI-CEC and Kodi through its control channel, returning the Kodi
+        outcome, or the power-on report and the lights result
+        """
         if value == 0:
             ## TV OFF
-            os.system("echo 'standby 0' | cec-client -s")
-            os.system("ssh kodi@192.168.1.200 'sudo shutdown now'")
-            LightManager.debugger('Set the TV and KODI to OFF', 0)
+            kodi = self._submit_kodi("System.Shutdown") #runs meanwhile
+            self.television.cec("standby")
+            LightManager.debugger('Set the TV to OFF', 0)
+            return self._wait_kodi(kodi, "System.Shutdown")
         elif value == 1:
             ## TV ON
-            os.system("echo 'on 0' | cec-client -s")
+            tv, result = self.television.power_on(lights)
+            if tv["media_center_ready_ms"] is not None:
+                self.mediacenter.submit("JSONRPC.Ping") #reopens the channel to the media center
             LightManager.debugger('Set the TV ON', 0)
+            return tv, result
         elif value == 2:
-            ## TV RESTART        
-            os.system("ssh kodi@192.168.1.200 'sudo reboot'")
-            LightManager.debugger('Restarted KODI', 0)
+            ## TV RESTART
+            return self._wait_kodi(self._submit_kodi("System.Reboot"), "System.Reboot")
+
+    def _submit_kodi(self, method):
+        return self.mediacenter.submit(method) if self.mediacenter is not None else None
+
+    def _wait_kodi(self, pending, method):
+        if pending is None:
+            LightManager.debugger("No [KODI] section in the configuration, {} not sent".format(method), 1)
+            return {"status": "error", "method": method, "message": "Kodi is not configured"}
+        return self.mediacenter.wait(pending, method)
+
+class HttpApi(object):
+    """
+    HTTP/1.1 JSON API of the play server, on the same port as the legacy protocol. Light
+    changes are run as batches, so they go through the same validation and admission
+    control. Connections are kept alive, and state responses are serialized once per
+    change and tagged: pollers sending the ETag back get an empty 304.
+    """
+    MAX_HEADER = 8192
+    MAX_BODY = 65536
+    REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+               405: "Method Not Allowed", 413: "Payload Too Large", 502: "Bad Gateway",
+               503: "Service Unavailable"}
+
+    def __init__(self, server, manager):
+        self.server = server
+        self.manager = manager
+        self._cache = {} #path -> (fingerprint, etag, body)
+        self._lock = threading.Lock()
+
+    def serve(self, client, address):
+        """ Answers the requests of a connection until the client closes it or goes idle """
+        pending = b''
+        while True:
+            try:
+                request, pending = self._read_request(client, pending)
+            except ValueError as ex:
+                self._respond(client, 413 if "large" in str(ex) else 400, {"status": "error", "message": str(ex)},
+                              [], False, "GET")
+                return
+            if request is None:
+                return
+            method, path, version, headers, body = request
+            self.server._cancel_disconnect()
+            LightManager.debugger("HTTP {} {} from {}".format(method, path, address[0]), 0)
+            if headers.get("upgrade", "").lower() == "websocket":
+                self._upgrade(client, address, path, headers, pending)
+                return
+            keep = headers.get("connection", "").lower() != "close" if version == "HTTP/1.1" \
+                   else headers.get("connection", "").lower() == "keep-alive"
+            try:
+                status, payload, extra = self.handle(method, path, headers, body, address[0])
+            except Exception as ex:
+                LightManager.debugger('Unhandled exception of type {}: {}, {}' \
+                                      .format(type(ex), ex, ''.join(traceback.format_tb(ex.__traceback__))), 2)
+                status, payload, extra = 400, {"status": "error", "message": str(ex)}, []
+            self._respond(client, status, payload, extra, keep, method)
+            if not keep:
+                return
+
+    def handle(self, method, path, headers, body, client):
+        """ Routes a request, returning its status, JSON payload (or serialized bytes) and extra headers """
+        parts = [part for part in path.split("?")[0].split("/") if part]
+        if method == "HEAD":
+            method = "GET"
+        if not parts:
+            return self._not_found(path)
+        resource, name = parts[0], "/".join(parts[1:]) or None
+        if method == "GET":
+            if resource == "state" and name is None:
+                return self._cached(path, headers, self._state)
+            if resource == "devices":
+                if name is None:
+                    return self._cached(path, headers, self._devices)
+                devid = self._devid(name)
+                if devid is None:
+                    return self._not_found(path)
+                return 200, self._devices()[devid], []
+            if resource == "groups" and name is None:
+                return 200, self._groups(), []
+            if resource == "scenes" and name is None:
+                return 200, sorted(self.manager.scenes), []
+            if resource in ("devices", "groups", "scenes", "tv", "state"):
+                return self._not_found(path)
+        elif method in ("PUT", "POST"):
+            try:
+                args = json.loads(body.decode('utf-8') or "{}")
+                if not isinstance(args, dict):
+                    raise ValueError("expected a JSON object")
+            except ValueError as ex:
+                return 400, {"status": "error", "message": "Invalid JSON body: {}".format(ex)}, []
+            if resource == "devices" and name is not None:
+                devid = self._devid(name)
+                if devid is None:
+                    return self._not_found(path)
+                return self._lights({"devices": [devid]}, args, client)
+            if resource == "groups" and name is not None:
+                if not any(dev.group == name for dev in self.manager.devices):
+                    return self._not_found(path)
+                return self._lights({"group": name, "subgroup": args.get("subgroup")}, args, client)
+            if resource == "scenes" and name is not None:
+                if name not in self.manager.scenes:
+                    return self._not_found(path)
+                return self._execute({"scene": name}, args, client)
+            if resource == "tv" and name in ("on", "off", "restart"):
+                return self._execute({"tv" + name: True}, args, client)
+            if resource not in ("devices", "groups", "scenes", "tv", "state"):
+                return self._not_found(path)
+        else:
+            return 405, {"status": "error", "message": "Method {} not allowed".format(method)}, \
+                   [("Allow", "GET, HEAD, PUT, POST")]
+        return 405, {"status": "error", "message": "Method {} not allowed on {}".format(method, path)}, \
+               [("Allow", "PUT, POST" if method == "GET" else "GET, HEAD")]
+
+    def _upgrade(self, client, address, path, headers, pending):
+        """ Completes an RFC 6455 opening handshake and runs the WebSocket session """
+        key = headers.get("sec-websocket-key")
+        if path.split("?")[0] != "/ws" or self.server.websockets is None:
+            self._respond(client, 404, {"status": "error", "message": "No WebSocket endpoint {}".format(path)},
+                          [], False, "GET")
+            return
+        if key is None or headers.get("sec-websocket-version") != "13":
+            self._respond(client, 400, {"status": "error", "message": "Unsupported WebSocket handshake"},
+                          [("Sec-WebSocket-Version", "13")], False, "GET")
+            return
+        import base64
+        import hashlib
+        accept = base64.b64encode(hashlib.sha1((key + WebSocketSession.GUID).encode('utf-8')).digest())
+        client.sendall(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                        "Connection: Upgrade\r\nSec-WebSocket-Accept: {}\r\n\r\n" \
+                        .format(accept.decode('ascii'))).encode('iso-8859-1'))
+        self.server.websockets.run(client, address, pending)
+
+    def _lights(self, op, args, client):
+        action = args.get("action", "set" if "color" in args else None)
+        if action not in ("set", "on", "off", "toggle"):
+            return 400, {"status": "error",
+                         "message": "Expected a color or an action (on, off or toggle)"}, []
+        op["op"] = action
+        if action == "set":
+            op["color"] = args["color"]
+        return self._execute({"batch": [op]}, args, client)
+
+    def _execute(self, request, args, client):
+        request["priority"] = int(args.get("priority", 1))
+        request["notime"] = bool(args.get("notime", False))
+        result = self.server.execute_request(self.server._sanitize(request), client)
+        if result["status"] == "busy":
+            return 503, result, [("Retry-After", str(int(math.ceil(result["retry_after"]))))]
+        if result["status"] == "error":
+            # failed batch steps are devices which could not be changed, anything else is a bad request
+            return (502 if "steps" in result else 400), result, []
+        return 200, result, []
+
+    def _cached(self, path, headers, build):
+        """ Serves the state-derived response of a path, serialized again only when the state changed """
+        if self.server.federation is not None and path.startswith("/state"):
+            import hashlib
+            body = json.dumps(self.server.federation.get_state()).encode('utf-8')
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        else:
+            fingerprint = self.manager.fingerprint()
+            with self._lock:
+                cached = self._cache.get(path)
+                if cached is None or cached[0] != fingerprint:
+                    cached = (fingerprint, '"{}"'.format(fingerprint), json.dumps(build()).encode('utf-8'))
+                    self._cache[path] = cached
+            _, etag, body = cached
+        if etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+            return 304, b'', [("ETag", etag)]
+        return 200, body, [("ETag", etag), ("Cache-Control", "no-cache")]
+
+    def _state(self):
+        return self.manager.get_status()
+
+    def _devices(self):
+        return [dict(description, **status) for description, status
+                in zip(self.manager.describe(), self.manager.get_status())]
+
+    def _groups(self):
+        groups = {}
+        for dev in self.manager.devices:
+            group = groups.setdefault(dev.group, {"devices": [], "subgroups": {}})
+            group["devices"].append(dev.devid)
+            group["subgroups"].setdefault(dev.subgroup, []).append(dev.devid)
+        return groups
+
+    def _devid(self, name):
+        return int(name) if name.isdigit() and int(name) < len(self.manager.devices) else None
+
+    @staticmethod
+    def _not_found(path):
+        return 404, {"status": "error", "message": "No resource {}".format(path)}, []
+
+    def _read_request(self, client, pending):
+        """ Reads one request, returning it as (method, path, version, headers, body) and the bytes after it """
+        while b"\r\n\r\n" not in pending:
+            if len(pending) > self.MAX_HEADER:
+                raise ValueError("Request header too large")
+            try:
+                chunk = client.recv(4096)
+            except socket.timeout:
+                return None, b''
+            if not chunk:
+                return None, b''
+            pending += chunk
+        head, pending = pending.split(b"\r\n\r\n", 1)
+        lines = head.decode('iso-8859-1').split("\r\n")
+        try:
+            method, path, version = lines[0].split(" ")
+        except ValueError:
+            raise ValueError("Malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise ValueError("Chunked request bodies are not supported")
+        length = int(headers.get("content-length", "0"))
+        if length > self.MAX_BODY:
+            raise ValueError("Request body too large")
+        while len(pending) < length:
+            chunk = client.recv(length - len(pending))
+            if not chunk:
+                return None, b''
+            pending += chunk
+        return (method.upper(), path, version, headers, pending[:length]), pending[length:]
+
+    def _respond(self, client, status, payload, headers, keep, method):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        lines = ["HTTP/1.1 {} {}".format(status, self.REASONS[status]),
+                 "Content-Type: application/json",
+                 "Connection: {}".format("keep-alive" if keep else "close")]
+        if status != 304:
+            lines.append("Content-Length: {}".format(len(body)))
+        lines.extend("{}: {}".format(name, value) for name, value in headers)
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode('iso-8859-1')
+        client.sendall(head if method == "HEAD" or status == 304 else head + body)
+
+
+class WebSocketHub(object):
+    """
+    WebSocket sessions of a LightServer (GET /ws). A single watcher thread checks the device
+    fingerprint every push_interval seconds and serializes a changed state once for all sessions.
+    """
+    def __init__(self, server, lm, ping_interval=20.0, queue_size=32, push_interval=0.25):
+        self.server = server
+        self.lm = lm
+        self.ping_interval = ping_interval
+        self.queue_size = queue_size
+        self.push_interval = push_interval
+        self.sessions = set()
+        self.state_frame = None
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def run(self, client, address, pending=b''):
+        """ Runs a session on an upgraded connection until it closes """
+        session = WebSocketSession(self, client, address, pending)
+        with self._lock:
+            self.sessions.add(session)
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="websocket-push", daemon=True)
+                self._watcher.start()
+        LightManager.debugger("WebSocket session opened by {}".format(address[0]), 0)
+        try:
+            session.run()
+        finally:
+            with self._lock:
+                self.sessions.discard(session)
+            LightManager.debugger("WebSocket session of {} closed".format(address[0]), 0)
+
+    def state_message(self):
+        """ Serializes the current state as a text frame """
+        state = self.server.federation.get_state() if self.server.federation is not None \
+                else self.lm.get_status()
+        return WebSocketSession.encode(WebSocketSession.TEXT,
+                                       json.dumps({"type": "state", "state": state}).encode('utf-8'))
+
+    def _watch(self):
+        fingerprint = None
+        while True:
+            time.sleep(self.push_interval)
+            with self._lock:
+                sessions = list(self.sessions)
+            if not sessions:
+                continue
+            current = self.lm.fingerprint()
+            if current == fingerprint:
+                continue
+            fingerprint = current
+            self.state_frame = self.state_message()
+            for session in sessions:
+                session.push_state(self.state_frame)
+
+
+class WebSocketSession(object):
+    """
+    RFC 6455 connection to a dashboard. Binary messages are stream frames made of the UDP
+    color entries (no header), text messages are the commands of the session protocol and
+    are answered in order with JSON. Replies go through a bounded queue (a client which
+    cannot keep up is disconnected), while state pushes only keep the newest one.
+    """
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xa
+    MAX_MESSAGE = 65536
+    #message type and answer key of the session commands, {"type": command, "result": ...} otherwise
+    ANSWERS = {"getstate": ("state", "state"), "describe": ("describe", "devices"),
+               "udpstats": ("udpstats", "streams"), "commitstats": ("commitstats", "commits")}
+
+    def __init__(self, hub, client, address, pending=b''):
+        self.hub = hub
+        self.client = client
+        self.address = address
+        self.sink = StreamSink(hub.lm, hub.server.admission, address[0])
+        self.replies = queue.Queue(maxsize=hub.queue_size)
+        self.closed = False
+        self.last_seen = time.monotonic()
+        self._pending = pending
+        self._state = hub.state_message() #pushed first, then on every change
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+
+    @staticmethod
+    def encode(opcode, payload):
+        """ Server frame (final, unmasked) of a payload """
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x80 | opcode, len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, len(payload))
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, len(payload))
+        return header + payload
+
+    def push_state(self, frame):
+        """ Replaces the state waiting to be pushed with a newer one """
+        with self._cond:
+            self._state = frame
+            self._cond.notify()
+
+    def reply(self, opcode, payload):
+        """ Queues a message, closing the session if the client is too slow to take it """
+        try:
+            self.replies.put_nowait(self.encode(opcode, payload))
+        except queue.Full:
+            LightManager.debugger("WebSocket client {} too slow, closing".format(self.address[0]), 1)
+            self.close()
+            return
+        with self._cond:
+            self._cond.notify()
+
+    def close(self, code=None):
+        """ Ends the session, with a close frame when a code is given """
+        if code is not None and not self.closed:
+            try:
+                self._send(self.encode(self.CLOSE, struct.pack('!H', code)))
+            except OSError:
+                pass
+        self.closed = True
+        self.sink.close()
+        with self._cond:
+            self._cond.notify()
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def run(self):
+        """ Reads the messages of the client, the writer thread sending the replies and pushes """
+        self.client.settimeout(None) #liveness is checked with pings
+        writer = threading.Thread(target=self._write, daemon=True)
+        writer.start()
+        try:
+            while not self.closed:
+                message = self._read_message()
+                if message is None:
+                    break
+                opcode, payload = message
+                if opcode == self.BINARY:
+                    colors = UdpIngest.parse_entries(self.hub.lm, payload)
+                    if colors is None:
+                        self.reply(self.TEXT, json.dumps({"type": "error",
+                                                          "message": "Malformed color frame"}).encode('utf-8'))
+                    else:
+                        self.sink.offer(colors)
+                else:
+                    self._command(payload)
+        except (OSError, ValueError) as ex:
+            LightManager.debugger("WebSocket session of {} failed: {}".format(self.address[0], ex), 1)
+        finally:
+            self.close()
+            writer.join(1)
+
+    def _command(self, payload):
+        try:
+            text = payload.decode('utf-8')
+        except UnicodeDecodeError:
+            self.close(1007)
+            return
+        server = self.hub.server
+        command = server.session_command(text)
+        if command is not None:
+            kind, key = self.ANSWERS.get(command[0], (command[0], "result"))
+            result = {"type": kind, key: command[1]}
+        else:
+            try:
+                args = json.loads(text)
+                if not isinstance(args, dict):
+                    raise ValueError("expected a JSON object")
+            except ValueError:
+                result = {"type": "error", "message": "Improperly formatted JSON"}
+            else:
+                server._cancel_disconnect()
+                LightManager.debugger('WebSocket request with args: ' + str(args), 0)
+                result = server.execute_request(server._sanitize(args), self.address[0])
+                result["type"] = "result"
+                if "id" in args:
+                    result["id"] = args["id"]
+        self.reply(self.TEXT, json.dumps(result).encode('utf-8'))
+
+    def _recv(self, size):
+        while len(self._pending) < size:
+            chunk = self.client.recv(65536)
+            if not chunk:
+                return None
+            self._pending += chunk
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def _read_frame(self):
+        header = self._recv(2)
+        if header is None:
+            return None
+        fin, opcode = header[0] & 0x80, header[0] & 0x0f
+        masked, length = header[1] & 0x80, header[1] & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self._recv(2) or b'\0\0')[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._recv(8) or b'\0' * 8)[0]
+        if not masked:
+            self.close(1002) #client frames must be masked
+            return None
+        if length > self.MAX_MESSAGE:
+            self.close(1009)
+            return None
+        key = self._recv(4)
+        data = self._recv(length)
+        if key is None or data is None:
+            return None
+        self.last_seen = time.monotonic()
+        if length:
+            mask = (key * (length // 4 + 1))[:length]
+            data = (int.from_bytes(data, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(length, 'big')
+        return bool(fin), opcode, data
+
+    def _read_message(self):
+        """ Reads the next data message, answering control frames on the way """
+        message = None
+        while True:
+            frame = self._read_frame()
+            if frame is None:
+                return None
+            fin, opcode, data = frame
+            if opcode == self.PING:
+                self.reply(self.PONG, data)
+                continue
+            if opcode == self.PONG:
+                continue
+            if opcode == self.CLOSE:
+                self.close(struct.unpack('!H', data[:2])[0] if len(data) >= 2 else 1000)
+                return None
+            if opcode == self.CONTINUATION:
+                if message is None:
+                    self.close(1002)
+                    return None
+                message[1] += data
+            elif opcode in (self.TEXT, self.BINARY) and message is None:
+                message = [opcode, data]
+            else:
+                self.close(1002)
+                return None
+            if len(message[1]) > self.MAX_MESSAGE:
+                self.close(1009)
+                return None
+            if fin:
+                return message[0], message[1]
+
+    def _write(self):
+        ping_sent = None
+        while True:
+            with self._cond:
+                if not self.closed and self.replies.empty() and self._state is None:
+                    self._cond.wait(self.hub.ping_interval / 2)
+                state, self._state = self._state, None
+            if self.closed:
+                return
+            try:
+                while not self.replies.empty():
+                    self._send(self.replies.get_nowait())
+                if state is not None:
+                    self._send(state)
+                idle = time.monotonic() - self.last_seen
+                if idle > self.hub.ping_interval * 2:
+                    LightManager.debugger("WebSocket client {} stopped answering pings" \
+                                          .format(self.address[0]), 1)
+                    self.close(1001)
+                    return
+                if idle > self.hub.ping_interval and (ping_sent is None or ping_sent < self.last_seen):
+                    ping_sent = time.monotonic()
+                    self._send(self.encode(self.PING, b''))
+            except OSError:
+                self.close()
+                return
+
+    def _send(self, frame):
+        with self._send_lock:
+            self.client.sendall(frame)
+
+
+class DaemonProfiler(object):
+    """
+    Looks inside a running server without restarting it. SIGUSR1 (or the 'profile stacks'
+    session command) dumps every thread stack with the runtime counters, SIGUSR2 ('profile
+    cpu N') samples all the threads for N seconds and 'profile memory N' traces what is
+    allocated meanwhile. Reports are written to JOURNAL_DIR; nothing runs in between.
+    """
+    def __init__(self, server, lm, directory, seconds=30.0, interval=0.005):
+        self.server = server
+        self.lm = lm
+        self.directory = directory
+        self.seconds = seconds
+        self.interval = interval
+        self._busy = threading.Lock() #one timed profile at a time
+
+    def install(self):
+        """ Installs the signal handlers, which only hand the work to a thread """
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self._background(self.report))
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self._timed("cpu", self.seconds))
+
+    def command(self, text):
+        """ Runs a 'profile [status|stacks|cpu N|memory N]' session command """
+        words = text.split()
+        action = words[1] if len(words) > 1 else "status"
+        try:
+            seconds = float(words[2]) if len(words) > 2 else self.seconds
+        except ValueError:
+            return {"status": "error", "message": "Invalid duration {}".format(words[2])}
+        if action == "status":
+            return {"status": "ok", "runtime": self.runtime()}
+        if action == "stacks":
+            return {"status": "ok", "file": self.report(), "threads": threading.active_count()}
+        if action in ("cpu", "memory"):
+            if not 0 < seconds <= 600:
+                return {"status": "error", "message": "Profiles last from 0 to 600 seconds"}
+            path = self._timed(action, seconds)
+            if path is None:
+                return {"status": "busy", "message": "A profile is already running", "retry_after": seconds}
+            return {"status": "ok", "message": "Profiling {} for {} seconds".format(action, seconds),
+                    "file": path}
+        return {"status": "error", "message": "Unknown profile action {}".format(action)}
+
+    def stacks(self):
+        """ Current stack of every thread """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        lines = []
+        for ident, frame in sys._current_frames().items():
+            lines.append("Thread {} ({}):".format(names.get(ident, "?"), ident))
+            lines.extend(line.rstrip("\n") for line in traceback.format_stack(frame))
+        return "\n".join(lines)
+
+    def runtime(self):
+        """ Live thread counts, queue sizes and process resources """
+        import gc
+        import re
+        threads = {}
+        for thread in threading.enumerate():
+            name = re.sub(r"-\d+", "", thread.name)
+            threads[name] = threads.get(name, 0) + 1
+        runtime = {"threads": threading.active_count(), "threads_by_name": threads,
+                   "scheduler_pending": self.lm.scheduler.pending(),
+                   "scheduler_running": self.lm.scheduler.running(),
+                   "effect_runners": self.lm.effect_runners(),
+                   "last_commit": self.lm.commit_stats["last"],
+                   "clients": self.server.admission.clients,
+                   "connected_devices": sum(1 for dev in self.lm.devices if dev._connection is not None),
+                   "breakers_open": sum(1 for dev in self.lm.devices if dev.breaker_open()),
+                   "drifted": len(self.lm.drifted()),
+                   "journal_pending": self.lm.journal.pending() if self.lm.journal is not None else 0,
+                   "udp_streams": len(self.server.udp.streams) if self.server.udp is not None else 0,
+                   "gc_counts": gc.get_count()}
+        if self.server.websockets is not None:
+            sessions = list(self.server.websockets.sessions)
+            runtime["websocket_sessions"] = len(sessions)
+            runtime["websocket_queued"] = sum(session.replies.qsize() for session in sessions)
+        if os.path.isdir("/proc/self/fd"):
+            runtime["open_fds"] = len(os.listdir("/proc/self/fd"))
+            with open("/proc/self/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        runtime["rss_kb"] = int(line.split()[1])
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            runtime["tracemalloc_top"] = [str(stat) for stat in
+                                          tracemalloc.take_snapshot().statistics('lineno')[:10]]
+        return runtime
+
+    def report(self):
+        """ Writes the thread stacks and runtime counters, returning the file path """
+        path = self._path("stacks")
+        with open(path, "w") as rfile:
+            rfile.write(json.dumps(self.runtime(), indent=1) + "\n\n" + self.stacks() + "\n")
+        LightManager.debugger("Wrote the thread stacks to {}".format(path), 0)
+        return path
+
+    def sample(self, seconds, path):
+        """
+        Samples the stacks of every thread each interval (wall-clock: waiting threads are
+        counted too) and writes the busiest functions and the collapsed stacks, which
+        flamegraph.pl reads as is
+        """
+        own = threading.get_ident()
+        stacks = {}
+        samples = 0
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append("{}:{}".format(os.path.basename(frame.f_code.co_filename),
+                                                frame.f_code.co_name))
+                    frame = frame.f_back
+                key = (names.get(ident, "?"),) + tuple(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+            samples += 1
+            time.sleep(self.interval)
+        own_counts = {}
+        total_counts = {}
+        for stack, count in stacks.items():
+            own_counts[stack[-1]] = own_counts.get(stack[-1], 0) + count
+            for function in set(stack[1:]):
+                total_counts[function] = total_counts.get(function, 0) + count
+        with open(path, "w") as rfile:
+            rfile.write("{} samples over {} seconds, in thread-seconds\n\nself:\n".format(samples, seconds))
+            for function, count in sorted(own_counts.items(), key=lambda item: -item[1])[:30]:
+                rfile.write("{:8d} {:8.2f}s {}\n".format(count, count * seconds / samples, function))
+            rfile.write("\ninclusive:\n")
+            for function, count in sorted(total_counts.items(), key=lambda item: -item[1])[:30]:
+                rfile.write("{:8d} {:8.2f}s {}\n".format(count, count * seconds / samples, function))
+            rfile.write("\ncollapsed stacks:\n")
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                rfile.write("{} {}\n".format(";".join(stack), count))
+        LightManager.debugger("Wrote the {} seconds profile to {}".format(seconds, path), 0)
+
+    def trace_memory(self, seconds, path):
+        """ Traces the allocations for some seconds, writing the growth and the largest live ones """
+        import tracemalloc
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(10)
+        ignored = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        before = tracemalloc.take_snapshot().filter_traces(ignored)
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot().filter_traces(ignored)
+        if started:
+            tracemalloc.stop()
+        with open(path, "w") as rfile:
+            rfile.write("Allocations grown over {} seconds:\n".format(seconds))
+            for stat in after.compare_to(before, 'lineno')[:25]:
+                rfile.write("{}\n".format(stat))
+            rfile.write("\nLargest live allocations (traced ones only):\n")
+            for stat in after.statistics('lineno')[:25]:
+                rfile.write("{}\n".format(stat))
+        LightManager.debugger("Wrote the {} seconds memory trace to {}".format(seconds, path), 0)
+
+    def _timed(self, kind, seconds):
+        if not self._busy.acquire(blocking=False):
+            return None
+        path = self._path(kind)
+        function = self.sample if kind == "cpu" else self.trace_memory
+        def run():
+            try:
+                function(seconds, path)
+            finally:
+                self._busy.release()
+        self._background(run)
+        return path
+
+    def _path(self, kind):
+        return os.path.join(self.directory, "profile-{}-{}.txt".format(time.strftime("%Y%m%d-%H%M%S"), kind))
+
+    @staticmethod
+    def _background(function):
+        threading.Thread(target=function, name="profiler", daemon=True).start()
+
+
+class Federation(object):
+    """ Coordinator-side routing of requests to the play servers owning the devices """
+    def __init__(self, config):
+        self.config = config
+        self.nodes = []
+        i = 0
+        while True:
+            try:
+                nodeconf = self.config["NODE"+str(i)]
+                self.nodes.append(FederationNode(nodeconf.get("NAME", "NODE"+str(i)),
+                                                 nodeconf["HOST"], int(nodeconf["PORT"]),
+                                                 nodeconf.get("GROUPS", None),
+                                                 float(self.config.get("FEDERATION", "TIMEOUT",
+                                                                       fallback="30"))))
+                LightManager.debugger("Added federation node {} ({}:{})" \
+                                      .format(self.nodes[-1].name, nodeconf["HOST"],
+                                              nodeconf["PORT"]), 0)
+            except KeyError:
+                break
+            i = i + 1
+        self.state_ttl = float(self.config.get("FEDERATION", "STATE_TTL", fallback="30"))
+        from multiprocessing.pool import ThreadPool
+        self.pool = ThreadPool(processes=max(1, len(self.nodes)))
+        self.pool.map(FederationNode.connect, self.nodes)
+
+    def owners(self, group):
+        """ Getter for the nodes owning a group, every node if no group is given """
+        if group is None:
+            return list(self.nodes)
+        return [node for node in self.nodes if group in node.groups]
+
+    def execute(self, args, local_execute, expand_scenes):
+        """ Fans a request out to the owning nodes in parallel and merges the results """
+        results = {}
+        forwarded = {}
+        local_args = args
+        if args["batch"] is not None:
+            try:
+                batches = self.split_batch(expand_scenes(args["batch"], 0))
+            except (ValueError, TypeError, KeyError) as ex:
+                LightManager.debugger("Invalid batch: {}".format(ex), 2)
+                return {"status": "error", "message": "Invalid batch: {}".format(ex), "nodes": {}}
+            for node in self.nodes:
+                if node.name in batches:
+                    payload = dict(args, batch=batches[node.name], scene=None, server=False)
+                    forwarded[node.name] = self.pool.apply_async(node.request, (payload, ))
+            local_args = dict(args, batch=batches["local"], scene=None) if "local" in batches else None
+        else:
+            lights = any([args["hexvalues"], args["playbulb"], args["milight"], args["on"],
+                          args["off"], args["toggle"], args["prepare"], args["effect"]])
+            if lights:
+                payload = dict(args, tvon=False, tvoff=False, tvrestart=False, server=False)
+                for node in self.owners(args["group"]):
+                    forwarded[node.name] = self.pool.apply_async(node.request, (payload, ))
+            local_groups = set(dev.group for dev in lm.devices)
+            if not (args["tvon"] or args["tvoff"] or args["tvrestart"]
+                    or (lm.devices and (args["group"] is None or args["group"] in local_groups))):
+                local_args = None
+        if local_args is not None:
+            results["local"] = local_execute(local_args)
+        for name, pending in forwarded.items():
+            try:
+                results[name] = pending.get()
+            except Exception as ex:
+                results[name] = {"status": "error", "message": str(ex), "state": None}
+        if not results:
+            LightManager.debugger("No node owns group '{}'".format(args["group"]), 1)
+            return {"status": "error", "message": "No node owns group '{}'".format(args["group"]),
+                    "nodes": {}}
+        status = "ok"
+        if any(r["status"] == "partial" for r in results.values()):
+            status = "partial"
+        if any(r["status"] not in ("ok", "partial") for r in results.values()):
+            status = "error"
+        return {"status": status, "nodes": results}
+
+    def split_batch(self, ops):
+        """
+        Splits expanded batch operations by owning node, {node name or "local": ops}: light
+        operations go to the nodes of their group, TV operations and device numbers (which
+        are per server) stay local, and delays go everywhere to keep the batch timing
+        """
+        local_groups = set(dev.group for dev in lm.devices)
+        batches = collections.OrderedDict([("local", [])] + [(node.name, []) for node in self.nodes])
+        for op in ops:
+            if op.get("op") == "delay":
+                owners = list(batches)
+            elif op.get("op") == "tv" or op.get("devices") is not None:
+                owners = ["local"]
+            else:
+                owners = [node.name for node in self.owners(op.get("group"))]
+                if lm.devices and (op.get("group") is None or op["group"] in local_groups):
+                    owners.append("local")
+                if not owners:
+                    raise ValueError("no node owns group {}".format(op.get("group")))
+            for name in owners:
+                batches[name].append(op)
+        return {name: batch for name, batch in batches.items()
+                if any(op.get("op") != "delay" for op in batch)}
+
+    def get_state(self):
+        """ Getter for the cluster-wide state, refreshing nodes whose cached view is stale """
+        stale = [node for node in self.nodes if time.time() - node.updated > self.state_ttl]
+        self.pool.map(FederationNode.refresh, stale)
+        states = {"local": lm.get_state()}
+        for node in self.nodes:
+            states[node.name] = node.state
+        return states
+
+
+class FederationNode(object):
+    """ Persistent session with a remote play server """
+    def __init__(self, name, host, port, groups, timeout):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.static_groups = groups is not None
+        self.groups = set(g.strip() for g in groups.split(',')) if groups else set()
+        self.state = None
+        self.updated = 0
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """ Opens the session and learns which groups the node owns """
+        with self._lock:
+            try:
+                self._connect()
+            except (OSError, ValueError) as ex:
+                LightManager.debugger("Federation node {} unreachable: {}".format(self.name, ex), 1)
+                self.close()
+
+    def request(self, payload):
+        """ Sends a request over the session, reconnecting once if it went stale """
+        error = None
+        with self._lock:
+            for _attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    result = self._call(json.dumps(payload))
+                    if result.get("state") is not None:
+                        self.state = result["state"]
+                        self.updated = time.time()
+                    return result
+                except (OSError, ValueError) as ex:
+                    error = ex
+                    self.close()
+        LightManager.debugger("Federation node {} request failed: {}".format(self.name, error), 1)
+        return {"status": "error", "message": "Node {} unreachable: {}".format(self.name, error),
+                "state": None}
+
+    def refresh(self):
+        """ Refreshes the cached state of the node """
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._connect()
+                self.state = [dev["state"] for dev in self._call("getstate")]
+                self.updated = time.time()
+            except (OSError, ValueError) as ex:
+                LightManager.debugger("Federation node {} state refresh failed: {}" \
+                                      .format(self.name, ex), 1)
+                self.close()
+
+    def close(self):
+        """ Closes the session """
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        send_frame(self._sock, "session")
+        devices = self._call("describe")
+        if not self.static_groups:
+            self.groups = set(dev["group"] for dev in devices)
+        LightManager.debugger("Federation node {} owns groups {}".format(self.name, sorted(self.groups)), 0)
+
+    def _call(self, payload):
+        send_frame(self._sock, payload)
+        reply = recv_frame(self._sock)
+        if reply is None:
+            raise ConnectionError("session closed by {}".format(self.name))
+        return json.loads(reply)
+
+
+class MediaCenter(object):
+    """
+    Control channel to the Kodi media center: JSON-RPC over one kept-alive HTTP connection,
+    reopened once when it went stale. Commands run one at a time in a worker thread, so
+    requests wait at most timeout seconds for their outcome instead of a full handshake.
+    """
+    def __init__(self, host, port=8080, user=None, password=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.auth = None
+        if user:
+            import base64
+            self.auth = "Basic " + base64.b64encode("{}:{}".format(user, password or "") \
+                                                    .encode('utf-8')).decode('ascii')
+        self.last = None
+        self._conn = None
+        self._ids = itertools.count(1)
+        self._pool = None
+
+    def submit(self, method, params=None):
+        """ Queues a JSON-RPC method, returning the pending outcome for wait() """
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(processes=1)
+        return self._pool.apply_async(self._call, (method, params))
+
+    def wait(self, pending, method):
+        """ Waits for the outcome of a submitted method, a timeout being an outcome too """
+        try:
+            outcome = pending.get(self.timeout)
+        except Exception:
+            outcome = {"status": "timeout", "method": method,
+                       "message": "No answer from Kodi within {} seconds".format(self.timeout)}
+        LightManager.debugger("Kodi {}: {}".format(method, outcome["status"]),
+                              0 if outcome["status"] == "ok" else 1)
+        self.last = outcome
+        return outcome
+
+    def command(self, method, params=None):
+        """ Runs a JSON-RPC method, returning its outcome """
+        return self.wait(self.submit(method, params), method)
+
+    def close(self):
+        """ Closes the connection, the next command opens a new one """
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = None
+
+    def _call(self, method, params):
+        import http.client
+        payload = json.dumps({"jsonrpc": "2.0", "id": next(self._ids), "method": method,
+                              "params": params or {}}).encode('utf-8') #bytes: sent with the headers
+        headers = {"Content-Type": "application/json"}
+        if self.auth is not None:
+            headers["Authorization"] = self.auth
+        error = None
+        for _attempt in range(2):
+            try:
+                if self._conn is None:
+                    self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                start = time.monotonic()
+                self._conn.request("POST", "/jsonrpc", payload, headers)
+                response = self._conn.getresponse()
+                body = response.read()
+                if response.status != 200:
+                    self.close()
+                    return {"status": "error", "method": method,
+                            "message": "HTTP {} {}".format(response.status, response.reason)}
+                reply = json.loads(body.decode('utf-8'))
+                if "error" in reply:
+                    return {"status": "error", "method": method, "message": reply["error"].get("message")}
+                return {"status": "ok", "method": method, "result": reply.get("result"),
+                        "ms": round((time.monotonic() - start) * 1000, 1)}
+            except (OSError, ValueError, http.client.HTTPException) as ex:
+                error = ex
+                self.close()
+        return {"status": "error", "method": method, "message": "Kodi unreachable: {}".format(error)}
+
+
+class Television(object):
+    """
+    TV power-on pipeline: the Wake-on-LAN magic packet and the HDMI-CEC power-on go out
+    together, light changes run alongside, then the TV (CEC power status) and the media
+    center (TCP probe) are polled until they are ready instead of waiting a fixed time.
+    """
+    def __init__(self, wol_mac=None, wol_address="255.255.255.255", cec_device="0", probe=None,
+                 poll_interval=0.5, ready_timeout=30.0):
+        self.wol_mac = wol_mac
+        self.wol_address = wol_address
+        self.cec_device = cec_device
+        self.probe = probe
+        self.poll_interval = poll_interval
+        self.ready_timeout = ready_timeout
+        self.last = None
+
+    def wake(self):
+        """ Broadcasts the Wake-on-LAN magic packet, False if no MAC address is configured """
+        if not self.wol_mac:
+            return False
+        packet = b'\xff' * 6 + bytes.fromhex(self.wol_mac.replace(':', '').replace('-', '')) * 16
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                sock.sendto(packet, (self.wol_address, 9))
+            return True
+        except OSError as ex:
+            LightManager.debugger("Wake-on-LAN packet to {} failed: {}".format(self.wol_mac, ex), 1)
+            return False
+
+    def cec(self, command):
+        """ Runs a cec-client command on the TV, returning its output or None if it could not run """
+        import subprocess
+        try:
+            return subprocess.run(["cec-client", "-s", "-d", "1"], input="{} {}\n".format(command, self.cec_device),
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=15,
+                                  universal_newlines=True).stdout
+        except (OSError, subprocess.SubprocessError) as ex:
+            LightManager.debugger("cec-client {} failed: {}".format(command, ex), 1)
+            return None
+
+    def tv_on(self):
+        """ CEC power status of the TV, None if it cannot be told """
+        output = self.cec("pow")
+        if output is None or "power status:" not in output:
+            return None
+        return "power status: on" in output
+
+    def media_center_up(self):
+        """ TCP probe of the media center """
+        try:
+            socket.create_connection(self.probe, timeout=self.poll_interval).close()
+            return True
+        except OSError:
+            return False
+
+    def power_on(self, lights=None):
+        """
+        Powers the TV on while running lights (a callable) in parallel, returning the readiness
+        report (milliseconds from the start, None for what could not be checked) and the lights result
+        """
+        start = time.monotonic()
+        def elapsed():
+            return round((time.monotonic() - start) * 1000, 1)
+        report = {"status": "ok", "wol": self.wake(), "cec_on": None, "cec_on_ms": None, "tv_ready_ms": None,
+                  "media_center_ready_ms": None, "lights_ms": None}
+        outcome = {}
+        def cec_on():
+            report["cec_on"] = self.cec("on") is not None
+            report["cec_on_ms"] = elapsed()
+        def run_lights():
+            outcome["lights"] = lights()
+            report["lights_ms"] = elapsed()
+        workers = [threading.Thread(target=cec_on, name="tv", daemon=True)]
+        if lights is not None:
+            workers.append(threading.Thread(target=run_lights, name="tv", daemon=True))
+        for worker in workers:
+            worker.start()
+        check_tv = True
+        check_media_center = self.probe is not None
+        deadline = start + self.ready_timeout
+        while (check_tv or check_media_center) and time.monotonic() < deadline:
+            if check_media_center and self.media_center_up():
+                report["media_center_ready_ms"] = elapsed()
+                check_media_center = False
+            if check_tv and not workers[0].is_alive(): #cec-client serves one command at a time
+                status = self.tv_on() if report["cec_on"] else None
+                if status is not False:
+                    report["tv_ready_ms"] = elapsed() if status else None
+                    check_tv = False
+            if check_tv or check_media_center:
+                time.sleep(self.poll_interval)
+        if check_tv or check_media_center:
+            report["status"] = "timeout"
+        for worker in workers:
+            worker.join()
+        report["ready_ms"] = elapsed()
+        LightManager.debugger("TV power-on {}: TV ready at {} ms, media center at {} ms, lights at {} ms, "
+                              "all in {} ms".format(report["status"], report["tv_ready_ms"],
+                                                    report["media_center_ready_ms"], report["lights_ms"],
+                                                    report["ready_ms"]), 0 if report["status"] == "ok" else 1)
+        self.last = report
+        return report, outcome.get("lights")
+
 
 class LightManager(object):
     """ Methods for instanciating and managing BLE lightbulbs """
     def __init__(self, config=None):
         self.config = config
+        self.colorengine = ColorEngine()
         ## TWEAKABLES ##
         self.devices = []
         i = 0
@@ -333,77 +1817,219 @@ class LightManager(object):
 
         #TODO allow reporting of device state to the lightserver
         self.starttime = datetime.time(18, 00) #Light change minimal time
-        self.skiptime = 0
-        self.queue = queue.Queue()
-        self.colors = [LIGHT_OFF] * len(self.devices)
-        self.set_lock(0)
-        self.lockcount = 0
+        self.scheduler = RequestScheduler(self)
+        self.priority_ttl = float(self.config.get('SERVER', 'PRIORITY_TTL', fallback='3600')) \
+                            if self.config is not None else 3600
+        self.breaker_threshold = int(self.config.get('SERVER', 'BREAKER_THRESHOLD', fallback='3')) \
+                                 if self.config is not None else 3
+        self.probe_interval = float(self.config.get('SERVER', 'BREAKER_PROBE_INTERVAL', fallback='30')) \
+                              if self.config is not None else 30
+        self._probe_thread = None
+        self.journal = None
+        self.scenes = {}
+        i = 0
+        while self.config is not None and self.config.has_section("SCENE"+str(i)):
+            self.scenes[self.config["SCENE"+str(i)]["NAME"]] = json.loads(self.config["SCENE"+str(i)]["BATCH"])
+            i = i + 1
+        self.prepare_ttl = float(self.config.get('SERVER', 'PREPARE_TTL', fallback='120')) \
+                           if self.config is not None else 120
+        self.connect_pool = None
+        self.group_commit = self.config.getboolean('SERVER', 'GROUP_COMMIT', fallback=True) \
+                            if self.config is not None else True
+        self.commit_deadline = float(self.config.get('SERVER', 'COMMIT_DEADLINE', fallback='2')) \
+                               if self.config is not None else 2
+        self.commit_pool = None
+        self.commit_stats = {"commits": 0, "stragglers": 0, "last": None}
+        self._commit_lock = threading.Lock() #requests on disjoint devices commit concurrently
+        self.effect_step = float(self.config.get('SERVER', 'EFFECT_STEP_MS', fallback='50')) / 1000 \
+                           if self.config is not None else 0.05
+        self._effects = []
+        self._effect_lock = threading.Lock()
         self.journaling = False
-        self.priority = 0
         self.threaded = False
-        self.light_threads = [None] * len(self.devices)
         self.light_pool = None
+        self.reconciler = None
+        if self.config is not None and self.config.getboolean('SERVER', 'RECONCILE', fallback=False):
+            self.reconciler = Reconciler(self,
+                                         float(self.config.get('SERVER', 'RECONCILE_INTERVAL', fallback='5')),
+                                         float(self.config.get('SERVER', 'RECONCILE_BACKOFF', fallback='1')),
+                                         float(self.config.get('SERVER', 'RECONCILE_MAX_BACKOFF', fallback='60')),
+                                         float(self.config.get('SERVER', 'READBACK_INTERVAL', fallback='300')))
 
     def start_threaded(self):
         """ Enables multithreaded light change requests """
+        from multiprocessing.pool import ThreadPool
         self.threaded = True
         self.light_pool = ThreadPool(processes=4)
 
-    def skip_time(self, serverwide=0):
-        """ Enables skipping time check """
-        if serverwide:
-            LightManager.debugger("Skipping time check for all requests", 0)
-            self.starttime = None
-        else:
-            LightManager.debugger("Skipping time check", 0)
-            self.skiptime = 1
+    def prepare(self, group=None, subgroup=None, ttl=None):
+        """ Connects in parallel to the devices of a group and holds the connections for ttl seconds """
+        ttl = self.prepare_ttl if ttl is None else float(ttl)
+        devices = [dev for dev in self.devices if (group is None or dev.group == group)
+                   and (subgroup is None or dev.subgroup == subgroup) and not dev.breaker_open()]
+        if not devices:
+            return 0
+        if self.connect_pool is None:
+            from multiprocessing.pool import ThreadPool
+            self.connect_pool = ThreadPool(processes=8)
+        until = time.time() + ttl
+        for dev in devices:
+            dev.prepared_until = max(dev.prepared_until, until)
+        connected = sum(self.connect_pool.map(Bulb.connect, devices))
+        LightManager.debugger("Prepared {} of {} devices for {} seconds" \
+                              .format(connected, len(devices), ttl), 0)
+        release = threading.Timer(ttl, self._release_prepared)
+        release.daemon = True
+        release.start()
+        return connected
+
+    def start_prepare_schedule(self, group, lead):
+        """ Prepares a group every day, lead seconds before the light change minimal time """
+        threading.Thread(target=self._prepare_schedule, args=(group, lead), name="prepare",
+                         daemon=True).start()
+
+    def start_probe(self):
+        """ Starts the background probing of the devices with an open circuit breaker """
+        if self._probe_thread is None:
+            self._probe_thread = threading.Thread(target=self._probe, name="probe", daemon=True)
+            self._probe_thread.start()
 
-    def set_colors(self, color):
-        """ Setter function for color request. Required. """
-        self.colors = color
+    def skip_time(self):
+        """ Disables the time check for all requests """
+        LightManager.debugger("Skipping time check for all requests", 0)
+        self.starttime = None
 
-    def get_group(self, group, subgroup):
-        """ Gets devices from a specific group/subgroup for the light change """
+    def select_group(self, colors, group, subgroup):
+        """ Returns the colors with the devices out of a group/subgroup skipped """
+        colors = list(colors)
         for _cnt, device in enumerate(self.devices):
             if device.group != group:
                 LightManager.debugger("Skipping device {} as it does not belong in the '{}' group" \
                                       .format(device.device, group), 0)
-                self.colors[_cnt] = LIGHT_SKIP
+                colors[_cnt] = LIGHT_SKIP
             else:
                 if subgroup is not None and device.subgroup != subgroup:
                     LightManager.debugger("Skipping device {} as it does not belong in the '{}' subgroup" \
                                           .format(device.device, subgroup), 0)
-                    self.colors[_cnt] = LIGHT_SKIP
+                    colors[_cnt] = LIGHT_SKIP
+        return colors
 
     def get_toggle(self):
         """ Toggles the devices on/off """
-        colors = [LIGHT_ON] * len(lm.devices)
-        i = 0
+        colors = [LIGHT_ON] * len(self.devices)
         for color in self.get_state():
             if color != LIGHT_OFF:
-                colors = [LIGHT_OFF] * len(lm.devices)
-            i = i+1
+                colors = [LIGHT_OFF] * len(self.devices)
         return colors
 
-    def set_typed_colors(self, colorargs, atype):
-        """ Gets devices of a specific  type for the light change """
+    def typed_colors(self, colors, colorargs, atype):
+        """ Returns the colors with the devices of a specific type set to colorargs """
         cvals = self._get_type_index(atype)
         if cvals[0] != len(colorargs):
             LightManager.debugger("Received color hexvalues length {} for {} devices. Quitting" \
                                   .format(len(colorargs), cvals[0]), 2)
+            return colors
+        colors = list(colors)
+        colors[cvals[1]:cvals[1]+cvals[0]] = colorargs
+        return colors
+
+    def run(self, context):
+        """ Schedules the light change of a request context and waits for its outcome """
+        if context.check_time and not self._check_time():
+            return "too soon"
+        self.stop_effects(context.targets, context.priority)
+        if self.reconciler is not None:
+            return self.reconciler.submit(list(context.colors), context.priority)
+        request = self.scheduler.submit(list(context.colors), context.priority)
+        request.done.wait()
+        return request.outcome
+
+    def run_frame(self, colors, priority=1, check_time=True):
+        """ Schedules a light change of one color per device and waits for its outcome """
+        return self.run(RequestContext.build(colors, priority, check_time))
+
+    def start_effect(self, context, effect, speed):
+        """
+        Schedules an effect on the devices of a request context, colored by its colors, and
+        waits for its start: one write per device running it in firmware, server-side frames
+        for the others
+        """
+        if context.check_time and not self._check_time():
+            return "too soon"
+        self.stop_effects(context.targets, context.priority)
+        request = self.scheduler.submit(list(context.colors), context.priority,
+                                        effect=(EFFECTS.index(effect), speed))
+        request.done.wait()
+        return "started" if request.outcome == "completed" else request.outcome
+
+    def _start_effect(self, request):
+        # runs on the scheduler like a change of lights, so no other request drives the devices meanwhile
+        mode, speed = request.effect
+        self.stop_effects(request.targets, request.priority)
+        converted = self.colorengine.convert_frame(request.colors, self.devices)
+        snapshot = self.snapshot()
+        for i in request.targets:
+            if self.devices[i].breaker_open():
+                LightManager.debugger("Device {} is unreachable, skipping it".format(self.devices[i].device), 0)
+                request.skipped.add(i)
+        targets = sorted(request.targets - request.skipped)
+        results = self._pool().starmap(self._start_device_effect,
+                                       [(self.devices[i], mode, converted[i], speed, request.priority)
+                                        for i in targets])
+        frames = {}
+        for i, started in zip(targets, results):
+            device = self.devices[i]
+            if started is None:
+                frames[i] = request.colors[i]
+            elif not started:
+                LightManager.debugger("Device {} did not start the {} effect".format(device.device,
+                                                                                    EFFECTS[mode]), 1)
+                continue
+            request.completed.add(i)
+            device.effect = mode + 1
+            device.effect_speed = speed
+            device.desired = None #the color changes on its own, nothing to reconcile
+        if frames:
+            runner = EffectRunner(self, mode, frames, max(speed * self.effect_step, 0.2), request.priority)
+            with self._effect_lock:
+                self._effects.append(runner)
+            runner.start()
+        self._journal_changes(request.seq, snapshot, request.targets)
+        LightManager.debugger("Effect {} started: {} devices in firmware, {} with server frames" \
+                              .format(EFFECTS[mode], len(request.completed) - len(frames), len(frames)), 0)
+        return True
+
+    @staticmethod
+    def _start_device_effect(device, mode, color, speed, priority):
+        started = False
+        for _try in range(3):
+            if device.breaker_open():
+                break
+            started = device.start_effect(mode, color, speed, priority)
+            if started is not False:
+                break
+        return started
+
+    def stop_effects(self, targets, priority=3):
+        """ Ends the effects of the devices a new request changes, unless they hold a higher priority """
+        if not any(dev.effect for dev in self.devices):
             return
-        self.colors[cvals[1]:cvals[1]+cvals[0]] = colorargs
+        now = time.time()
+        stopped = set()
+        for i in targets:
+            device = self.devices[i]
+            if device.effect and not (device.priority > priority and now < device.priority_expiry):
+                device.effect = 0
+                stopped.add(i)
+        if stopped:
+            LightManager.debugger("Stopping the effects of devices {}".format(sorted(stopped)), 0)
+            with self._effect_lock:
+                self._effects = [runner for runner in self._effects if runner.stop(stopped)]
 
-    def run(self):
-        """ Validates the request and runs the light change """
-        if self._check_time():
-            self.queue.put(self.colors)
-            #TODO Manage locking out when the run thread hangs
-            LightManager.debugger("Locked status: {}".format(self.locked), 0)
-            if not self.locked or self.lockcount == 2:
-                self._set_lights()
-            else:
-                self.lockcount = self.lockcount + 1
+    def effect_runners(self):
+        """ Getter for the number of effects running on server-side frames """
+        with self._effect_lock:
+            return len(self._effects)
 
     def descriptions(self):
         """ Getter for configured devices descriptions """
@@ -421,38 +2047,75 @@ class LightManager(object):
         """ Enables journaling to file """
         global JOURNALING
         JOURNALING = True
-        #TODO Dynamic history limits
-        if os.path.isfile(self.config['SERVER']['JOURNAL_DIR'] + "/play.0.log"):
-            if os.path.isfile(self.config['SERVER']['JOURNAL_DIR'] + "/play.1.log"):
-                if os.path.isfile(self.config['SERVER']['JOURNAL_DIR'] + "/play.2.log"):
-                    os.remove(self.config['SERVER']['JOURNAL_DIR'] + "/play.2.log")
-                os.rename(self.config['SERVER']['JOURNAL_DIR'] + "/play.1.log",
-                          self.config['SERVER']['JOURNAL_DIR'] + "/play.2.log")
-            os.rename(self.config['SERVER']['JOURNAL_DIR'] + "/play.0.log",
-                      self.config['SERVER']['JOURNAL_DIR'] + "/play.1.log")
-
-    def set_lock(self, is_locked):
-        """ Locks the light change request """
-        self.locked = is_locked
+        # the debug logs rotate at start-up and keep as many files as the state journal keeps segments
+        keep = max(int(self.config.get('SERVER', 'JOURNAL_SEGMENTS', fallback='3')), 1)
+        logs = [self.config['SERVER']['JOURNAL_DIR'] + "/play.{}.log".format(i) for i in range(keep)]
+        oldest = keep - 1
+        while os.path.isfile(self.config['SERVER']['JOURNAL_DIR'] + "/play.{}.log".format(oldest)):
+            os.remove(self.config['SERVER']['JOURNAL_DIR'] + "/play.{}.log".format(oldest)) #also a lower limit
+            oldest += 1
+        for i in range(keep - 2, -1, -1):
+            if os.path.isfile(logs[i]):
+                os.rename(logs[i], logs[i + 1])
+
+    def start_state_journal(self):
+        """ Starts journaling requests and state transitions to JOURNAL_DIR """
+        self.journal = StateJournal(self.config['SERVER']['JOURNAL_DIR'], self.get_state,
+                                    float(self.config.get('SERVER', 'JOURNAL_FLUSH', fallback='1')),
+                                    int(self.config.get('SERVER', 'JOURNAL_MAX_RECORDS', fallback='10000')),
+                                    int(self.config.get('SERVER', 'JOURNAL_SEGMENTS', fallback='3')))
+
+    def restore(self):
+        """ Restores the last journaled device states, returning them as the colors to apply """
+        states = StateJournal.replay(self.config['SERVER']['JOURNAL_DIR'])
+        if states is None or len(states) != len(self.devices):
+            LightManager.debugger("No usable state journal to restore from", 1)
+            return None
+        LightManager.debugger("Restored device states {} from the journal".format(states), 0)
+        return states
+
+    def describe(self):
+        """ Getter for the configured devices, as reported to federation coordinators """
+        return [{"devid": dev.devid, "type": dev.device_type, "address": dev.device,
+                 "group": dev.group, "subgroup": dev.subgroup} for dev in self.devices]
+
+    def get_status(self):
+        """ Getter for the state, desired state and circuit breaker of every device """
+        return [dev.get_status() for dev in self.devices]
+
+    def snapshot(self):
+        """ Copy of the device states, to diff against later """
+        return [dev.state for dev in self.devices]
+
+    def drifted(self):
+        """ Indexes of the devices with a desired color they do not show """
+        return [i for i, dev in enumerate(self.devices) if dev.drifted()]
+
+    def fingerprint(self):
+        """ Digest of the device fields reported by getstate, changing whenever one of them does """
+        import hashlib
+        return hashlib.md5(repr([(dev.state, dev.desired, dev.breaker, dev.failures, dev.effect)
+                                 for dev in self.devices]).encode('utf-8')).hexdigest()
 
     def get_state(self, devid=None):
         """ Getter for configured devices actual colors """
-        states = [None] * len(self.devices)
-        for _cnt, dev in enumerate(self.devices):
-            states[_cnt] = dev.get_state()
         if devid is not None:
-            return states[devid]
-        return states
+            return self.devices[devid].get_state()
+        return [dev.get_state() for dev in self.devices]
 
     def set_light_stream(self, devid, color, is_group):
         """ Simplified function for quick, streamed light change requests """
+        snapshot = self.snapshot()
+        self.stop_effects([i for i, dev in enumerate(self.devices) if dev.group == devid]
+                          if is_group else [devid])
         if is_group:
             for device in self.devices:
                 if device.group == devid:
                     cnt = 0
                     _color = device.convert(color)
+                    device.desired = _color
                     while True:
-                        if cnt == 4:
+                        if cnt == 4 or device.breaker_open():
                             break
                         if device.color(_color, 3):
                             break
@@ -460,111 +2123,192 @@ class LightManager(object):
                         cnt = cnt + 1
         else:
             cnt = 0
-            _color = device.convert(color)
+            _color = self.devices[devid].convert(color)
+            self.devices[devid].desired = _color
             while True:
-                if cnt == 4:
+                if cnt == 4 or self.devices[devid].breaker_open():
                     break
                 if self.devices[devid].color(_color, 3):
                     break
                 time.sleep(0.3)
                 cnt = cnt + 1
-        self.reinit()
+        self._journal_changes("stream", snapshot)
 
-    def reinit(self):
-        """ Resets the Success bool to False """
-        i = 0
-        while i < len(self.devices):
-            self.devices[i].reinit()
-            i += 1
+    def set_stream_frame(self, colors):
+        """ Applies a frame of {devid: color} once: a missed frame is superseded, not retried """
+        snapshot = self.snapshot()
+        self.stop_effects(colors)
+        for devid, color in colors.items():
+            device = self.devices[devid]
+            _color = device.convert(color)
+            device.desired = _color
+            if not device.breaker_open():
+                device.color(_color, 3)
+        self._journal_changes("stream", snapshot)
 
-    def _set_lights(self):
+    def _set_lights(self, request):
         LightManager.debugger("Running a change of lights (priority level: {})..." \
-                              .format(self.priority), 0)
+                              .format(request.priority), 0)
         try:
-            self.lockcount = 0
-            firstran = False
-            try:
-                while not self.queue.empty():
-                    colors = None
-                    if firstran:
-                        LightManager.debugger("Getting remainder of queue", 0)
-                        self.reinit()
-                    colors = self.queue.get() #TODO Check performance
-                    LightManager.debugger("Changing colors to {} from state {}" \
-                                          .format(colors, self.get_state()), 0)
-                    self.set_lock(1)
-                    i = 0
-                    tries = 0
-                    firstran = True
-
-                    while i < len(self.devices):
-                        _state = self.get_state(i)
-                        _color = self.devices[i].convert(colors[i])
-
-                        if not self.devices[i].success:
-                            LightManager.debugger("DEVICE: {}, REQUESTED COLOR: {}, \
-                                                  FROM STATE: {}, PRIORITY: {}"
-                                                  .format(self.devices[i].device,
-                                                          _color, _state,
-                                                          self.devices[i].priority),
-                                                  0)
-                            if self.threaded:
-                                if not self.queue.empty():
-                                    break
-                                self.light_threads[i] = self.light_pool.apply_async(self.devices[i].color, 
-                                                                                    args=(_color, self.priority, ))
-                            else:
-                                self.devices[i].color(_color, self.priority)
-                        i += 1
-
-                        if i == len(self.devices):
-                            if self.threaded:
-                                LightManager.debugger("Awaiting results", 0)
-                                for _cnt, _thread in enumerate(self.light_threads):
-                                    if _thread is not None:
-                                        try:
-                                            if not _thread.get(5):
-                                                i = 0
-                                        except:
-                                            i = 0
-                                tries = tries + 1
-                                if tries == 5:
-                                    break
-                            else:
-                                for _cnt, _dev in enumerate(self.devices):
-                                    _state = self.get_state(_cnt)
-                                    if colors[_cnt] != _state \
-                                       or (colors[_cnt] == self.devices[_cnt].convert(LIGHT_OFF) \
-                                       and _state == self.devices[_cnt].convert(LIGHT_OFF)):
-                                        i = 0
-                                tries = tries + 1
-                                if tries == 5:
-                                    break
-
-            except queue.Empty:
-                LightManager.debugger("Nothing in queue", 0)
-                pass
-
-            finally:
-                LightManager.debugger("Clearing up light change queues.", 0)
-                if colors:
-                    self.queue.task_done()
+            colors = request.colors
+            converted = self.colorengine.convert_frame(colors, self.devices)
+            snapshot = self.snapshot()
+            LightManager.debugger("Changing colors to {} from state {}" \
+                                  .format(colors, self.get_state()), 0)
+            request.skipped.clear() #a request run again after a preemption checks the breakers again
+            if request.runner is None:
+                self.stop_effects(request.targets, request.priority)
+            if self.group_commit and len(request.targets - request.completed) > 1 \
+               and not self.scheduler.preempts(request):
+                self._group_commit(request, converted)
+            for _try in range(5):
+                writes = []
+                for i, device in enumerate(self.devices):
+                    if i not in request.targets or i in request.completed or i in request.skipped:
+                        continue
+                    if self.scheduler.preempts(request):
+                        LightManager.debugger("Change of lights preempted by a higher priority request", 0)
+                        self._await_writes(writes, request)
+                        self._journal_changes(request.seq, snapshot, request.targets)
+                        return False
+                    if self._left_effect(request, i):
+                        continue
+                    device.desired = converted[i]
+                    device.desired_priority = request.priority
+                    if device.breaker_open():
+                        LightManager.debugger("Device {} is unreachable, skipping it".format(device.device), 0)
+                        request.skipped.add(i)
+                        continue
+                    LightManager.debugger("DEVICE: {}, REQUESTED COLOR: {}, \
+                                          FROM STATE: {}, PRIORITY: {}"
+                                          .format(device.device, converted[i], device.get_state(),
+                                                  device.priority),
+                                          0)
+                    if self.threaded:
+                        writes.append((i, self.light_pool.apply_async(device.color,
+                                                                      args=(converted[i], request.priority, ))))
+                    elif device.color(converted[i], request.priority):
+                        request.completed.add(i)
+                self._await_writes(writes, request)
+                if request.completed | request.skipped >= request.targets:
+                    break
+            self._journal_changes(request.seq, snapshot, request.targets)
+            if self.journal is not None:
+                for i in request.targets - request.completed:
+                    self.journal.transition(request.seq, i, self.devices[i].state, converted[i],
+                                            "skipped" if i in request.skipped else "failed")
+            LightManager.debugger("Change of lights completed.", 0)
+            return True
 
         except Exception as ex:
             LightManager.debugger('Unhandled exception of type {}: {}, {}'
                                   .format(type(ex), ex, 
                                           ''.join(traceback.format_tb(ex.__traceback__))), 2)
+            request.failed = True
+            if self.journal is not None:
+                for i in request.targets - request.completed:
+                    self.journal.transition(request.seq, i, self.devices[i].state, request.colors[i], "failed")
+            return False
 
-        finally:
-            self.reinit()
-            self.set_lock(0)
+    def _group_commit(self, request, converted):
+        # devices left out (failed or straggling) are retried one by one by _set_lights
+        plans = []
+        for i in sorted(request.targets - request.completed):
+            device = self.devices[i]
+            if self._left_effect(request, i):
+                continue
+            device.desired = converted[i]
+            device.desired_priority = request.priority
+            if device.breaker_open():
+                LightManager.debugger("Device {} is unreachable, skipping it".format(device.device), 0)
+                request.skipped.add(i)
+                continue
+            writes = device.encode(converted[i], request.priority)
+            if writes is None:
+                request.completed.add(i)
+            else:
+                plans.append((i, device, writes))
+        if not plans:
+            return
+        written, stats = GroupCommit(self._pool(), self.commit_deadline,
+                                     request.runner.holds if request.runner is not None else None).run(plans)
+        request.completed.update(written)
+        with self._commit_lock:
+            self.commit_stats["commits"] += 1
+            self.commit_stats["stragglers"] += stats["stragglers"]
+            self.commit_stats["last"] = stats
+        LightManager.debugger("Group commit of {devices} devices: prepared in {prepare_ms} ms, written in "
+                              "{commit_ms} ms with a skew of {skew_ms} ms, {written} written, {stragglers} "
+                              "stragglers".format(**stats), 0)
+
+    @staticmethod
+    def _left_effect(request, i):
+        # an effect frame is dropped, right before its write, for a device taken out of the effect
+        if request.runner is None or request.runner.holds(i):
+            return False
+        request.targets = request.targets - {i}
+        return True
+
+    def _pool(self):
+        # one thread per device: every device of a group commit waits for the commit
+        with self._commit_lock:
+            if self.commit_pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.commit_pool = ThreadPool(processes=len(self.devices))
+            return self.commit_pool
+
+    def _await_writes(self, writes, request):
+        # results of the threaded writes belong to this request only, nothing outlives it
+        if writes:
+            LightManager.debugger("Awaiting results", 0)
+        for i, result in writes:
+            try:
+                if result.get(5):
+                    request.completed.add(i)
+            except Exception:
+                pass
 
-        LightManager.debugger("Change of lights completed.", 0)
+    def _journal_changes(self, seq, snapshot, targets=None):
+        if self.journal is None:
+            return
+        for i, old in enumerate(snapshot):
+            if self.devices[i].state != old and (targets is None or i in targets):
+                self.journal.transition(seq, i, old, self.devices[i].state, "ok")
+
+    def _release_prepared(self):
+        for dev in self.devices:
+            if dev.prepared_until and not dev.prepared():
+                dev.prepared_until = 0
+                dev.disconnect()
+
+    def _prepare_schedule(self, group, lead):
+        while self.starttime is not None:
+            now = datetime.datetime.now()
+            start = datetime.datetime.combine(now.date(), self.starttime) - datetime.timedelta(seconds=lead)
+            if start <= now:
+                start = start + datetime.timedelta(days=1)
+            time.sleep((start - now).total_seconds())
+            LightManager.debugger("Preparing group '{}' ahead of {}".format(group, self.starttime), 0)
+            self.prepare(group, None, lead + self.prepare_ttl)
+
+    def _probe(self):
+        while True:
+            time.sleep(self.probe_interval)
+            for _cnt, device in enumerate(self.devices):
+                if not device.breaker_open() or not device.probe():
+                    continue
+                if device.drifted() and self.reconciler is not None:
+                    self.reconciler.wake()
+                elif device.drifted():
+                    LightManager.debugger("Applying latest desired state {} to device {}" \
+                                          .format(device.desired, device.device), 0)
+                    colors = [LIGHT_SKIP] * len(self.devices)
+                    colors[_cnt] = device.desired
+                    self.scheduler.submit(colors, device.desired_priority)
 
     def _check_time(self):
         #TODO Check if we keep this...
-        if self.skiptime or self.starttime is None:
-            self.skiptime = 0
+        if self.starttime is None:
             return 1
         if datetime.time(6, 00) < datetime.datetime.now().time() < self.starttime:
             LightManager.debugger("Too soon, no change of light required", 0)
@@ -589,45 +2333,1317 @@ class LightManager(object):
     @staticmethod
     def debugger(msg, level):
         """ Handles debug logging """
-        playconfig = configparser.ConfigParser()
-        playconfig.read('play.ini')
         levels = {0: "DEBUG", 1: "ERROR", 2: "FATAL"}
         debugtext = "({}) - [{}] {}".format(datetime.datetime.now().time(), levels[level], msg)
         print(debugtext)
         if JOURNALING:
+            import configparser
+            playconfig = configparser.ConfigParser()
+            playconfig.read(PLAYCONFIG_FILE)
             with open(playconfig['SERVER']['JOURNAL_DIR'] + "/play.0.log", "a") as jfile:
                 jfile.write(debugtext + "\n")
 
 
+class RequestContext(collections.namedtuple('RequestContext', 'colors priority check_time targets')):
+    """
+    Everything a light change request needs, built once from its arguments and never
+    modified: concurrent requests share no per-request state on the light manager
+    """
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, colors, priority=1, check_time=True):
+        colors = tuple(colors)
+        return cls(colors, priority, check_time,
+                   frozenset(i for i, color in enumerate(colors) if color != LIGHT_SKIP))
+
+
+class LightRequest(object):
+    """ A light change waiting for, or running on, the request scheduler """
+    def __init__(self, colors, priority, seq, effect=None, runner=None):
+        self.colors = colors
+        self.priority = priority
+        self.seq = seq
+        self.effect = effect #(mode, speed) of a request starting an effect
+        self.runner = runner #EffectRunner of a request sending an effect frame
+        self.targets = frozenset(i for i, color in enumerate(colors) if color != LIGHT_SKIP)
+        self.completed = set()
+        self.skipped = set() #devices left alone as their circuit breaker is open
+        self.cancelled = False
+        self.preempted = False
+        self.failed = False #stopped by an unexpected error, not to be run again
+        self.outcome = None
+        self.done = threading.Event()
+
+    def finish(self, outcome):
+        """ Records the outcome and wakes up the submitter """
+        self.outcome = outcome
+        self.done.set()
+
+    def __lt__(self, other):
+        return (-self.priority, self.seq) < (-other.priority, other.seq)
+
+
+class GroupCommit(object):
+    """
+    Changes several devices at the same instant, in two phases. Prepare: every device
+    connects and resolves its characteristics in parallel, its writes already encoded.
+    Commit: the writes are released together once all devices are ready or the deadline
+    passed. Devices ready later are stragglers, written as soon as they are ready (and
+    left out of the skew) unless the commit gave up on them.
+    """
+    def __init__(self, pool, deadline, keep=None):
+        self.pool = pool
+        self.deadline = deadline
+        self.keep = keep #checked for each device right before its write, if given
+        self.go = threading.Event()
+        self.go_at = None
+        self.abandoned = False
+        self._arrived = 0
+        self._cond = threading.Condition()
+
+    def run(self, plans):
+        """ Commits (devid, device, writes) plans, returning the devids written and the phase timings """
+        start = time.monotonic()
+        results = [(devid, self.pool.apply_async(self._device, (devid, device, writes)))
+                   for devid, device, writes in plans]
+        with self._cond:
+            self._cond.wait_for(lambda: self._arrived == len(plans), self.deadline)
+            self.go_at = time.monotonic()
+            self.go.set()
+        written = set()
+        on_time = []
+        stragglers = 0
+        for devid, result in results:
+            try:
+                done, written_at, straggler = result.get(max(self.go_at + self.deadline - time.monotonic(), 0))
+            except Exception:
+                done, written_at, straggler = False, None, True
+            stragglers += straggler
+            if done:
+                written.add(devid)
+                if not straggler:
+                    on_time.append(written_at)
+        with self._cond:
+            self.abandoned = True
+        return written, {"devices": len(plans), "written": len(written), "stragglers": stragglers,
+                         "prepare_ms": round((self.go_at - start) * 1000, 1),
+                         "commit_ms": round((max(on_time) - self.go_at) * 1000, 1) if on_time else None,
+                         "skew_ms": round((max(on_time) - min(on_time)) * 1000, 1) if on_time else None}
+
+    def _device(self, devid, device, writes):
+        ready = device.ready(set(uuid for uuid, _payload, _state in writes))
+        with self._cond:
+            straggler = self.go.is_set()
+            self._arrived += 1
+            self._cond.notify()
+        if not ready:
+            return False, None, straggler
+        self.go.wait()
+        with self._cond:
+            if self.abandoned:
+                return False, None, True
+        if self.keep is not None and not self.keep(devid):
+            return False, None, straggler
+        return device.commit(writes), time.monotonic(), straggler
+
+
+class RequestScheduler(object):
+    """
+    Runs light change requests highest priority first, each in its own thread: requests
+    on disjoint devices run in parallel, overlapping ones in priority then arrival order.
+    Queued requests whose devices are all covered by a newer request of equal or higher
+    priority are cancelled, and a running request yields between device writes to higher
+    priorities on its remaining devices.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self._pending = []
+        self._running = []
+        self._seq = itertools.count(int(time.time() * 1000)) #unique across restarts, for the journal
+        self._cond = threading.Condition()
+        self._worker = None
+
+    def submit(self, colors, priority, effect=None, runner=None):
+        """ Queues a light change (or an effect start or frame), cancelling the queued work it supersedes """
+        request = LightRequest(colors, priority, next(self._seq), effect, runner)
+        if self.manager.journal is not None:
+            self.manager.journal.request(request.seq, colors, priority)
+        with self._cond:
+            self._supersede(request.targets, priority)
+            heapq.heappush(self._pending, request)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="scheduler", daemon=True)
+                self._worker.start()
+            self._cond.notify()
+        return request
+
+    def preempts(self, request):
+        """ Checks whether a queued request should run before the given one on its remaining devices """
+        with self._cond:
+            remaining = request.targets - request.completed - request.skipped
+            return any(not queued.cancelled and queued.priority > request.priority
+                       and not queued.targets.isdisjoint(remaining) for queued in self._pending)
+
+    def pending(self):
+        """ Getter for the number of queued requests """
+        with self._cond:
+            return sum(1 for queued in self._pending if not queued.cancelled)
+
+    def running(self):
+        """ Getter for the number of requests running """
+        with self._cond:
+            return len(self._running)
+
+    def coalesce(self, priority):
+        """
+        Makes room in a full queue by merging its two newest requests of a same priority, the
+        lowest one up to the given priority: the older one is cancelled and its devices added
+        to the newer one, so no device runs at a priority it was not requested with
+        """
+        with self._cond:
+            for level in sorted(set(q.priority for q in self._pending if not q.cancelled)):
+                if level > priority:
+                    return False
+                queued = sorted((q for q in self._pending if not q.cancelled and q.priority == level
+                                 and q.effect is None and q.runner is None), key=lambda q: q.seq)
+                if len(queued) >= 2:
+                    break
+            else:
+                return False
+            older, newer = queued[-2], queued[-1]
+            for i in older.targets - newer.targets:
+                newer.colors[i] = older.colors[i]
+            newer.targets = newer.targets | older.targets
+            older.cancelled = True
+            self._finish(older, "coalesced")
+            return True
+
+    def _supersede(self, targets, priority):
+        for queued in self._pending:
+            if not queued.cancelled and queued.priority <= priority and queued.targets <= targets:
+                LightManager.debugger("Cancelling queued request {} superseded by a newer one" \
+                                      .format(queued.seq), 0)
+                queued.cancelled = True
+                self._finish(queued, "superseded")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                request = self._next()
+                while request is None:
+                    self._cond.wait()
+                    request = self._next()
+                self._running.append(request)
+            threading.Thread(target=self._execute, args=(request,), name="request", daemon=True).start()
+
+    def _next(self):
+        # the first request in priority order whose devices are neither used by a running
+        # request nor claimed by a request queued before it
+        self._pending = [queued for queued in self._pending if not queued.cancelled]
+        heapq.heapify(self._pending)
+        busy = set()
+        for running in self._running:
+            busy |= running.targets
+        for queued in sorted(self._pending):
+            if queued.targets.isdisjoint(busy):
+                self._pending.remove(queued)
+                heapq.heapify(self._pending)
+                return queued
+            busy |= queued.targets
+        return None
+
+    def _execute(self, request):
+        try:
+            run = self.manager._start_effect if request.effect is not None else self.manager._set_lights
+            finished = run(request)
+            if not finished and request.failed:
+                self._finish(request, "incomplete")
+                return
+            if not finished:
+                with self._cond:
+                    request.preempted = True
+                    remaining = request.targets - request.completed
+                    if any(not queued.cancelled and queued.priority >= request.priority
+                           and remaining <= queued.targets for queued in self._pending):
+                        self._finish(request, "superseded")
+                    else:
+                        heapq.heappush(self._pending, request)
+                return
+            with self._cond:
+                self._drop_stale(request)
+            self._finish(request, self._outcome(request))
+        finally:
+            with self._cond:
+                self._running.remove(request)
+                self._cond.notify()
+
+    @staticmethod
+    def _outcome(request):
+        # skipped devices were never written: the request only partly applies, it did not fail
+        if request.completed >= request.targets:
+            return "completed"
+        if request.completed | request.skipped >= request.targets:
+            return "partial"
+        return "incomplete"
+
+    def _finish(self, request, outcome):
+        if self.manager.journal is not None:
+            self.manager.journal.outcome(request.seq, outcome)
+        request.finish(outcome)
+
+    def _drop_stale(self, request):
+        # Preempted work must not undo the devices changed by the request that preempted it
+        for queued in self._pending:
+            if queued.preempted and not queued.cancelled and queued.priority < request.priority:
+                queued.targets = queued.targets - request.targets
+                if queued.completed >= queued.targets:
+                    queued.cancelled = True
+                    self._finish(queued, "superseded")
+
+
+class EffectRunner(threading.Thread):
+    """
+    Server-side frames of an effect, for the devices without firmware effects: a frame is
+    submitted to the request scheduler every interval, so effects yield to and queue with
+    the other requests. A request changing one of the devices takes it out of the effect,
+    which ends with its last device. Milights cannot dim, so they pulse by blinking slower.
+    """
+    def __init__(self, manager, mode, colors, interval, priority):
+        threading.Thread.__init__(self, name="effect", daemon=True)
+        import random
+        self.manager = manager
+        self.mode = mode
+        self.colors = colors
+        self.interval = interval
+        self.priority = priority
+        self.random = random.Random()
+        self._lock = threading.Lock()
+
+    def holds(self, devid):
+        """ Checks whether a device is still part of the effect """
+        with self._lock:
+            return devid in self.colors
+
+    def stop(self, devids):
+        """ Takes devices out of the effect, False once none is left """
+        with self._lock:
+            for devid in devids:
+                self.colors.pop(devid, None)
+            return bool(self.colors)
+
+    def frame(self, step, color):
+        """ Color of a device at a step of the effect """
+        if self.mode == 0: #blink
+            return color if step % 2 == 0 else LIGHT_OFF
+        if self.mode == 1: #pulse
+            return color if step % 4 != 3 else LIGHT_OFF
+        if self.mode == 2: #hard rainbow
+            return "hsv({},100,100)".format(step % 6 * 60)
+        if self.mode == 3: #smooth rainbow
+            return "hsv({},100,100)".format(step * 15 % 360)
+        return "hsv({},100,100)".format(self.random.randint(15, 45)) #candle
+
+    def run(self):
+        for step in itertools.count():
+            with self._lock: #a request stopping the effect is never overtaken by one of its frames
+                if not self.colors:
+                    return
+                frame = [LIGHT_SKIP] * len(self.manager.devices)
+                for devid, color in self.colors.items():
+                    frame[devid] = self.frame(step, color)
+                request = self.manager.scheduler.submit(frame, self.priority, runner=self)
+            request.done.wait()
+            time.sleep(self.interval)
+
+
+class Reconciler(object):
+    """
+    Converges the devices to their desired state in the background: requests only record
+    the desired states and return. Drifted devices are written highest priority first, a
+    failing device backing off exponentially, and Playbulb colors are read back every
+    readback seconds so that a wall switch or a power cut is seen as drift and corrected.
+    """
+    def __init__(self, manager, interval=5.0, backoff=1.0, max_backoff=60.0, readback=300.0):
+        self.manager = manager
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.readback = readback
+        self._seq = itertools.count(int(time.time() * 1000))
+        self._requests = [None] * len(manager.devices) #journal seq of the latest desired state
+        self._attempts = [0] * len(manager.devices)
+        self._retry_at = [0] * len(manager.devices)
+        self._checked_at = [0] * len(manager.devices)
+        self._wake = threading.Event()
+        self._worker = None
+
+    def start(self):
+        """ Starts the convergence loop, spreading the first read-backs over one interval """
+        if self._worker is None:
+            now = time.time()
+            for _cnt in range(len(self.manager.devices)):
+                self._checked_at[_cnt] = now + self.readback * _cnt / len(self.manager.devices)
+            self._worker = threading.Thread(target=self._run, name="reconciler", daemon=True)
+            self._worker.start()
+
+    def wake(self):
+        """ Runs a convergence pass now """
+        self._wake.set()
+
+    def submit(self, colors, priority):
+        """ Records the desired colors of a request and returns without waiting for the devices """
+        manager = self.manager
+        converted = manager.colorengine.convert_frame(colors, manager.devices)
+        seq = next(self._seq)
+        if manager.journal is not None:
+            manager.journal.request(seq, colors, priority)
+        accepted = 0
+        for _cnt, device in enumerate(manager.devices):
+            if colors[_cnt] == LIGHT_SKIP or not device.hold_priority(priority):
+                continue
+            device.desired = converted[_cnt]
+            device.desired_priority = priority
+            self._attempts[_cnt] = 0
+            self._retry_at[_cnt] = 0
+            self._requests[_cnt] = seq
+            accepted += 1
+        outcome = "accepted" if accepted else "held"
+        if manager.journal is not None:
+            manager.journal.outcome(seq, outcome)
+        self.start()
+        self.wake()
+        return outcome
+
+    def _run(self):
+        while True:
+            self._wake.wait(self._next_pass())
+            self._wake.clear()
+            if self.readback:
+                self._read_back()
+            self._converge()
+
+    def _next_pass(self):
+        now = time.time()
+        retries = [self._retry_at[i] for i in self.manager.drifted() if self._retry_at[i] > now]
+        return max(min(retries + [now + self.interval]) - now, 0)
+
+    def _converge(self):
+        now = time.time()
+        devices = self.manager.devices
+        due = [i for i in self.manager.drifted() if self._retry_at[i] <= now
+               and not devices[i].breaker_open()]
+        due.sort(key=lambda i: -devices[i].desired_priority)
+        for i in due:
+            if self._wake.is_set(): #a newer request, start over with its priority
+                return
+            self._apply(i, devices[i])
+
+    def _apply(self, slot, device):
+        old = device.state
+        desired = device.desired
+        try:
+            device.color(desired, device.desired_priority)
+        except Exception as ex:
+            LightManager.debugger("Device ({}) {} failed to converge: {}" \
+                                  .format(device.device_type, device.device, ex), 1)
+        if device.state == desired:
+            self._attempts[slot] = 0
+            if self.manager.journal is not None:
+                self.manager.journal.transition(self._requests[slot] or "reconcile", slot, old,
+                                                desired, "ok")
+            return
+        self._attempts[slot] += 1
+        delay = min(self.backoff * 2 ** (self._attempts[slot] - 1), self.max_backoff)
+        self._retry_at[slot] = time.time() + delay
+        LightManager.debugger("Device ({}) {} is still {} instead of {}, retrying in {:.1f} seconds" \
+                              .format(device.device_type, device.device, device.state, desired, delay), 0)
+
+    def _read_back(self):
+        now = time.time()
+        for _cnt, device in enumerate(self.manager.devices):
+            if self._checked_at[_cnt] > now or device.breaker_open():
+                continue
+            if self._wake.is_set():
+                return
+            self._checked_at[_cnt] = now + self.readback
+            actual = device.read_state()
+            if actual is not None and actual != device.state:
+                LightManager.debugger("Device ({}) {} drifted to {} from {}" \
+                                      .format(device.device_type, device.device, actual, device.state), 0)
+                device.state = actual
+
+
+class TokenBucket(object):
+    """ Token bucket refilled at rate tokens per second, holding at most burst tokens """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.time()
+
+    def wait(self):
+        """ Getter for the seconds until a token is available, 0 if one is """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """ Consumes a token, to be called once wait() returned 0 """
+        self.tokens -= 1
+
+
+class AdmissionControl(object):
+    """
+    Keeps the BLE radio from being flooded: requests are limited per client, stream frames
+    per client and per device, and the requests waiting for the radio are bounded. Over the
+    limits, OVERLOAD_POLICY either rejects requests with a retry delay, delays them up to
+    ADMISSION_MAX_DELAY seconds, or coalesces them into the queued requests. Priority 3
+    requests (manual offs) are never limited. Stream frames yield to queued requests.
+    """
+    def __init__(self, config, scheduler):
+        def setting(key, default):
+            return config.get('SERVER', key, fallback=default) if config is not None else default
+        self.scheduler = scheduler
+        self.client_rate = float(setting('CLIENT_RATE', '2'))
+        self.client_burst = float(setting('CLIENT_BURST', '10'))
+        self.stream_rate = float(setting('STREAM_RATE', '20'))
+        self.device_rate = float(setting('DEVICE_RATE', '10'))
+        self.max_pending = int(setting('MAX_PENDING', '20'))
+        self.policy = setting('OVERLOAD_POLICY', 'delay')
+        self.max_delay = float(setting('ADMISSION_MAX_DELAY', '5'))
+        self._clients = {}
+        self._streams = {}
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(int(setting('MAX_CLIENTS', '32')))
+        self.clients = 0
+
+    def admit_client(self):
+        """ Takes one of the concurrent client slots, if any is left """
+        if not self._slots.acquire(blocking=False):
+            return False
+        with self._lock:
+            self.clients += 1
+        return True
+
+    def release_client(self):
+        """ Gives back a concurrent client slot """
+        with self._lock:
+            self.clients -= 1
+        self._slots.release()
+
+    def admit_request(self, client, priority):
+        """ Admits a request, returning 0 or the seconds after which the client should retry """
+        if priority >= 3:
+            return 0
+        deadline = time.time() + (self.max_delay if self.policy == "delay" else 0)
+        while True:
+            with self._lock:
+                bucket = self._clients.setdefault(client, TokenBucket(self.client_rate, self.client_burst))
+                wait = bucket.wait()
+                overflow = self.scheduler.pending() - self.max_pending + 1
+                if overflow > 0 and self.policy == "coalesce":
+                    overflow = 0 if self.scheduler.coalesce(priority) else overflow
+                if overflow > 0:
+                    wait = max(wait, overflow * 1.0)
+                if not wait:
+                    bucket.take()
+                    return 0
+            if time.time() + wait > deadline:
+                return wait
+            time.sleep(wait)
+
+    def admit_frame(self, client, targets):
+        """ Admits a stream frame, returning 0 or the seconds to wait before trying again """
+        with self._lock:
+            if self.scheduler.pending():
+                return 0.05
+            buckets = [self._streams.setdefault(client, TokenBucket(self.stream_rate, self.stream_rate))]
+            buckets += [self._devices.setdefault(i, TokenBucket(self.device_rate, self.device_rate))
+                        for i in targets]
+            wait = max(bucket.wait() for bucket in buckets)
+            if not wait:
+                for bucket in buckets:
+                    bucket.take()
+            return wait
+
+
+class UdpIngest(object):
+    """
+    Connectionless ingest of real-time stream frames (UDP_PORT). A datagram is a
+    '!HI' header (stream id, sequence number) followed by one or more entries:
+    '!BH4s' (0, device id, WRGB color) or '!BB' (1, group name length) + name + '4s'.
+    Late and duplicate sequence numbers are discarded, and only the newest color of each
+    device is handed to the sender thread: a stale frame is worse than a lost one.
+    """
+    HEADER = struct.Struct('!HI')
+    DEVICE = struct.Struct('!BH4s')
+    GROUP = struct.Struct('!BB')
+
+    def __init__(self, lm, admission, host, port, stream_timeout=5.0, capture=None):
+        self.lm = lm
+        self.stream_timeout = stream_timeout
+        self.capture = capture
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.streams = {}
+        self.sink = StreamSink(lm, admission, "udp")
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Starts the receiver and sender threads """
+        LightManager.debugger("Listening for UDP stream frames on port {}" \
+                              .format(self.sock.getsockname()[1]), 0)
+        threading.Thread(target=self._receive, daemon=True).start()
+        self.sink.start()
+
+    def stats(self):
+        """
+        Getter for the statistics of the active streams: lost counts the sequence gaps
+        (late frames included), late the discarded out-of-order or duplicate frames
+        """
+        with self._lock:
+            return [{"source": stream["source"], "stream": stream["stream"],
+                     "received": stream["received"], "lost": stream["lost"],
+                     "late": stream["late"], "jitter_ms": round(stream["jitter_ms"], 2)}
+                    for stream in self.streams.values()]
+
+    def parse(self, datagram):
+        """ Returns (stream id, sequence, {devid: color}) of a datagram, None if malformed """
+        try:
+            stream_id, seq = self.HEADER.unpack_from(datagram)
+        except struct.error:
+            return None
+        colors = self.parse_entries(self.lm, datagram, self.HEADER.size)
+        if colors is None:
+            return None
+        return stream_id, seq, colors
+
+    @classmethod
+    def parse_entries(cls, lm, data, offset=0):
+        """ Returns the {devid: color} of the color entries from offset, None if malformed or empty """
+        if offset >= len(data):
+            return None
+        colors = {}
+        try:
+            while offset < len(data):
+                if data[offset] == 0:
+                    _, devid, color = cls.DEVICE.unpack_from(data, offset)
+                    offset += cls.DEVICE.size
+                    if devid >= len(lm.devices):
+                        return None
+                    colors[devid] = color.hex()
+                else:
+                    _, length = cls.GROUP.unpack_from(data, offset)
+                    offset += cls.GROUP.size
+                    group = bytes(data[offset:offset + length]).decode('utf-8')
+                    color = data[offset + length:offset + length + 4]
+                    offset += length + 4
+                    if len(color) < 4:
+                        return None
+                    for devid, dev in enumerate(lm.devices):
+                        if dev.group == group:
+                            colors[devid] = bytes(color).hex()
+        except (struct.error, UnicodeDecodeError):
+            return None
+        return colors
+
+    def accept(self, address, stream_id, seq, now):
+        """ Updates the stream statistics, False for late or duplicate sequence numbers """
+        with self._lock:
+            key = (address[0], address[1], stream_id)
+            stream = self.streams.get(key)
+            if stream is None or now - stream["last_seen"] > self.stream_timeout:
+                if stream is not None:
+                    self._report(stream)
+                stream = {"source": "{}:{}".format(address[0], address[1]), "stream": stream_id,
+                          "received": 0, "lost": 0, "late": 0, "jitter_ms": 0.0,
+                          "seq": (seq - 1) & 0xffffffff, "last_seen": now, "gap": None}
+                self.streams[key] = stream
+            ahead = (seq - stream["seq"]) & 0xffffffff
+            if ahead == 0 or ahead >= 0x80000000:
+                stream["late"] += 1
+                return False
+            stream["lost"] += ahead - 1
+            stream["received"] += 1
+            gap = now - stream["last_seen"]
+            if stream["gap"] is not None: #smoothed variation of the inter-arrival gaps
+                stream["jitter_ms"] += (abs(gap - stream["gap"]) * 1000 - stream["jitter_ms"]) / 16
+            stream["gap"] = gap
+            stream["seq"] = seq
+            stream["last_seen"] = now
+            for stale in [k for k, v in self.streams.items()
+                          if now - v["last_seen"] > self.stream_timeout]:
+                self._report(self.streams.pop(stale))
+            return True
+
+    def _report(self, stream):
+        LightManager.debugger("UDP stream {} from {} ended: {} frames, {} lost, {} late, "
+                              "jitter {:.1f} ms".format(stream["stream"], stream["source"],
+                                                       stream["received"], stream["lost"],
+                                                       stream["late"], stream["jitter_ms"]), 0)
+
+    def _receive(self):
+        while True:
+            datagram, address = self.sock.recvfrom(2048)
+            if self.capture is not None:
+                self.capture.datagram(address, datagram)
+            frame = self.parse(datagram)
+            if frame is None:
+                LightManager.debugger("Malformed UDP frame from {}".format(address[0]), 1)
+                continue
+            stream_id, seq, colors = frame
+            if not self.accept(address, stream_id, seq, time.monotonic()):
+                continue
+            self.sink.offer(colors)
+
+
+class StreamSink(object):
+    """
+    Hands stream frames to the radio from its own thread. Only the newest color of each
+    device is kept while a frame waits for admission: a stale frame is worse than a lost one.
+    """
+    def __init__(self, lm, admission, client):
+        self.lm = lm
+        self.admission = admission
+        self.client = client
+        self.closed = False
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Starts the sender thread """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._send, daemon=True)
+            self._thread.start()
+
+    def offer(self, colors):
+        """ Merges a frame of {devid: color} into the one waiting to be sent """
+        with self._lock:
+            self._latest.update(colors)
+            self._ready.set()
+        self.start()
+
+    def close(self):
+        """ Stops the sender thread, dropping any frame still waiting """
+        self.closed = True
+        self._ready.set()
+
+    def _send(self):
+        while True:
+            self._ready.wait()
+            if self.closed:
+                return
+            with self._lock:
+                targets = list(self._latest)
+            wait = self.admission.admit_frame(self.client, targets)
+            if wait:
+                time.sleep(wait)
+                continue
+            with self._lock:
+                colors, self._latest = self._latest, {}
+                self._ready.clear()
+            self.lm.set_stream_frame(colors)
+
+
+class StateJournal(object):
+    """
+    Append-only journal of accepted requests and device state transitions, one JSON record
+    per line. Records are buffered and written by a background thread with a single fsync
+    per batch. Every segment starts with a snapshot of all device states, and only the
+    latest JOURNAL_SEGMENTS segments of JOURNAL_MAX_RECORDS records are kept.
+    """
+    def __init__(self, directory, snapshot, flush_interval=1.0, max_records=10000, segments=3):
+        self.directory = directory
+        self.snapshot = snapshot
+        self.flush_interval = flush_interval
+        self.max_records = max_records
+        self.segments = segments
+        self._pending = []
+        self._records = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._file = None
+        self._rotate()
+        self._writer = threading.Thread(target=self._run, name="journal", daemon=True)
+        self._writer.start()
+
+    def request(self, reqid, colors, priority):
+        """ Journals an accepted request """
+        self._append({"t": time.time(), "k": "req", "r": reqid, "p": priority, "c": colors})
+
+    def transition(self, reqid, devid, old, new, outcome):
+        """ Journals a device state transition, or a failed attempt """
+        self._append({"t": time.time(), "k": "set", "r": reqid, "d": devid, "o": old, "n": new,
+                      "x": outcome})
+
+    def outcome(self, reqid, outcome):
+        """ Journals the outcome of a request """
+        self._append({"t": time.time(), "k": "end", "r": reqid, "x": outcome})
+
+    def pending(self):
+        """ Getter for the number of records waiting to be written """
+        with self._cond:
+            return len(self._pending)
+
+    def close(self):
+        """ Writes the pending records and stops the writer """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._writer.join(5)
+
+    def _append(self, record):
+        with self._cond:
+            self._pending.append(record)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.flush_interval)
+                batch = self._pending
+                self._pending = []
+                closed = self._closed
+            if batch:
+                self._file.write("".join(json.dumps(record, separators=(',', ':')) + "\n"
+                                         for record in batch))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._records += len(batch)
+                if self._records >= self.max_records:
+                    self._rotate()
+            if closed:
+                self._file.close()
+                return
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        for i in range(self.segments - 1, 0, -1):
+            older = StateJournal.segment(self.directory, i - 1)
+            if os.path.isfile(older):
+                os.replace(older, StateJournal.segment(self.directory, i))
+        self._file = open(StateJournal.segment(self.directory, 0), "a")
+        self._file.write(json.dumps({"t": time.time(), "k": "snap", "s": self.snapshot()},
+                                    separators=(',', ':')) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records = 1
+
+    @staticmethod
+    def segment(directory, index):
+        """ Getter for the path of a journal segment, 0 being the one being written """
+        return os.path.join(directory, "state.{}.journal".format(index))
+
+    @staticmethod
+    def records(directory):
+        """ Reads the journal records, oldest first """
+        paths = []
+        index = 0
+        while os.path.isfile(StateJournal.segment(directory, index)):
+            paths.insert(0, StateJournal.segment(directory, index))
+            index += 1
+        for path in paths:
+            with open(path) as jfile:
+                for line in jfile:
+                    try:
+                        yield json.loads(line)
+                    except ValueError: #torn write at crash time
+                        continue
+
+    @staticmethod
+    def replay(directory, until=None):
+        """ Rebuilds the device states as they were at the until timestamp (default: now) """
+        states = None
+        for record in StateJournal.records(directory):
+            if until is not None and record["t"] > until:
+                break
+            if record["k"] == "snap":
+                states = list(record["s"])
+            elif record["k"] == "set" and states is not None and record["x"] == "ok":
+                states[record["d"]] = record["n"]
+        return states
+
+
+class TrafficCapture(object):
+    """
+    Compact capture of the incoming traffic for replaytool.py: after a header holding the
+    wall clock start time, every record is a '!dBIH' header (seconds since the start, kind,
+    connection id, payload length) and its payload. OPEN records hold the source address
+    of a connection or UDP source, FRAME records the legacy frames (requests, session
+    commands and TCP stream frames), DATAGRAM records the UDP stream frames, and REPLY
+    records the '!f' milliseconds taken to answer the last frame and the answer status.
+    Records are buffered and written by a background thread.
+    """
+    MAGIC = b'LSCAPTURE1\n'
+    START = struct.Struct('!d')
+    RECORD = struct.Struct('!dBIH')
+    REPLY_MS = struct.Struct('!f')
+    OPEN, FRAME, CLOSE, DATAGRAM, REPLY = range(5)
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.records = 0
+        self._start = time.monotonic()
+        self._ids = itertools.count(1)
+        self._sources = {}
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._file = open(path, "wb")
+        self._file.write(self.MAGIC + self.START.pack(time.time()))
+        self._writer = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._writer.start()
+
+    def open(self, address):
+        """ Records a new connection and returns its id """
+        conn = next(self._ids)
+        self._append(self.OPEN, conn, "{}:{}".format(address[0], address[1]).encode('utf-8'))
+        return conn
+
+    def frame(self, conn, data):
+        """ Records a legacy frame received on a connection """
+        self._append(self.FRAME, conn, data.encode('utf-8'))
+
+    def reply(self, conn, received, status):
+        """ Records the time taken to answer the frame received at the received monotonic time """
+        self._append(self.REPLY, conn, self.REPLY_MS.pack((time.monotonic() - received) * 1000)
+                     + str(status).encode('utf-8'))
+
+    def close(self, conn):
+        """ Records the end of a connection """
+        self._append(self.CLOSE, conn, b'')
+
+    def datagram(self, address, data):
+        """ Records a UDP datagram, its source getting a connection id on its first datagram """
+        conn = self._sources.get(address) #called by the UDP receiver thread only
+        if conn is None:
+            conn = self._sources[address] = self.open(address)
+        self._append(self.DATAGRAM, conn, bytes(data))
+
+    def stop(self):
+        """ Writes the pending records and closes the capture """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._writer.join(5)
+
+    def _append(self, kind, conn, payload):
+        record = self.RECORD.pack(time.monotonic() - self._start, kind, conn, len(payload)) + payload
+        with self._cond:
+            self._pending.append(record)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.flush_interval)
+                batch = self._pending
+                self._pending = []
+                closed = self._closed
+            if batch:
+                self._file.write(b''.join(batch))
+                self._file.flush()
+                self.records += len(batch)
+            if closed:
+                self._file.close()
+                return
+
+    @classmethod
+    def read(cls, path):
+        """ Returns the wall clock start time and the (seconds, kind, conn, payload) records of a capture """
+        with open(path, "rb") as cfile:
+            data = cfile.read()
+        if not data.startswith(cls.MAGIC):
+            raise ValueError("{} is not a traffic capture".format(path))
+        offset = len(cls.MAGIC)
+        started, = cls.START.unpack_from(data, offset)
+        offset += cls.START.size
+        records = []
+        while offset + cls.RECORD.size <= len(data):
+            seconds, kind, conn, length = cls.RECORD.unpack_from(data, offset)
+            offset += cls.RECORD.size
+            if offset + length > len(data): #torn write at crash time
+                break
+            records.append((seconds, kind, conn, data[offset:offset + length]))
+            offset += length
+        return started, records
+
+
+class ColorEngine(object):
+    """
+    Converts standard color inputs to each device's native format.
+    Accepted inputs: the 0/1/-1 shortcuts, '#rrggbb' or 'rrggbb', 'hsv(h,s,v)' (h in degrees,
+    s and v in percent), color temperatures ('2700k') and named colors ('warmwhite').
+    Device-native values (8 digits WRGB playbulb hex, decimal milight color ids) pass through.
+    """
+    NAMED = {"off": LIGHT_OFF, "on": LIGHT_ON, "black": "#000000", "white": "#ffffff",
+             "warmwhite": "2700k", "coolwhite": "6500k", "red": "#ff0000", "green": "#00ff00",
+             "blue": "#0000ff", "yellow": "#ffff00", "orange": "#ff8000", "purple": "#8000ff",
+             "pink": "#ff40a0", "cyan": "#00ffff", "magenta": "#ff00ff"}
+    MILIGHT_BITS = 6 #bits kept per channel in the milight lookup table (64x64x64 entries)
+    MILIGHT_WHITE = 0 #color ids 0 and 1 collide with the LIGHT_OFF/LIGHT_ON shortcuts,
+    MILIGHT_BLACK = 1 #so the lookup table uses them for unsaturated and dark colors
+
+    def __init__(self):
+        self._milight_lut = None
+        try: #the lookup table and frame conversion are vectorized when numpy is there
+            import numpy
+            self._numpy = True
+        except ImportError:
+            self._numpy = False
+        self.parse = functools.lru_cache(maxsize=1024)(self._parse)
+        self.to_playbulb = functools.lru_cache(maxsize=1024)(self._to_playbulb)
+        self.to_milight = functools.lru_cache(maxsize=1024)(self._to_milight)
+
+    def valid(self, color, device_type):
+        """ Checks whether a color input can be converted for the device type """
+        color = self.NAMED.get(color, color)
+        return color in (LIGHT_OFF, LIGHT_ON, LIGHT_SKIP) or self._is_native(color, device_type) \
+               or self._is_native(color, "Playbulb") or self.parse(color) is not None
+
+    def milight_lut(self):
+        """ Getter for the precomputed quantized RGB -> milight color id table """
+        import numpy as np
+        if self._milight_lut is None:
+            levels = 1 << self.MILIGHT_BITS
+            step = 256 // levels
+            index = np.arange(levels ** 3)
+            rgb = np.stack([(index >> (2 * self.MILIGHT_BITS)) & (levels - 1),
+                            (index >> self.MILIGHT_BITS) & (levels - 1),
+                            index & (levels - 1)], axis=1) * step + step // 2
+            self._milight_lut = self._milight_ids(rgb / 255.0)
+        return self._milight_lut
+
+    def milight_index(self, rgb):
+        """ Gets the lookup table indexes of an (n, 3) uint8 RGB array """
+        import numpy as np
+        rgb = np.asarray(rgb, dtype=np.uint32) >> (8 - self.MILIGHT_BITS)
+        return (rgb[:, 0] << (2 * self.MILIGHT_BITS)) | (rgb[:, 1] << self.MILIGHT_BITS) | rgb[:, 2]
+
+    def convert_frame(self, colors, devices):
+        """ Converts one color per device to the devices native formats, in a single pass """
+        if not self._numpy:
+            return [device.convert(color) for color, device in zip(colors, devices)]
+        import numpy as np
+        rgbs = np.zeros((len(colors), 3), dtype=np.uint8)
+        parsed = [False] * len(colors)
+        for _cnt, color in enumerate(colors):
+            if color in (LIGHT_OFF, LIGHT_ON, LIGHT_SKIP) or color in self.NAMED \
+               or self._is_native(color, devices[_cnt].device_type) \
+               or (self._is_temperature(color) and devices[_cnt].device_type == "Milight"):
+                continue
+            rgb = self.parse(color)
+            if rgb is not None:
+                rgbs[_cnt] = rgb
+                parsed[_cnt] = True
+        ids = self.milight_lut()[self.milight_index(rgbs)]
+        converted = [None] * len(colors)
+        for _cnt, device in enumerate(devices):
+            if not parsed[_cnt]:
+                converted[_cnt] = device.convert(colors[_cnt])
+            elif device.device_type == "Milight":
+                converted[_cnt] = self._milight_code(int(ids[_cnt]))
+            else:
+                converted[_cnt] = "00%02x%02x%02x" % tuple(rgbs[_cnt])
+        return converted
+
+    def _to_playbulb(self, color, intensity):
+        color = self.NAMED.get(color, color)
+        if color == LIGHT_OFF:
+            return "00000000"
+        if color == LIGHT_ON:
+            return intensity
+        if color == LIGHT_SKIP:
+            return color
+        if self._is_native(color, "Playbulb"):
+            return color.lower()
+        rgb = self.parse(color)
+        if rgb is None:
+            return color
+        return "00%02x%02x%02x" % rgb
+
+    def _to_milight(self, color):
+        color = self.NAMED.get(color, color)
+        if color in (LIGHT_OFF, LIGHT_ON, LIGHT_SKIP) or self._is_native(color, "Milight"):
+            return color
+        if self._is_temperature(color): #milights only have the one white
+            return LIGHT_ON
+        if self._is_native(color, "Playbulb"):
+            if int(color[2:], 16) == 0:
+                return LIGHT_ON if int(color[0:2], 16) else LIGHT_OFF
+            color = color[2:]
+        rgb = self.parse(color)
+        if rgb is None:
+            return color
+        if not self._numpy:
+            return self._milight_code(self._milight_id(rgb))
+        return self._milight_code(int(self.milight_lut()[self.milight_index([rgb])[0]]))
+
+    def _milight_code(self, colorid):
+        if colorid == self.MILIGHT_WHITE:
+            return LIGHT_ON
+        if colorid == self.MILIGHT_BLACK:
+            return LIGHT_OFF
+        return str(colorid)
+
+    def _milight_ids(self, rgb):
+        # Milight color wheel: red is 176 and ids decrease with the hue angle
+        import numpy as np
+        hsv = self._rgb_to_hsv(rgb)
+        ids = (256 + 176 - (hsv[:, 0] * 255.0 + 1e-6).astype(np.int32)) % 256 #hues on an exact id
+        ids[ids < 2] = 2
+        ids[hsv[:, 1] < 0.2] = self.MILIGHT_WHITE
+        ids[hsv[:, 2] < 0.05] = self.MILIGHT_BLACK
+        return ids.astype(np.uint8)
+
+    def _milight_id(self, rgb):
+        """ Single color version of _milight_ids, quantized like the lookup table """
+        step = 256 >> self.MILIGHT_BITS
+        hue, sat, val = colorsys.rgb_to_hsv(*[((c // step) * step + step // 2) / 255.0 for c in rgb])
+        if val < 0.05:
+            return self.MILIGHT_BLACK
+        if sat < 0.2:
+            return self.MILIGHT_WHITE
+        return max((256 + 176 - int(hue * 255.0 + 1e-6)) % 256, 2)
+
+    @staticmethod
+    def _rgb_to_hsv(rgb):
+        """ Vectorized colorsys.rgb_to_hsv over an (n, 3) float array in [0, 1] """
+        import numpy as np
+        maxc = rgb.max(axis=1)
+        minc = rgb.min(axis=1)
+        delta = maxc - minc
+        safe = np.where(delta == 0, 1, delta)
+        r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+        hue = np.where(maxc == r, (g - b) / safe,
+                       np.where(maxc == g, 2.0 + (b - r) / safe, 4.0 + (r - g) / safe))
+        hue = np.where(delta == 0, 0.0, (hue / 6.0) % 1.0)
+        sat = np.where(maxc == 0, 0.0, delta / np.where(maxc == 0, 1, maxc))
+        return np.stack([hue, sat, maxc], axis=1)
+
+    @staticmethod
+    def _is_temperature(color):
+        return color.lower().endswith("k") and color[:-1].isdigit()
+
+    @staticmethod
+    def _is_native(color, device_type):
+        if device_type == "Milight":
+            return color.isdigit() and len(color) <= 3
+        return len(color) == 8 and all(c in "0123456789abcdefABCDEF" for c in color)
+
+    def _parse(self, color):
+        """ Parses a color input to an (r, g, b) tuple, None if the format is unknown """
+        color = self.NAMED.get(color.strip().lower(), color.strip().lower())
+        try:
+            if color.startswith("hsv(") and color.endswith(")"):
+                hue, sat, val = [float(v) for v in color[4:-1].split(",")]
+                return tuple(int(round(c * 255)) for c in colorsys.hsv_to_rgb((hue % 360) / 360.0,
+                                                                               sat / 100.0,
+                                                                               val / 100.0))
+            if self._is_temperature(color):
+                return self._temperature(int(color[:-1]))
+            if color.startswith("#"):
+                color = color[1:]
+            if len(color) == 6:
+                return (int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16))
+        except ValueError:
+            pass
+        return None
+
+    @staticmethod
+    def _temperature(kelvin):
+        """ Color temperature to RGB (Tanner Helland's approximation) """
+        temp = min(max(kelvin, 1000), 40000) / 100.0
+        if temp <= 66:
+            red = 255
+            green = 99.4708025861 * math.log(temp) - 161.1195681661
+            blue = 0 if temp <= 19 else 138.5177312231 * math.log(temp - 10) - 305.0447927307
+        else:
+            red = 329.698727446 * ((temp - 60) ** -0.1332047592)
+            green = 288.1221695283 * ((temp - 60) ** -0.0755148492)
+            blue = 255
+        return tuple(int(min(max(c, 0), 255)) for c in (red, green, blue))
+
+
 class Bulb(object):
     """ Global bulb functions and variables """
+    __slots__ = ('devid', 'device', 'description', 'group', 'subgroup', 'server', 'device_type',
+                 'state', 'desired', 'priority', 'priority_expiry', 'desired_priority', 'failures',
+                 'breaker', 'prepared_until', 'effect', 'effect_speed', '_connection',
+                 '_connect_lock', '_handles')
+
     def __init__(self, devid, device, description, group, subgroup, server):
         self.devid = devid
         self.device = device
         self.description = description
-        self.success = False
         self._connection = None
         self.group = group
         self.subgroup = subgroup
         self.server = server
         self.priority = 0
+        self.priority_expiry = 0
         self.state = None
         self.device_type = None
+        self.failures = 0
+        self.breaker = "closed"
+        self.desired = None
+        self.desired_priority = 1
+        self.prepared_until = 0
+        self.effect = 0 #EFFECTS index + 1, 0 for none
+        self.effect_speed = 0
+        self._connect_lock = threading.Lock()
+        self._handles = {}
 
-    def reinit(self):
-        """ Prepares the device for a future request """
-        self.success = False
+    def connect(self):
+        """ Opens the BLE connection to the device, if not already opened """
+        with self._connect_lock:
+            if self._connection is not None:
+                return True
+            try:
+                LightManager.debugger("CONnecting to device ({}) {}".format(self.device_type,
+                                                                            self.device), 0)
+                if SIMULATE:
+                    connection = SimulatedPeripheral(self.device)
+                else:
+                    connection = load_bluepy().Peripheral(self.device)
+                self._connection = connection.withDelegate(self)
+                self._handles = {}
+                return True
+            except Exception as ex:
+                LightManager.debugger("Device ({}) {} connection failed. Exception: {}" \
+                                      .format(self.device_type, self.device, ex), 1)
+                self._connection = None
+                return False
+
+    def ready(self, uuids):
+        """ Connects and resolves the characteristics of coming writes, for commit() """
+        if not self.connect():
+            self.record_failure()
+            return False
+        try:
+            for uuid in uuids:
+                if uuid not in self._handles:
+                    self._handles[uuid] = self._connection.getCharacteristics(uuid=uuid)[0]
+            return True
+        except Exception as ex:
+            LightManager.debugger("Device ({}) {} characteristics not found: {}" \
+                                  .format(self.device_type, self.device, ex), 1)
+            self.disconnect()
+            self.record_failure()
+            return False
+
+    def encode(self, color, priority):
+        """ Checks the request, returning its (uuid, payload, state) writes or None if none is needed """
+        return None
+
+    def start_effect(self, mode, color, speed, priority):
+        """ Starts an EFFECTS mode in firmware, None if the device has none (the server runs it) """
+        return None
+
+    def commit(self, writes):
+        """ Sends writes of encode() back to back through the characteristics resolved by ready() """
+        try:
+            for uuid, payload, state in writes:
+                self._handles[uuid].write(payload)
+                self.state = state
+        except Exception as ex:
+            LightManager.debugger("Device ({}) {} commit failed: {}".format(self.device_type, self.device, ex), 1)
+            self.disconnect()
+            self.record_failure()
+            return False
+        self.record_success()
+        LightManager.debugger("Device ({}) {} color changed to {}".format(self.device_type, self.device,
+                                                                        self.state), 0)
+        return True
+
+    def prepared(self):
+        """ Checks whether the connection is held open for an expected request """
+        return time.time() < self.prepared_until
+
+    def breaker_open(self):
+        """ Checks whether requests should skip the device until it is reachable again """
+        return self.breaker == "open"
+
+    def drifted(self):
+        """ Checks whether the device has a desired color it does not show """
+        return self.desired is not None and self.state != self.desired
+
+    def record_success(self):
+        """ Resets the consecutive failures count of the circuit breaker """
+        self.failures = 0
+
+    def record_failure(self):
+        """ Counts a failed write, opening the circuit breaker after too many in a row """
+        self.failures += 1
+        if self.failures >= self.server.breaker_threshold and self.breaker == "closed":
+            LightManager.debugger("Device ({}) {} failed {} times in a row, skipping it until it is back" \
+                                  .format(self.device_type, self.device, self.failures), 1)
+            self.breaker = "open"
+            self.server.start_probe()
+
+    def probe(self):
+        """ Checks whether an unreachable device is back, closing its circuit breaker if so """
+        if not self.connect():
+            return False
+        LightManager.debugger("Device ({}) {} is reachable again".format(self.device_type, self.device), 0)
+        self.failures = 0
+        self.breaker = "closed"
+        return True
+
+    def get_status(self):
+        """ Getter for the device state as reported by getstate """
+        return {"devid": self.devid, "state": self.state, "desired": self.desired,
+                "breaker": self.breaker, "failures": self.failures,
+                "effect": EFFECTS[self.effect - 1] if self.effect else None,
+                "effect_speed": self.effect_speed if self.effect else None}
+
+    def hold_priority(self, priority):
+        """ Checks the priority hold of the device, holding the request priority if it passes """
+        if self.priority > priority and time.time() < self.priority_expiry:
+            LightManager.debugger("{} bulb {} is set with higher priority ({}), skipping."
+                                  .format(self.device_type, self.device, self.priority), 0)
+            return False
+        # priority 3 goes through any hold and leaves none behind
+        self.priority = 1 if priority == 3 else priority
+        self.priority_expiry = time.time() + self.server.priority_ttl
+        return True
 
     def get_state(self):
         """ Getter for the actual color """
         return self.state
 
+    def read_state(self):
+        """ Reads the actual color back from the device, None if it cannot tell """
+        return None
+
+    def handleNotification(self, cHandle, data):
+        """ bluepy delegate callback, devices which notify their color override it """
+        pass
+
     def disconnect(self):
         """ Disconnects the device """
+        connection = self._connection
+        self._connection = None
+        self._handles = {}
+        if connection is None:
+            return
+        LightManager.debugger("DISconnecting from device {}".format(self.device), 0)
+        if ble is None:
+            # bluepy is loaded by the first real connection: this one is simulated, its errors are bugs
+            connection.disconnect()
+            return
         try:
-            if self._connection is not None:
-                LightManager.debugger("DISconnecting from device {}".format(self.device), 0)
-                self._connection.disconnect()
+            connection.disconnect()
         except ble.BTLEException:
             LightManager.debugger("Device ({}) {} disconnection failed. Already disconnected?"
                                   .format(self.device_type, self.device), 1)
@@ -635,11 +3651,13 @@ class Bulb(object):
         except:
             pass
 
-        self._connection = None
-
 
 class Playbulb(Bulb):
     """ Methods for driving a rainbow BLE lightbulb """
+    __slots__ = ('intensity',)
+    COLOR_UUID = "0000fffc-0000-1000-8000-00805f9b34fb"
+    EFFECT_UUID = "0000fffb-0000-1000-8000-00805f9b34fb"
+
     def __init__(self, devid, device, description, group, subgroup, intensity, server):
         super().__init__(devid, device, description, group, subgroup, server)
         self.device_type = "Playbulb"
@@ -649,48 +3667,72 @@ class Playbulb(Bulb):
 
     def convert(self, color):
         """ Conversion to a color code acceptable by the device """
-        if color == LIGHT_OFF:
-            color = "00000000"
-        elif color == LIGHT_ON:
-            color = self.intensity
-        return color
+        return self.server.colorengine.to_playbulb(color, self.intensity)
 
     def color(self, color, priority):
         """ Checks the request and trigger a light change if needed """
+        if self.encode(color, priority) is None:
+            return True
+        LightManager.debugger("Changing playbulb {} color to {}".format(self.device, color), 0)
+        if not self._write(color): return False
+        return True
+
+    def encode(self, color, priority):
+        """ Checks the request, returning its (uuid, payload, state) writes or None if none is needed """
         if len(color) not in (1, 8) and color != self.convert(LIGHT_SKIP):
             LightManager.debugger("Unhandled color format {}".format(color), 1)
-            return True
-        if self.success:
-            return True
+            return None
         if color == self.convert(LIGHT_SKIP):
-            self.success = True
-            return True
-        if self.priority > priority:
-            LightManager.debugger("Playbulb bulb {} is set with higher priority ({}), skipping."
-                                  .format(self.device, self.priority), 0)
-            self.success = True
-            return True
-        if priority == 3:
-            self.priority = 1
-        else:
-            self.priority = priority
+            return None
+        if not self.hold_priority(priority):
+            return None
         if self.state == color and color != self.convert(LIGHT_OFF):
-            self.success = True
             LightManager.debugger("Bulb {} is already of the requested color, skipping."
                                   .format(self.device), 0)
-            return True
-        LightManager.debugger("Changing playbulb {} color to {}".format(self.device, color), 0)
-        if not self._write(color): return False
-        return True
+            return None
+        return [(self.COLOR_UUID, bytearray.fromhex(color), color)]
+
+    def start_effect(self, mode, color, speed, priority):
+        """
+        Writes a WRGB color, mode, 00, speed (1 fastest to 255), 00 animation: the bulb runs it
+        until its next color write, its color being unknown meanwhile
+        """
+        if not self.hold_priority(priority):
+            return False
+        LightManager.debugger("Starting effect {} on playbulb {}".format(EFFECTS[mode], self.device), 0)
+        return self.ready([self.EFFECT_UUID]) \
+               and self.commit([(self.EFFECT_UUID, bytearray.fromhex(color) + bytearray([mode, 0, speed, 0]),
+                                 None)])
 
     def descriptions(self):
         """ Getter for the device description """
         desctext = "[Playbulb MAC: " + self.device + "] " + self.description
         return desctext
 
+    def read_state(self):
+        """ Reads the color back from the bulb, which is only disconnected again if it was not connected """
+        connected = self._connection is not None
+        if not connected and not self.connect():
+            return None
+        try:
+            data = self._connection.getCharacteristics(uuid=self.COLOR_UUID)[0].read()
+        except Exception as ex:
+            LightManager.debugger("Reading back playbulb {} failed: {}".format(self.device, ex), 1)
+            data = b''
+            connected = False
+        if not connected and not self.prepared():
+            self.disconnect()
+        return data.hex() if len(data) == 4 else None
+
+    def handleNotification(self, cHandle, data):
+        """ A color notified by the bulb is its actual state """
+        if len(data) == 4:
+            self.state = data.hex()
+            if self.server.reconciler is not None:
+                self.server.reconciler.wake()
+
     @connect_ble
     def _write(self, color):
-        _oldcolor = self.state
         try:
             if self._connection is not None:
                     #NOT YET STABLE
@@ -712,17 +3754,16 @@ class Playbulb(Bulb):
 #                           time.sleep(0.5)
 
 
-                self.state = color
                 LightManager.debugger("Setting playbulb {} color to {}".format(self.device, color), 0)
-                self._connection.getCharacteristics(uuid="0000fffc-0000-1000-8000-00805f9b34fb")[0] \
-                                .write(bytearray.fromhex(color))
+                self._connection.getCharacteristics(uuid=self.COLOR_UUID)[0].write(bytearray.fromhex(color))
+                self.state = color
 
-                #Prebuilt animations: blink=00, pulse=01, hard rainbow=02, smooth rainbow=03, candle=04
-                #self._connection.getCharacteristics(uuid="0000fffb-0000-1000-8000-00805f9b34fb")[0].write(bytearray.fromhex(color+"02ffffff"))
-                self.success = True
+                self.record_success()
                 LightManager.debugger("Playbulb {} color changed to {}".format(self.device, color), 0)
                 return True
-            self.state = _oldcolor
+            self.record_failure()
+            if self.breaker_open():
+                return False
             LightManager.debugger("Connection error to device (playbulb) {}. Retrying" \
                                   .format(self.device), 1)
             time.sleep(0.2)
@@ -730,14 +3771,17 @@ class Playbulb(Bulb):
 
         except Exception as ex:
             #TODO manage "overwritten" thread by queued requests
-            self.state = _oldcolor
             LightManager.debugger("Unhandled response. Thread died?\n{}".format(ex), 0)
             self.disconnect()
+            self.record_failure()
             return False
 
 
 class Milight(Bulb):
     """ Methods for driving a milight BLE lightbulb """
+    __slots__ = ('id1', 'id2')
+    COLOR_UUID = "00001001-0000-1000-8000-00805f9b34fb"
+
     def __init__(self, devid, device, id1, id2, description, group, subgroup, server):
         super().__init__(devid, device, description, group, subgroup, server)
         self.device_type = "Milight"
@@ -769,43 +3813,39 @@ class Milight(Bulb):
 
     def convert(self, color):
         """ Conversion to a color code acceptable by the device """
-        #TODO rrggbb to ...this format...
-        return color
+        return self.server.colorengine.to_milight(color)
 
     def color(self, color, priority):
         """ Checks the request and trigger a light change if needed """
+        writes = self.encode(color, priority)
+        if writes is None:
+            return True
+        for _uuid, payload, state in writes:
+            if not self._write(payload.hex(), state): return False
+        return True
+
+    def encode(self, color, priority):
+        """ Checks the request, returning its (uuid, payload, state) writes or None if none is needed """
         if len(color) > 3:
             LightManager.debugger("Unhandled color format {}".format(color), 1)
-            return True
-        if self.success:
-            return True
+            return None
         if color == self.convert(LIGHT_SKIP):
-            self.success = True
-            return True
-        if self.priority > priority:
-            LightManager.debugger("Milight bulb {} is set with higher priority ({}), skipping."
-                                  .format(self.device, self.priority), 0)
-            self.success = True
-            return True
-        if priority == 3:
-            self.priority = 1
-        else:
-            self.priority = priority
+            return None
+        if not self.hold_priority(priority):
+            return None
         if color == self.convert(LIGHT_OFF):
-            if not self.turn_off(): return False
-            return True
-        elif self.state == color:
-            self.success = True
+            return [self._command(self.get_query(32, 161, 2, self.id1, self.id2), "0")]
+        if self.state == color:
             LightManager.debugger("Device (milight) {} is already of the requested color, skipping."
                                   .format(self.device), 0)
-            return True
-        elif color == LIGHT_ON:
-            if not self.turn_on_and_dim_on(color):
-                return False
-            return True
-        else:
-            if not self.turn_on_and_set_color(color): return False
-            return True
+            return None
+        turn_on = self._command(self.get_query(32, 161, 1, self.id1, self.id2), "1")
+        if color == LIGHT_ON:
+            return [turn_on, self._command(self.get_query(20, 161, 5, self.id1, self.id2, 200, 4, 50), color)]
+        return [turn_on, self._command(self.get_query(45, 161, 4, self.id1, self.id2, color, 2, 50), color)]
+
+    def _command(self, query, state):
+        return (self.COLOR_UUID, bytearray.fromhex(query.replace('\n', '').replace('\r', '')), state)
 
     def get_query(self, value1, value2, value3, id1, id2, value4=0, value5=2, value6=0):
         """
@@ -826,27 +3866,26 @@ class Milight(Bulb):
 
     @connect_ble
     def _write(self, command, color):
-        _oldcolor = self.state
         try:
             if self._connection is not None:
-                self.state = color
                 LightManager.debugger("Setting milight {} color to {}".format(self.device, color), 0)
-                self._connection.getCharacteristics(uuid="00001001-0000-1000-8000-00805f9b34fb")[0] \
+                self._connection.getCharacteristics(uuid=self.COLOR_UUID)[0] \
                                                     .write(bytearray.fromhex(command \
                                                                              .replace('\n', '') \
                                                                              .replace('\r', '')))
-                self.success = True
+                self.state = color
+                self.record_success()
                 LightManager.debugger("Milight {} color changed to {}".format(self.device, color), 0)
                 return True
-            self.state = _oldcolor
+            self.record_failure()
             LightManager.debugger("Connection error to device (milight)  {}. Retrying" \
                                   .format(self.device), 1)
             return False
         except:
-            self.state = _oldcolor
             LightManager.debugger("Error sending data to device (milight) {}. Retrying" \
                                    .format(self.device), 1)
-            self._connection = None
+            self.disconnect()
+            self.record_failure()
             return False
 
     def _create_command(self, bledata):
@@ -870,17 +3909,115 @@ class Milight(Bulb):
         return ''.join(hexs)
 
 
+class SimulatedPeripheral(object):
+    """ Stand-in for bluepy's Peripheral used by --simulate, to run servers without BLE hardware """
+    LATENCY = 0.05 #seconds per connect or write, roughly what a real bulb takes
+    CONNECT_TIMEOUT = 2.0 #seconds before a connection to an unreachable device fails
+    values = {} #(address, uuid) -> last written bytes, shared by all connections
+    unreachable = set() #addresses of the devices simulated as unplugged
+    connections = 0 #connections not disconnected yet, reported to the soak test by 'simulate {}'
+    lock = threading.Lock()
+    POWER_ON = bytes.fromhex("ff000000") #color of a Playbulb switched off and on at the wall
+
+    def __init__(self, address):
+        if address in self.unreachable:
+            time.sleep(self.CONNECT_TIMEOUT)
+            raise ConnectionError("Failed to connect to peripheral {}".format(address))
+        time.sleep(self.LATENCY)
+        self.address = address
+        self.delegate = None
+        self.connected = True
+        with SimulatedPeripheral.lock:
+            SimulatedPeripheral.connections += 1
+
+    def withDelegate(self, delegate):
+        """ Mirrors Peripheral.withDelegate """
+        self.delegate = delegate
+        return self
+
+    def getCharacteristics(self, uuid=None):
+        """ Mirrors Peripheral.getCharacteristics """
+        return [SimulatedCharacteristic(self, uuid)]
+
+    def disconnect(self):
+        """ Mirrors Peripheral.disconnect """
+        self.delegate = None
+        if self.connected:
+            self.connected = False
+            with SimulatedPeripheral.lock:
+                SimulatedPeripheral.connections -= 1
+
+    @classmethod
+    def power_cycle(cls, address):
+        """ Simulates a device switched off and on at the wall, back to its power-on color """
+        cls.values[(address, "0000fffc-0000-1000-8000-00805f9b34fb")] = cls.POWER_ON
+
+    @classmethod
+    def control(cls, data):
+        """
+        Injects faults from the 'simulate' session command of simulated servers, e.g.
+        simulate {"unreachable": ["CC:..."], "power_cycle": ["CC:..."]}, and reports the open
+        connections (simulate {} only reports)
+        """
+        try:
+            faults = json.loads(data)
+            if not isinstance(faults, dict):
+                raise ValueError("expected a JSON object")
+            if faults.get("unreachable") is not None:
+                cls.unreachable = set(faults["unreachable"])
+            for address in faults.get("power_cycle") or []:
+                cls.power_cycle(address)
+        except (ValueError, TypeError) as ex:
+            return {"status": "error", "message": "Bad simulate command: {}".format(ex)}
+        return {"status": "ok", "unreachable": sorted(cls.unreachable),
+                "power_cycled": sorted(faults.get("power_cycle") or []), "connections": cls.connections}
+
+
+class SimulatedCharacteristic(object):
+    """ Characteristic of a SimulatedPeripheral, remembering the last written value """
+    def __init__(self, peripheral, uuid):
+        self.peripheral = peripheral
+        self.uuid = uuid
+
+    def write(self, data):
+        """ Mirrors Characteristic.write """
+        time.sleep(SimulatedPeripheral.LATENCY)
+        if self.peripheral.address in SimulatedPeripheral.unreachable:
+            raise ConnectionError("Device disconnected")
+        SimulatedPeripheral.values[(self.peripheral.address, self.uuid)] = bytes(data)
+
+    def read(self):
+        """ Mirrors Characteristic.read """
+        return SimulatedPeripheral.values.get((self.peripheral.address, self.uuid), b'')
+
+
 """ Script executed directly """
 if __name__ == "__main__":
     #TODO externalize?
-    PLAYCONFIG = configparser.ConfigParser()
-    PLAYCONFIG.read('play.ini')
-    lm = LightManager(PLAYCONFIG)
+    confparser = argparse.ArgumentParser(add_help=False)
+    confparser.add_argument('--config', type=str, default='play.ini')
+    confparser.add_argument('--server', action='store_true', default=False)
+    preargs = confparser.parse_known_args()[0]
+    PLAYCONFIG_FILE = preargs.config
+    if preargs.server:
+        import configparser
+        PLAYCONFIG = configparser.ConfigParser()
+        PLAYCONFIG.read(PLAYCONFIG_FILE)
+        lm = LightManager(PLAYCONFIG)
+    else: #clients only need the server address, from the cached config
+        from playclient import CachedConfig, device_descriptions
+        PLAYCONFIG = CachedConfig(PLAYCONFIG_FILE)
+        lm = None
 
-    parser = argparse.ArgumentParser(description='BLE light bulbs manager script', epilog=lm.descriptions(),
+    #device descriptions are only needed by --help
+    epilog = None
+    if '-h' in sys.argv or '--help' in sys.argv:
+        epilog = lm.descriptions() if lm is not None else device_descriptions(PLAYCONFIG)
+    parser = argparse.ArgumentParser(description='BLE light bulbs manager script', epilog=epilog,
                                      formatter_class=RawTextHelpFormatter)
     parser.add_argument('hexvalues', metavar='N', type=str, nargs="*",
-                        help='color hex values for the lightbulbs (see list below)')
+                        help='colors for the lightbulbs (see list below): device hex values, #rrggbb, \n'
+                             'hsv(h,s,v), color temperatures (2700k) or names (red, warmwhite...)')
     parser.add_argument('--playbulb', metavar='P', type=str, nargs="*", help='Change playbulbs colors only')
     parser.add_argument('--milight', metavar='M', type=str, nargs="*", help='Change milights colors only')
     parser.add_argument('--priority', metavar='prio', type=int, nargs="?", default=1,
@@ -894,6 +4031,11 @@ if __name__ == "__main__":
     parser.add_argument('--on', action='store_true', default=False, help='Turn everything on')
     parser.add_argument('--off', action='store_true', default=False, help='Turn everything off')
     parser.add_argument('--toggle', action='store_true', default=False, help='Toggle all lights on/off')
+    parser.add_argument('--effect', type=str, choices=EFFECTS, default=None,
+                        help='Run an effect, in the color given if any: Playbulbs run it in firmware,\n'
+                             'the server sends the frames of the other devices')
+    parser.add_argument('--speed', metavar='N', type=int, default=20,
+                        help='Effect speed from 1 (fastest) to 255 (default: 20)')
     parser.add_argument('--server', action='store_true', default=False,
                         help='Start as a socket server daemon')
     parser.add_argument('--threaded', action='store_true', default=False,
@@ -906,87 +4048,113 @@ if __name__ == "__main__":
                         help='Stream colors directly to device id')
     parser.add_argument('--stream-group', metavar='str-grp', type=str, nargs="?", default=None,
                         help='Stream colors directly to device group')
+    parser.add_argument('--stream-from', metavar='file', type=str, default=None,
+                        help="Stream the colors of a file or named pipe ('-' for stdin), one per line")
+    parser.add_argument('--fps', metavar='fps', type=float, default=0,
+                        help='Pace the streamed colors to this frame rate (default: as they come)')
+    parser.add_argument('--binary', action='store_true', default=False,
+                        help='Streamed colors are 4-byte WRGB records instead of lines')
+    parser.add_argument('--udp', action='store_true', default=False,
+                        help='Stream over UDP to the server UDP_PORT (hex colors only)')
+    parser.add_argument('--prepare', action='store_true', default=False,
+                        help='Connect to the (group) devices ahead of an expected request')
+    parser.add_argument('--hold', metavar='sec', type=float, nargs="?", default=None,
+                        help='Seconds to hold the prepared connections (default: PREPARE_TTL)')
+    parser.add_argument('--batch', metavar='json', type=str, default=None,
+                        help='Run a JSON list of operations as one request, e.g. [{"op": "tv", "value": "off"},\n'
+                             '{"op": "off", "group": "salon"}, {"op": "delay", "seconds": 2},\n'
+                             '{"op": "set", "group": "passage", "color": "warmwhite"}, {"op": "scene", "name": "x"}]')
+    parser.add_argument('--scene', metavar='name', type=str, default=None,
+                        help='Run a scene (batch) from the configuration file')
+    parser.add_argument('--capture', metavar='file', type=str, default=None,
+                        help='Starts the server daemon capturing its incoming traffic to a file (see replaytool.py)')
+    parser.add_argument('--restore', action='store_true', default=False,
+                        help='Starts the server daemon with the last journaled states (requires --journal)')
+    parser.add_argument('--config', metavar='file', type=str, default='play.ini',
+                        help='Configuration file to use (default: play.ini)')
+    parser.add_argument('--simulate', action='store_true', default=False,
+                        help='Starts the server daemon with simulated BLE devices')
+    parser.add_argument('--coordinator', action='store_true', default=False,
+                        help='Starts the server daemon as a coordinator of the NODE# play servers')
+    parser.add_argument('--profile', metavar='action', type=str, nargs="+", default=None,
+                        help='Profile the server: status, stacks, cpu [sec] or memory [sec]\n'
+                             '(reports are written to the server JOURNAL_DIR)')
 
     args = parser.parse_args()
 
-    if args.server and (args.playbulb or args.milight or args.on
-                        or args.off or args.toggle or args.stream_dev
+    if args.server and (args.playbulb or args.milight or args.on or args.effect
+                        or args.off or args.toggle or args.stream_dev is not None
                         or args.stream_group):
         LightManager.debugger("You cannot start the daemon and send arguments at the same time. \
                               Quitting.", 2)
         sys.exit()
 
-    if args.stream_dev and args.stream_group:
+    if args.stream_dev is not None and args.stream_group:
         LightManager.debugger("You cannot stream data to both devices and groups. Quitting.", 2)
         sys.exit()
 
     if args.journal:
-        lm.enable_journaling()
+        if lm is not None:
+            lm.enable_journaling()
+        else:
+            JOURNALING = True
 
     if args.server:
         if args.notime:
-            lm.skip_time(1)
+            lm.skip_time()
         if args.threaded:
             lm.start_threaded()
-        LightServer(lm, PLAYCONFIG['SERVER']['HOST'], int(PLAYCONFIG['SERVER']['PORT'])) \
-                    .listen()
+        if args.simulate:
+            SIMULATE = True
+        if PLAYCONFIG.get('SERVER', 'PREPARE_GROUP', fallback=None):
+            lm.start_prepare_schedule(PLAYCONFIG['SERVER']['PREPARE_GROUP'],
+                                      float(PLAYCONFIG.get('SERVER', 'PREPARE_LEAD', fallback='60')))
+        if lm.reconciler is not None:
+            lm.reconciler.start()
+        colors = None
+        if args.journal:
+            if args.restore:
+                colors = lm.restore()
+            lm.start_state_journal()
+        federation = Federation(PLAYCONFIG) if args.coordinator else None
+        capture = TrafficCapture(args.capture) if args.capture else None
+        LightServer(lm, PLAYCONFIG['SERVER']['HOST'], int(PLAYCONFIG['SERVER']['PORT']),
+                    federation, colors, capture).listen()
 
-    elif args.stream_dev or args.stream_group:
-        colorval = ""
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((PLAYCONFIG['SERVER']['HOST'], int(PLAYCONFIG['SERVER']['PORT'])))
-        if args.stream_dev:
-            s.sendall("0006".encode('utf-8'))
-            s.sendall("stream".encode('utf-8'))
-            s.sendall(('%04d' % args.stream_dev).encode('utf-8'))
-            s.sendall(str(args.stream_dev).encode('utf-8'))
-        else:
-            s.sendall("0011".encode('utf-8'))
-            s.sendall("streamgroup".encode('utf-8'))
-            s.sendall(('%04d' % len(args.stream_group)).encode('utf-8'))
-            s.sendall(args.stream_group.encode('utf-8'))
-        while colorval != "quit":
-            if args.stream_dev:
-                colorval = input("Set device {} to colorvalue ('quit' to exit): " \
-                                  .format(args.stream_dev))
-            else:
-                colorval = input("Set group '{}' to colorvalue ('quit' to exit): " \
-                                  .format(args.stream_group))
-            try:
-                if colorval == "quit":
-                    s.sendall("0008".encode('utf-8'))
-                    s.sendall("nostream".encode('utf-8'))
-                    break
-                s.sendall(('%04d' % len(colorval)).encode('utf-8'))
-                s.sendall(colorval.encode('utf-8'))
-            except BrokenPipeError:
-                if colorval != "quit":
-                    s.close()
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.connect((PLAYCONFIG['SERVER']['HOST'], int(PLAYCONFIG['SERVER']['PORT'])))
-                    if args.stream_dev:
-                        s.sendall("0006".encode('utf-8'))
-                        s.sendall("stream".encode('utf-8'))
-                        s.sendall(('%04d' % args.stream_dev).encode('utf-8'))
-                        s.sendall(str(args.stream_dev).encode('utf-8'))
-                    else:
-                        s.sendall("0011".encode('utf-8'))
-                        s.sendall("streamgroup".encode('utf-8'))
-                        s.sendall(('%04d' % len(args.stream_group)).encode('utf-8'))
-                        s.sendall(args.stream_group.encode('utf-8'))
-                    s.sendall(('%04d' % len(colorval)).encode('utf-8'))
-                    s.sendall(colorval.encode('utf-8'))
-                    continue
+    elif args.profile:
+        s = socket.create_connection((PLAYCONFIG['SERVER']['HOST'], int(PLAYCONFIG['SERVER']['PORT'])))
+        send_frame(s, "session")
+        send_frame(s, " ".join(["profile"] + args.profile))
+        print(json.dumps(json.loads(recv_frame(s)), indent=1))
         s.close()
 
+    elif args.stream_dev is not None or args.stream_group:
+        from playclient import StreamProducer, UdpStreamProducer, read_frames, prompt_frames
+        target = args.stream_group or args.stream_dev
+        if args.udp:
+            producer = UdpStreamProducer(PLAYCONFIG['SERVER']['HOST'],
+                                         int(PLAYCONFIG['SERVER']['UDP_PORT']),
+                                         target, bool(args.stream_group), args.fps)
+        else:
+            producer = StreamProducer(PLAYCONFIG['SERVER']['HOST'],
+                                      int(PLAYCONFIG['SERVER']['PORT']),
+                                      target, bool(args.stream_group), args.fps)
+        if args.stream_from is None and sys.stdin.isatty():
+            producer.run(prompt_frames(target, bool(args.stream_group)))
+        elif args.stream_from in (None, '-'):
+            producer.run(read_frames(sys.stdin.buffer if args.binary else sys.stdin, args.binary))
+        else:
+            with open(args.stream_from, 'rb' if args.binary else 'r') as source:
+                producer.run(read_frames(source, args.binary))
+
     else:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect((PLAYCONFIG['SERVER']['HOST'], int(PLAYCONFIG['SERVER']['PORT'])))
         #TODO report connection errors or allow feedback response
         LightManager.debugger('Connecting with lightmanager daemon', 0)
         LightManager.debugger('Sending request: ' + json.dumps(vars(args)), 0)
-        s.sendall("1024".encode('utf-8'))
-        s.sendall(json.dumps(vars(args)).encode('utf-8'))
+        payload = json.dumps(vars(args)).encode('utf-8')
+        s.sendall(('%04d' % len(payload)).encode('utf-8') + payload)
         s.close()
 
     sys.exit()
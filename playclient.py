@@ -13,9 +13,12 @@ import socket
 import datetime
 import json
 import os
-import configparser
+import time
+import select
+import struct
 from argparse import RawTextHelpFormatter
 from __main__ import *
+from playconstants import EFFECTS
 
 class LightManager(object):
     """ Methods for instanciating and managing BLE lightbulbs """
@@ -28,6 +31,334 @@ class LightManager(object):
         with open("./play.0.log", "a") as jfile:
             jfile.write(debugtext + "\n")
 
+class CachedConfig(object):
+    """
+    Read-only view of an ini file for the clients. The parsed sections are kept as JSON
+    next to the file, and configparser only runs again when the file changes (mtime or
+    size). Sections are dicts of upper-case keys, get() mirrors ConfigParser.get.
+    """
+    def __init__(self, path='play.ini'):
+        self.path = path
+        directory, name = os.path.split(path)
+        self.cache = os.path.join(directory, "." + name + ".cache")
+        self._sections = self._load()
+
+    def __getitem__(self, section):
+        return self._sections[section]
+
+    def __contains__(self, section):
+        return section in self._sections
+
+    def sections(self):
+        """ Mirrors ConfigParser.sections """
+        return list(self._sections)
+
+    def get(self, section, option, fallback=None):
+        """ Mirrors ConfigParser.get """
+        return self._sections.get(section, {}).get(option.upper(), fallback)
+
+    def _load(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError: #like ConfigParser.read, a missing file is an empty config
+            return {}
+        version = [stat.st_mtime_ns, stat.st_size]
+        try:
+            with open(self.cache) as cfile:
+                cached = json.load(cfile)
+            if cached["version"] == version:
+                return cached["sections"]
+        except (OSError, ValueError, KeyError):
+            pass
+        import configparser
+        parser = configparser.ConfigParser()
+        parser.read(self.path)
+        sections = {name: {key.upper(): value for key, value in parser[name].items()}
+                    for name in parser.sections()}
+        try:
+            with open(self.cache + ".tmp", "w") as cfile:
+                json.dump({"version": version, "sections": sections}, cfile)
+            os.replace(self.cache + ".tmp", self.cache)
+        except OSError: #read-only directory, parsed on every start
+            pass
+        return sections
+
+def device_descriptions(config):
+    """ Lists the DEVICE# sections like LightManager.descriptions, without creating the devices """
+    desctext = ""
+    i = 0
+    while "DEVICE" + str(i) in config:
+        device = config["DEVICE" + str(i)]
+        if device["TYPE"] == "Playbulb":
+            desctext += str(i + 1) + " - " + "[Playbulb MAC: " + device["ADDRESS"] + "] " \
+                        + device["DESCRIPTION"] + "\n"
+        elif device["TYPE"] == "Milight":
+            desctext += str(i + 1) + " - " + "[Milight MAC: {}, ID1: {}, ID2: {}] {}" \
+                        .format(device["ADDRESS"], device["ID1"], device["ID2"],
+                                device["DESCRIPTION"]) + "\n"
+        else:
+            desctext += str(i + 1) + " - " + "Unknown bulb type\n"
+        i += 1
+    return desctext
+
+def frame(payload):
+    """ Packs a length-prefixed protocol frame (4 ASCII digits + utf-8 payload) """
+    data = payload.encode('utf-8')
+    return ('%04d' % len(data)).encode('utf-8') + data
+
+def read_frames(source, binary=False):
+    """ Yields colors from a file object: one per line, or 4-byte WRGB records if binary """
+    if binary:
+        while True:
+            record = source.read(4)
+            if len(record) < 4:
+                return
+            yield record.hex()
+    for line in source:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+def prompt_frames(target, is_group):
+    """ Yields colors typed at the interactive prompt """
+    while True:
+        if is_group:
+            yield input("Set group '{}' to colorvalue ('quit' to exit): ".format(target))
+        else:
+            yield input("Set device {} to colorvalue ('quit' to exit): ".format(target))
+
+class StreamProducer(object):
+    """
+    Streams colors to a device or group of a play server.
+    Frames are paced to fps (0: as fast as they come), each one is written with a single
+    non-blocking send and dropped while the server still has the previous one unread.
+    Lost connections are retried with a backoff and resumed from the last color sent.
+    """
+    RECONNECT_DELAY = 0.5
+    MAX_RECONNECT_DELAY = 10
+
+    def __init__(self, host, port, target, is_group, fps=0):
+        self.address = (host, port)
+        self.handshake = frame("streamgroup" if is_group else "stream") + frame(str(target))
+        self.interval = 1.0 / fps if fps else 0
+        self.sock = None
+        self.pending = b''
+        self.last = None
+        self.retry_at = 0
+        self.delay = self.RECONNECT_DELAY
+        self.sent = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    def run(self, frames):
+        """ Streams the frames until exhausted or 'quit', returns (sent, dropped) """
+        due = time.monotonic()
+        try:
+            for color in frames:
+                if color == "quit":
+                    break
+                if self.interval:
+                    now = time.monotonic()
+                    if now < due:
+                        time.sleep(due - now)
+                    elif now - due > self.interval: #slow source - start over from now
+                        due = now
+                    due += self.interval
+                self.push(color)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+        LightManager.debugger("Stream ended: {} frames sent, {} dropped, {} reconnections" \
+                              .format(self.sent, self.dropped, self.reconnects), 0)
+        return self.sent, self.dropped
+
+    def push(self, color):
+        """ Sends a frame now, or drops it if the server lags or cannot be reached """
+        if self.sock is None and not self._connect():
+            self.last = color #resumed with this color once connected
+            self.dropped += 1
+            return False
+        try:
+            self._check_peer()
+            if self.pending:
+                self.pending = self.pending[self.sock.send(self.pending):]
+                if self.pending: #previous frame still not taken by the server
+                    self.dropped += 1
+                    self.last = color
+                    return False
+            data = frame(color)
+            self.pending = data[self.sock.send(data):]
+        except BlockingIOError:
+            self.dropped += 1
+            self.last = color
+            return False
+        except OSError as ex:
+            LightManager.debugger("Stream connection lost: {}".format(ex), 1)
+            self._drop_connection()
+            self.last = color
+            self.dropped += 1
+            return False
+        self.last = color
+        self.sent += 1
+        return True
+
+    def close(self):
+        """ Ends the stream on the server and closes the connection """
+        if self.sock is None:
+            return
+        try:
+            self.sock.setblocking(True)
+            self.sock.settimeout(2)
+            self.sock.sendall(self.pending + frame("nostream"))
+        except OSError:
+            pass
+        self._drop_connection()
+
+    def _connect(self):
+        if time.monotonic() < self.retry_at:
+            return False
+        try:
+            sock = socket.create_connection(self.address, timeout=2)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(self.handshake + (frame(self.last) if self.last is not None else b''))
+        except OSError as ex:
+            self.retry_at = time.monotonic() + self.delay
+            LightManager.debugger("Cannot reach stream server, retrying in {}s: {}" \
+                                  .format(self.delay, ex), 1)
+            self.delay = min(self.delay * 2, self.MAX_RECONNECT_DELAY)
+            return False
+        sock.setblocking(False)
+        if self.sent or self.dropped:
+            self.reconnects += 1
+            LightManager.debugger("Stream resumed", 0)
+        self.sock = sock
+        self.delay = self.RECONNECT_DELAY
+        return True
+
+    def _check_peer(self):
+        """ The server only writes to a stream to refuse it (busy) or by hanging up """
+        if not select.select([self.sock], [], [], 0)[0]:
+            return
+        data = self.sock.recv(4096)
+        retry_after = self.RECONNECT_DELAY
+        if data:
+            try:
+                retry_after = float(json.loads(data[4:].decode('utf-8')).get("retry_after",
+                                                                           retry_after))
+            except ValueError:
+                pass
+        self.retry_at = time.monotonic() + retry_after
+        raise ConnectionResetError("Stream closed by the server")
+
+    def _drop_connection(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.sock = None
+        self.pending = b''
+
+class UdpStreamProducer(StreamProducer):
+    """
+    Streams colors as sequenced datagrams to the UDP_PORT of a play server: no connection
+    to keep, late frames are discarded by the server (see play.py UdpIngest).
+    A datagram carries one color per target, see add_target.
+    """
+    def __init__(self, host, port, target, is_group, fps=0):
+        StreamProducer.__init__(self, host, port, target, is_group, fps)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.stream_id = int.from_bytes(os.urandom(2), 'big')
+        self.entries = []
+        self.add_target(target, is_group)
+
+    def add_target(self, target, is_group):
+        """ Adds a device or group to the frames """
+        if is_group:
+            name = str(target).encode('utf-8')
+            self.entries.append(struct.pack('!BB', 1, len(name)) + name)
+        else:
+            self.entries.append(struct.pack('!BH', 0, int(target)))
+
+    def push(self, color):
+        """ Sends a datagram, colors are 8 hex digits (WWRRGGBB) """
+        return self.push_frame([color] * len(self.entries))
+
+    def push_frame(self, colors):
+        """ Sends a datagram with one color per target """
+        datagram = b''
+        for entry, color in zip(self.entries, colors):
+            try:
+                wrgb = bytes.fromhex(color)
+            except ValueError:
+                wrgb = b''
+            if len(wrgb) != 4:
+                LightManager.debugger("Color {} is not an 8 digits hex value, skipped" \
+                                      .format(color), 1)
+                self.dropped += 1
+                return False
+            datagram += entry + wrgb
+        try:
+            seq = (self.sent + self.dropped) & 0xffffffff
+            self.sock.sendto(struct.pack('!HI', self.stream_id, seq) + datagram, self.address)
+        except OSError as ex:
+            LightManager.debugger("Cannot send stream frame: {}".format(ex), 1)
+            self.dropped += 1
+            return False
+        self.sent += 1
+        return True
+
+    def close(self):
+        self.sock.close()
+
+class ZoneSender(object):
+    """
+    Sends one color per target (device id or group name) per frame for the ambient and
+    audio producers: as single datagrams if the server has a UDP_PORT, otherwise on one
+    stream per target. Frames are capped to rate and unchanged frames are not sent.
+    """
+    def __init__(self, config, targets, rate):
+        host = config['SERVER']['HOST']
+        self.udp = None
+        self.producers = []
+        if config.get('SERVER', 'UDP_PORT', fallback=None):
+            self.udp = UdpStreamProducer(host, int(config['SERVER']['UDP_PORT']), *targets[0])
+            for target, is_group in targets[1:]:
+                self.udp.add_target(target, is_group)
+        else:
+            self.producers = [StreamProducer(host, int(config['SERVER']['PORT']), target, is_group)
+                              for target, is_group in targets]
+        self.interval = 1.0 / rate if rate else 0
+        self.next = 0
+        self.last = [None] * len(targets)
+
+    @staticmethod
+    def target(section):
+        """ Returns the (target, is_group) of a config section with a DEVICE or GROUP key """
+        if 'GROUP' in section:
+            return section['GROUP'], True
+        return int(section['DEVICE']), False
+
+    def push(self, colors):
+        """ Sends the colors of a frame, False if skipped by the rate cap or unchanged """
+        now = time.monotonic()
+        if now < self.next or colors == self.last:
+            return False
+        self.next = now + self.interval
+        if self.udp is not None:
+            self.udp.push_frame(colors)
+        else:
+            for producer, color, last in zip(self.producers, colors, self.last):
+                if color != last:
+                    producer.push(color)
+        self.last = list(colors)
+        return True
+
+    def close(self):
+        """ Ends the streams """
+        for producer in self.producers + ([self.udp] if self.udp is not None else []):
+            producer.close()
+
 """ Script executed directly """
 if __name__ == "__main__":
     if os.path.isfile("./play.0.log"):
@@ -37,11 +368,12 @@ if __name__ == "__main__":
             os.rename("./play.1.log", "./play.2.log")
         os.rename("./play.0.log", "./play.1.log")
 
-    PLAYCONFIG = configparser.ConfigParser()
-    PLAYCONFIG.read('play.ini')
+    PLAYCONFIG = CachedConfig('play.ini')
     lm = LightManager()
 
-    parser = argparse.ArgumentParser(description='BLE light bulbs manager script',
+    #device descriptions are only needed by --help
+    epilog = device_descriptions(PLAYCONFIG) if '-h' in sys.argv or '--help' in sys.argv else None
+    parser = argparse.ArgumentParser(description='BLE light bulbs manager script', epilog=epilog,
                                      formatter_class=RawTextHelpFormatter)
     parser.add_argument('hexvalues', metavar='N', type=str, nargs="*",
                         help='color hex values for the lightbulbs (see list below)')
@@ -58,6 +390,12 @@ if __name__ == "__main__":
     parser.add_argument('--on', action='store_true', default=False, help='Turn everything on')
     parser.add_argument('--off', action='store_true', default=False, help='Turn everything off')
     parser.add_argument('--toggle', action='store_true', default=False, help='Toggle all lights on/off')
+    parser.add_argument('--effect', type=str, default=None,
+                        choices=EFFECTS,
+                        help='Run an effect, in the color given if any: Playbulbs run it in firmware,\n'
+                             'the server sends the frames of the other devices')
+    parser.add_argument('--speed', metavar='N', type=int, default=20,
+                        help='Effect speed from 1 (fastest) to 255 (default: 20)')
     parser.add_argument('--server', action='store_true', default=False,
                         help='Start as a socket server daemon')
     parser.add_argument('--threaded', action='store_true', default=False,
@@ -70,69 +408,65 @@ if __name__ == "__main__":
                         help='Stream colors directly to device id')
     parser.add_argument('--stream-group', metavar='str-grp', type=str, nargs="?", default=None,
                         help='Stream colors directly to device group')
+    parser.add_argument('--stream-from', metavar='file', type=str, default=None,
+                        help="Stream the colors of a file or named pipe ('-' for stdin), one per line")
+    parser.add_argument('--fps', metavar='fps', type=float, default=0,
+                        help='Pace the streamed colors to this frame rate (default: as they come)')
+    parser.add_argument('--binary', action='store_true', default=False,
+                        help='Streamed colors are 4-byte WRGB records instead of lines')
+    parser.add_argument('--udp', action='store_true', default=False,
+                        help='Stream over UDP to the server UDP_PORT (hex colors only)')
+    parser.add_argument('--batch', metavar='json', type=str, default=None,
+                        help='Run a JSON list of operations as one request (see play.py -h)')
+    parser.add_argument('--scene', metavar='name', type=str, default=None,
+                        help='Run a scene (batch) from the server configuration file')
+    parser.add_argument('--prepare', action='store_true', default=False,
+                        help='Connect to the (group) devices ahead of an expected request')
+    parser.add_argument('--hold', metavar='sec', type=float, nargs="?", default=None,
+                        help='Seconds to hold the prepared connections (default: PREPARE_TTL)')
+    parser.add_argument('--profile', metavar='action', type=str, nargs="+", default=None,
+                        help='Profile the server: status, stacks, cpu [sec] or memory [sec]\n'
+                             '(reports are written to the server JOURNAL_DIR)')
 
     args = parser.parse_args()
 
-    if args.stream_dev and args.stream_group:
+    if args.stream_dev is not None and args.stream_group:
         LightManager.debugger("You cannot stream data to both devices and groups. Quitting.", 2)
         sys.exit()
 
-    elif args.stream_dev or args.stream_group:
-        colorval = ""
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((PLAYCONFIG['SERVER']['HOST'], int(PLAYCONFIG['SERVER']['PORT'])))
-        if args.stream_dev:
-            s.sendall("0006".encode('utf-8'))
-            s.sendall("stream".encode('utf-8'))
-            s.sendall(('%04d' % args.stream_dev).encode('utf-8'))
-            s.sendall(str(args.stream_dev).encode('utf-8'))
-        else:
-            s.sendall("0011".encode('utf-8'))
-            s.sendall("streamgroup".encode('utf-8'))
-            s.sendall(('%04d' % len(args.stream_group)).encode('utf-8'))
-            s.sendall(args.stream_group.encode('utf-8'))
-        while colorval != "quit":
-            if args.stream_dev:
-                colorval = input("Set device {} to colorvalue ('quit' to exit): " \
-                                 .format(args.stream_dev))
-            else:
-                colorval = input("Set group '{}' to colorvalue ('quit' to exit): " \
-                                 .format(args.stream_group))
-            try:
-                if colorval == "quit":
-                    s.sendall("0008".encode('utf-8'))
-                    s.sendall("nostream".encode('utf-8'))
-                    break
-                s.sendall(('%04d' % len(colorval)).encode('utf-8'))
-                s.sendall(colorval.encode('utf-8'))
-            except BrokenPipeError:
-                if colorval != "quit":
-                    s.close()
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.connect((PLAYCONFIG['SERVER']['HOST'], int(PLAYCONFIG['SERVER']['PORT'])))
-                    if args.stream_dev:
-                        s.sendall("0006".encode('utf-8'))
-                        s.sendall("stream".encode('utf-8'))
-                        s.sendall(('%04d' % args.stream_dev).encode('utf-8'))
-                        s.sendall(str(args.stream_dev).encode('utf-8'))
-                    else:
-                        s.sendall("0011".encode('utf-8'))
-                        s.sendall("streamgroup".encode('utf-8'))
-                        s.sendall(('%04d' % len(args.stream_group)).encode('utf-8'))
-                        s.sendall(args.stream_group.encode('utf-8'))
-                    s.sendall(('%04d' % len(colorval)).encode('utf-8'))
-                    s.sendall(colorval.encode('utf-8'))
-                    continue
+    elif args.profile:
+        s = socket.create_connection((PLAYCONFIG['SERVER']['HOST'], int(PLAYCONFIG['SERVER']['PORT'])))
+        s.sendall(frame("session") + frame(" ".join(["profile"] + args.profile)))
+        header = s.recv(4, socket.MSG_WAITALL)
+        print(json.dumps(json.loads(s.recv(int(header), socket.MSG_WAITALL).decode('utf-8')), indent=1))
         s.close()
 
+    elif args.stream_dev is not None or args.stream_group:
+        target = args.stream_group or args.stream_dev
+        if args.udp:
+            producer = UdpStreamProducer(PLAYCONFIG['SERVER']['HOST'],
+                                         int(PLAYCONFIG['SERVER']['UDP_PORT']),
+                                         target, bool(args.stream_group), args.fps)
+        else:
+            producer = StreamProducer(PLAYCONFIG['SERVER']['HOST'],
+                                      int(PLAYCONFIG['SERVER']['PORT']),
+                                      target, bool(args.stream_group), args.fps)
+        if args.stream_from is None and sys.stdin.isatty():
+            producer.run(prompt_frames(target, bool(args.stream_group)))
+        elif args.stream_from in (None, '-'):
+            producer.run(read_frames(sys.stdin.buffer if args.binary else sys.stdin, args.binary))
+        else:
+            with open(args.stream_from, 'rb' if args.binary else 'r') as source:
+                producer.run(read_frames(source, args.binary))
+
     else:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect((PLAYCONFIG['SERVER']['HOST'], int(PLAYCONFIG['SERVER']['PORT'])))
         #todo report connection errors or allow feedback response
         LightManager.debugger('Connecting with lightmanager daemon', 0)
         LightManager.debugger('Sending request: ' + json.dumps(vars(args)), 0)
-        s.sendall("1024".encode('utf-8'))
-        s.sendall(json.dumps(vars(args)).encode('utf-8'))
+        payload = json.dumps(vars(args)).encode('utf-8')
+        s.sendall(('%04d' % len(payload)).encode('utf-8') + payload)
         s.close()
 
     sys.exit()
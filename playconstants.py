@@ -0,0 +1,9 @@
+#!/usr/bin/env python3
+'''
+    File name: playconstants.py
+    Python Version: 3.7
+
+    Constants shared by the play server and its clients, kept out of both scripts so that
+    neither imports the other
+'''
+EFFECTS = ("blink", "pulse", "hard-rainbow", "smooth-rainbow", "candle") #Playbulb animation modes 00 to 04
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+'''
+    File name: replaytool.py
+    Python Version: 3.7
+
+    Replays a traffic capture of ./play.py --server --capture against a play server, live
+    or simulated, at the captured pace, faster (--speed 10) or as fast as possible
+    (--speed max), and compares the outcomes and latency distributions of the replay with
+    the capture itself or with an earlier replay saved with --save.
+'''
+import argparse
+import configparser
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import RawTextHelpFormatter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from play import TrafficCapture
+from playclient import frame
+
+QUERIES = ("getstate", "describe", "udpstats", "commitstats")
+
+def connections(records):
+    """ Groups the capture records by connection: {conn: {"source", "kinds", "records"}} """
+    conns = {}
+    for seconds, kind, conn, payload in records:
+        if kind == TrafficCapture.OPEN:
+            conns[conn] = {"source": payload.decode('utf-8'), "records": [], "kinds": [],
+                           "mode": None}
+            continue
+        if conn not in conns:
+            continue
+        entry = conns[conn]
+        entry["records"].append((seconds, kind, payload))
+        if kind == TrafficCapture.FRAME:
+            entry["kinds"].append(classify(entry, payload.decode('utf-8')))
+        elif kind == TrafficCapture.DATAGRAM:
+            entry["mode"] = "udp"
+    return conns
+
+def classify(entry, data):
+    """ Returns the kind of a frame on its connection, following the connection mode """
+    mode = entry["mode"]
+    if mode is None:
+        if data in ("session", "stream", "streamgroup"):
+            entry["mode"] = data
+            return "control"
+        entry["mode"] = "oneshot"
+        return "query" if data == "getstate" else "request"
+    if mode == "session":
+        return "query" if data in QUERIES or data.startswith("profile") else "request"
+    if mode in ("stream", "streamgroup"):
+        return "control" if data == "nostream" else "stream"
+    return "control"
+
+def captured_results(conns):
+    """ Returns the answered frames of a capture as replay results """
+    results = []
+    for conn, entry in sorted(conns.items()):
+        index = -1
+        data = None
+        for _seconds, kind, payload in entry["records"]:
+            if kind == TrafficCapture.FRAME:
+                index += 1
+                data = payload.decode('utf-8')
+            elif kind == TrafficCapture.REPLY and index >= 0:
+                size = TrafficCapture.REPLY_MS.size
+                ms, = TrafficCapture.REPLY_MS.unpack_from(payload)
+                results.append({"conn": conn, "index": index, "kind": entry["kinds"][index],
+                                "status": payload[size:].decode('utf-8'), "ms": round(ms, 2),
+                                "frame": data[:80]})
+    return results
+
+class Replayer(object):
+    """
+    Replays every captured connection from its own thread, sending its frames at their
+    captured time divided by the speed (0: as fast as possible) and timing the answers:
+    session frames until their answer frame, one-shot requests until the server closes
+    the connection (their status is unknown, the server does not answer them).
+    """
+    def __init__(self, host, port, udp_port, speed, timeout=30):
+        self.host = host
+        self.port = port
+        self.udp_port = udp_port
+        self.speed = speed
+        self.timeout = timeout
+        self.results = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def run(self, conns):
+        """ Replays the connections and returns the results sorted by connection and frame """
+        start = time.monotonic()
+        threads = []
+        for conn, entry in sorted(conns.items(), key=lambda item: item[1]["records"][0][0]
+                                  if item[1]["records"] else 0):
+            if not entry["records"]:
+                continue
+            self._wait(start, entry["records"][0][0])
+            thread = threading.Thread(target=self._guard, args=(conn, entry, start), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return sorted(self.results, key=lambda result: (result["conn"], result["index"])), \
+               time.monotonic() - start
+
+    def _wait(self, start, seconds):
+        if self.speed:
+            delay = start + seconds / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _guard(self, conn, entry, start):
+        try:
+            if entry["mode"] == "udp":
+                self._datagrams(entry, start)
+            else:
+                self._connection(conn, entry, start)
+        except (OSError, ValueError) as ex:
+            with self._lock:
+                self.errors += 1
+            print("  connection {} from {} failed: {}".format(conn, entry["source"], ex))
+
+    def _datagrams(self, entry, start):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for seconds, kind, payload in entry["records"]:
+                if kind == TrafficCapture.DATAGRAM:
+                    self._wait(start, seconds)
+                    sock.sendto(payload, (self.host, self.udp_port))
+
+    def _connection(self, conn, entry, start):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        index = -1
+        try:
+            for seconds, kind, payload in entry["records"]:
+                self._wait(start, seconds)
+                if kind == TrafficCapture.CLOSE:
+                    break
+                if kind != TrafficCapture.FRAME:
+                    continue
+                index += 1
+                data = payload.decode('utf-8')
+                sent = time.monotonic()
+                sock.sendall(frame(data))
+                if entry["kinds"][index] in ("control", "stream"):
+                    continue
+                if entry["mode"] == "session":
+                    status = self._answer(sock)
+                else:
+                    status = self._closed(sock, entry["kinds"][index])
+                with self._lock:
+                    self.results.append({"conn": conn, "index": index, "kind": entry["kinds"][index],
+                                         "status": status,
+                                         "ms": round((time.monotonic() - sent) * 1000, 2),
+                                         "frame": data[:80]})
+                if entry["mode"] == "oneshot":
+                    break
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _answer(sock):
+        header = sock.recv(4, socket.MSG_WAITALL)
+        if len(header) < 4:
+            raise OSError("session closed by the server")
+        body = sock.recv(int(header), socket.MSG_WAITALL)
+        try:
+            reply = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return "error"
+        return reply.get("status", "ok") if isinstance(reply, dict) else "ok"
+
+    @staticmethod
+    def _closed(sock, kind):
+        received = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            received += chunk
+        if kind != "query":
+            return None
+        try:
+            json.loads(received.decode('utf-8'))
+        except ValueError:
+            return "error"
+        return "ok"
+
+def percentile(values, ratio):
+    """ Nearest-rank percentile of sorted values """
+    return values[min(int(ratio * len(values)), len(values) - 1)]
+
+def summary(name, results):
+    """ Prints the latency distribution of each frame kind of a run """
+    for kind in ("request", "query"):
+        values = sorted(result["ms"] for result in results if result["kind"] == kind)
+        if not values:
+            continue
+        print("{:8s} {:10s} {:6d} {:9.1f} {:9.1f} {:9.1f} {:9.1f}" \
+              .format(kind, name, len(values), percentile(values, 0.5), percentile(values, 0.9),
+                      percentile(values, 0.99), values[-1]))
+
+def compare(runs):
+    """ Prints the latency distributions of two runs and the frames whose outcome changed """
+    (first_name, first), (second_name, second) = runs
+    print("kind     run         count   p50 (ms)  p90 (ms)  p99 (ms)  max (ms)")
+    for name, results in runs:
+        summary(name, results)
+    before = {(result["conn"], result["index"]): result for result in first}
+    compared = 0
+    changed = []
+    for result in second:
+        old = before.get((result["conn"], result["index"]))
+        if old is None or old["status"] is None or result["status"] is None:
+            continue
+        compared += 1
+        if old["status"] != result["status"]:
+            changed.append((old, result))
+    print("\n{} outcomes compared, {} changed".format(compared, len(changed)))
+    for old, new in changed[:20]:
+        print("  connection {} frame {} ({}): {} -> {}".format(new["conn"], new["index"], new["frame"],
+                                                              old["status"], new["status"]))
+    return changed
+
+def load_run(path):
+    """ Returns the results of a saved replay or of a capture """
+    with open(path, "rb") as rfile:
+        is_capture = rfile.read(len(TrafficCapture.MAGIC)) == TrafficCapture.MAGIC
+    if is_capture:
+        return captured_results(connections(TrafficCapture.read(path)[1]))
+    with open(path) as rfile:
+        return json.load(rfile)["results"]
+
+def free_port(kind):
+    """ Returns a local port free for the given socket kind """
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def simulated_server(config_path, workdir):
+    """ Starts play.py --server --simulate with the configuration devices on free local ports """
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(config_path)
+    if not config.has_section('SERVER'):
+        config.add_section('SERVER')
+    port = free_port(socket.SOCK_STREAM)
+    udp_port = free_port(socket.SOCK_DGRAM)
+    config['SERVER'].update({'HOST': '127.0.0.1', 'PORT': str(port), 'UDP_PORT': str(udp_port),
+                             'JOURNAL_DIR': workdir})
+    path = os.path.join(workdir, 'play.ini')
+    with open(path, 'w') as cfile:
+        config.write(cfile)
+    for name in ("play.py", "playclient.py", "playconstants.py"):
+        shutil.copy(os.path.join(HERE, name), workdir)
+    log = open(os.path.join(workdir, "server.log"), "w")
+    server = subprocess.Popen([sys.executable, "play.py", "--server", "--simulate", "--notime",
+                               "--config", path], cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, log, port, udp_port
+        except OSError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                raise OSError("the simulated server did not start, see {}".format(log.name))
+            time.sleep(0.5)
+
+""" Script executed directly """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replays and compares play server traffic captures',
+                                     formatter_class=RawTextHelpFormatter)
+    parser.add_argument('capture', metavar='file', type=str, nargs='?', default=None,
+                        help='Capture written by ./play.py --server --capture file')
+    parser.add_argument('--speed', metavar='x', type=str, default='1',
+                        help="Replay speed: 1 (captured pace), 10... or max (default: 1)")
+    parser.add_argument('--simulate', action='store_true', default=False,
+                        help='Replay against a local play.py --server --simulate of the configuration devices')
+    parser.add_argument('--config', metavar='file', type=str, default=os.path.join(HERE, 'play.ini'),
+                        help='Configuration of the server to replay against (default: play.ini)')
+    parser.add_argument('--against', metavar='file', type=str, default=None,
+                        help='Compare with a replay saved with --save instead of the capture')
+    parser.add_argument('--save', metavar='file', type=str, default=None,
+                        help='Save the replay results to compare later runs with')
+    parser.add_argument('--compare', metavar='file', type=str, nargs=2, default=None,
+                        help='Compare two saved replays or captures without replaying')
+    args = parser.parse_args()
+
+    if args.compare:
+        changed = compare([(os.path.basename(path)[:10], load_run(path)) for path in args.compare])
+        sys.exit(1 if changed else 0)
+    if args.capture is None:
+        parser.error("a capture file is required to replay")
+    speed = 0 if args.speed == "max" else float(args.speed)
+    started, records = TrafficCapture.read(args.capture)
+    conns = connections(records)
+    print("Replaying {} records of {} connections captured at {} ({})" \
+          .format(len(records), len(conns), time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started)),
+                  "{}x".format(args.speed) if speed else "as fast as possible"))
+
+    server = None
+    workdir = None
+    if args.simulate:
+        workdir = tempfile.mkdtemp(prefix="replaytool")
+        server, log, port, udp_port = simulated_server(args.config, workdir)
+        host = '127.0.0.1'
+    else:
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        host = config['SERVER']['HOST']
+        port = int(config['SERVER']['PORT'])
+        udp_port = int(config.get('SERVER', 'UDP_PORT', fallback='0'))
+    replayer = Replayer(host, port, udp_port, speed)
+    try:
+        results, elapsed = replayer.run(conns)
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(15)
+            except subprocess.TimeoutExpired:
+                server.kill()
+            log.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+    print("Replayed in {:.1f}s, capture span {:.1f}s, {} connections failed\n" \
+          .format(elapsed, records[-1][0] if records else 0, replayer.errors))
+
+    if args.save:
+        with open(args.save, "w") as sfile:
+            json.dump({"capture": args.capture, "speed": args.speed, "simulated": args.simulate,
+                       "results": results}, sfile)
+    baseline = load_run(args.against) if args.against else captured_results(conns)
+    compare([("baseline" if args.against else "capture", baseline), ("replay", results)])
@@ -54,15 +54,15 @@ class S(BaseHTTPRequestHandler):
             elif action == "luminaire_passage_on":
                 os.system('./playclient.py --on --notime --priority 2 --group passage')
             elif action == "television_salon_on":
-                os.system('./playclient.py --tvon --priority 3')
+                os.system('./playclient.py --tvon --priority 3') #the play server also sends Wake-on-LAN
                 time.sleep(2)
-                os.system('/usr/sbin/ether-wake 4C:CC:6A:F4:79:EC -i br0')
+                os.system('/usr/sbin/ether-wake 4C:CC:6A:F4:79:EC -i br0') #until its broadcast is known to reach the TV
             elif action == "television_salon_off":
                 os.system('./playclient.py --tvoff --priority 3')
             elif action == "television_salon_restart":
                 os.system('./playclient.py --tvrestart')
             elif action == "salon_close":
-                os.system('./playclient.py --tvoff --off --notime --priority 3 --group salon')
+                os.system('./playclient.py --scene salon_close --notime --priority 3')
             elif action == "luminaire_salon_off":
                 os.system('./playclient.py --off --notime --priority 3 --group salon --subgroup luminaire')
             elif action == "luminaire_salon_on":
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+'''
+    File name: soaktest.py
+    Python Version: 3.7
+
+    Soak test of the play server: runs play.py --server --simulate under a mixed workload
+    (detector arrivals and departures, IFTTT actions, streaming bursts, state pollers) with
+    hours of traffic compressed into minutes, samples the server RSS, threads, open file
+    descriptors, open device connections and request latency, and fails when any of them
+    keeps growing (Linux only).
+'''
+import argparse
+import configparser
+import os
+import random
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import json
+from argparse import RawTextHelpFormatter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from playclient import StreamProducer, UdpStreamProducer, frame
+
+# Events per simulated hour of a busy evening
+DETECTOR_RATE = 2
+IFTTT_RATE = 6
+STREAM_RATE = 1
+IFTTT_ACTIONS = [{"off": True, "notime": True, "priority": 3, "group": "salon"},
+                 {"on": True, "notime": True, "priority": 2, "group": "salon"},
+                 {"off": True, "notime": True, "priority": 3, "group": "passage"},
+                 {"on": True, "notime": True, "priority": 2, "group": "passage"},
+                 {"scene": "salon_close", "notime": True, "priority": 3},
+                 {"off": True, "notime": True, "priority": 3, "group": "salon", "subgroup": "luminaire"},
+                 {"on": True, "notime": True, "priority": 2, "group": "salon", "subgroup": "luminaire"},
+                 {"on": True, "notime": True, "priority": 2},
+                 {"off": True, "notime": True, "priority": 3}]
+
+def soak_config(devices, port, workdir):
+    """ Writes a configuration of simulated devices with the server timers compressed """
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config['SERVER'] = {'HOST': '127.0.0.1', 'PORT': str(port), 'UDP_PORT': str(port + 1),
+                        'JOURNAL_DIR': workdir, 'PRIORITY_TTL': '5', 'DISCONNECT_DELAY': '2',
+                        'PREPARE_TTL': '5', 'CLIENT_RATE': '50', 'CLIENT_BURST': '50',
+                        'MAX_PENDING': '50', 'HTTP_API': 'yes'}
+    for i in range(devices):
+        milight = i % 3 == 2
+        section = {'TYPE': 'Milight' if milight else 'Playbulb',
+                   'ADDRESS': 'CC:00:00:00:{:02X}:{:02X}'.format(i // 256, i % 256),
+                   'DESCRIPTION': 'Soak device {}'.format(i),
+                   'GROUP': 'salon' if i % 2 else 'passage',
+                   'SUBGROUP': 'luminaire' if i % 4 < 2 else 'sofa'}
+        if milight:
+            section.update({'ID1': str(80 + i), 'ID2': '112'})
+        else:
+            section['DEFAULT_INTENSITY'] = '05000000'
+        config['DEVICE' + str(i)] = section
+    config['SCENE0'] = {'NAME': 'salon_close', 'BATCH': '[{"op": "off", "group": "salon"}]'}
+    path = os.path.join(workdir, 'play.ini')
+    with open(path, 'w') as cfile:
+        config.write(cfile)
+    return path
+
+def one_shot(port, args):
+    """ Sends a request the way playclient.py does: one frame, no reply awaited """
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(frame(json.dumps(args)))
+
+class Session(object):
+    """ Persistent session, timing each request round trip """
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=30)
+        self.sock.sendall(frame("session"))
+
+    def call(self, payload):
+        start = time.monotonic()
+        self.sock.sendall(frame(payload))
+        header = self.sock.recv(4, socket.MSG_WAITALL)
+        self.sock.recv(int(header), socket.MSG_WAITALL)
+        return time.monotonic() - start
+
+    def query(self, payload):
+        """ Returns the JSON answer of a session command """
+        self.sock.sendall(frame(payload))
+        header = self.sock.recv(4, socket.MSG_WAITALL)
+        return json.loads(self.sock.recv(int(header), socket.MSG_WAITALL).decode('utf-8'))
+
+class Soak(object):
+    """ Workload threads and the sampler of the server process """
+    def __init__(self, pid, port, compression, interval):
+        self.pid = pid
+        self.port = port
+        self.compression = compression
+        self.interval = interval
+        self.stop = threading.Event()
+        self.latencies = {"latency_ms": [], "getstate_ms": []}
+        self.errors = 0
+        self.samples = []
+        self._probe = None #session of the sampler
+        self._lock = threading.Lock()
+
+    def start(self):
+        for target in (self.detector, self.ifttt, self.streams, self.session, self.poller):
+            threading.Thread(target=self._guard, args=(target, ), daemon=True).start()
+
+    def _guard(self, target):
+        while not self.stop.is_set():
+            try:
+                target()
+            except OSError as ex:
+                with self._lock:
+                    self.errors += 1
+                print("  {} failed: {}".format(target.__name__, ex))
+                self.stop.wait(1)
+
+    def _wait(self, rate):
+        """ Waits a random interval of a Poisson process of rate events per simulated hour """
+        return self.stop.wait(random.expovariate(rate * self.compression / 3600.0))
+
+    def detector(self):
+        home = False
+        while not self._wait(DETECTOR_RATE):
+            home = not home
+            if home:
+                one_shot(self.port, {"prepare": True, "group": "passage", "hold": 5})
+                one_shot(self.port, {"on": True, "group": "passage", "notime": True})
+            else:
+                one_shot(self.port, {"off": True, "notime": True, "priority": 3})
+
+    def ifttt(self):
+        while not self._wait(IFTTT_RATE):
+            one_shot(self.port, dict(random.choice(IFTTT_ACTIONS)))
+
+    def streams(self):
+        while not self._wait(STREAM_RATE):
+            colors = ["00{:06x}".format(random.getrandbits(24)) for _ in range(60)]
+            if random.random() < 0.5:
+                producer = StreamProducer('127.0.0.1', self.port, 'salon', True, 20)
+            else:
+                producer = UdpStreamProducer('127.0.0.1', self.port + 1, 'salon', True, 20)
+            producer.run(colors)
+
+    def session(self):
+        session = Session(self.port)
+        try:
+            while not self.stop.wait(random.uniform(0.2, 0.6)):
+                if random.random() < 0.5:
+                    metric = "latency_ms"
+                    elapsed = session.call(json.dumps(dict(random.choice(IFTTT_ACTIONS[:4]))))
+                else:
+                    metric = "getstate_ms"
+                    elapsed = session.call("getstate")
+                with self._lock:
+                    self.latencies[metric].append(elapsed * 1000)
+        finally:
+            session.sock.close()
+
+    def poller(self):
+        with socket.create_connection(('127.0.0.1', self.port), timeout=10) as sock:
+            request = "GET /state HTTP/1.1\r\nHost: soak\r\n\r\n".encode('ascii')
+            while not self.stop.wait(0.5):
+                sock.sendall(request)
+                response = b''
+                while b"\r\n\r\n" not in response:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        raise OSError("HTTP poller connection closed")
+                    response += chunk
+                head, body = response.split(b"\r\n\r\n", 1)
+                length = [int(line.split(b":")[1]) for line in head.split(b"\r\n")
+                          if line.lower().startswith(b"content-length")][0]
+                while len(body) < length:
+                    body += sock.recv(length - len(body))
+
+    def sample(self, elapsed):
+        """ Samples the server process and the latencies of the last interval """
+        status = {}
+        with open("/proc/{}/status".format(self.pid)) as sfile:
+            for line in sfile:
+                key, _, value = line.partition(":")
+                status[key] = value.split()
+        with self._lock:
+            latencies, self.latencies = self.latencies, {"latency_ms": [], "getstate_ms": []}
+        sample = {"t": elapsed, "hours": elapsed * self.compression / 3600.0,
+                  "rss_kb": int(status["VmRSS"][0]), "threads": int(status["Threads"][0]),
+                  "fds": len(os.listdir("/proc/{}/fd".format(self.pid)))}
+        if self._probe is None:
+            self._probe = Session(self.port)
+        sample["connections"] = self._probe.query("simulate {}")["connections"]
+        sample.update(latencies) #request latencies are lists, pooled by the trend check
+        self.samples.append(sample)
+        return sample
+
+def pooled(samples, metric):
+    """ Returns the values of a metric over samples, request latencies being lists """
+    values = []
+    for sample in samples:
+        values.extend(sample[metric] if isinstance(sample[metric], list) else [sample[metric]])
+    return values
+
+def trends(samples, warmup, limits):
+    """ Compares the medians of the first and last thirds after the warm-up, per metric """
+    samples = samples[int(len(samples) * warmup):]
+    third = max(len(samples) // 3, 1)
+    results = []
+    for metric, (absolute, relative) in limits.items():
+        first = pooled(samples[:third], metric)
+        last = pooled(samples[-third:], metric)
+        if not first or not last:
+            continue
+        before, after = statistics.median(first), statistics.median(last)
+        limit = absolute + relative * before
+        results.append((metric, before, after, after - before, limit, after - before > limit))
+    return results
+
+""" Script executed directly """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Soak test of the play server with simulated devices',
+                                     formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--hours', metavar='h', type=float, default=24,
+                        help='Simulated hours of traffic (default: 24)')
+    parser.add_argument('--minutes', metavar='m', type=float, default=10,
+                        help='Real minutes to run them in (default: 10)')
+    parser.add_argument('--devices', metavar='n', type=int, default=12,
+                        help='Simulated devices, one Milight out of three (default: 12)')
+    parser.add_argument('--sample', metavar='sec', type=float, default=5,
+                        help='Seconds between samples (default: 5)')
+    parser.add_argument('--warmup', metavar='ratio', type=float, default=0.2,
+                        help='Share of the run ignored by the trend checks (default: 0.2)')
+    parser.add_argument('--threaded', action='store_true', default=False,
+                        help='Run the server with --threaded light changes')
+    parser.add_argument('--port', metavar='port', type=int, default=2190,
+                        help='Local port of the server, and port + 1 for UDP (default: 2190)')
+    parser.add_argument('--record', metavar='file', type=str, default=None,
+                        help='Write the samples to this CSV file')
+    args = parser.parse_args()
+
+    if not os.path.isdir("/proc/self/fd"):
+        print("The soak test samples the server through /proc, Linux only")
+        sys.exit(2)
+    duration = args.minutes * 60
+    compression = args.hours * 3600 / duration
+    workdir = tempfile.mkdtemp(prefix="soaktest")
+    for name in ("play.py", "playclient.py", "playconstants.py"):
+        shutil.copy(os.path.join(HERE, name), workdir)
+    config = soak_config(args.devices, args.port, workdir)
+    command = [sys.executable, "play.py", "--server", "--simulate", "--notime", "--config", config]
+    if args.threaded:
+        command.append("--threaded")
+    log = open(os.path.join(workdir, "server.log"), "w")
+    server = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    soak = Soak(server.pid, args.port, compression, args.sample)
+    os.chdir(workdir) #the stream producers log to ./play.0.log
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', args.port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    print("The server did not start, see {}".format(log.name))
+                    sys.exit(2)
+                time.sleep(0.5)
+        print("Soaking {} simulated hours in {} minutes ({:.0f}x) with {} devices" \
+              .format(args.hours, args.minutes, compression, args.devices))
+        soak.start()
+        start = time.monotonic()
+        while time.monotonic() - start < duration:
+            time.sleep(args.sample)
+            if server.poll() is not None:
+                print("The server exited with {}, see {}".format(server.returncode, log.name))
+                sys.exit(1)
+            sample = soak.sample(time.monotonic() - start)
+            print("  {:6.1f}h rss {:7d} kB, {:3d} threads, {:3d} fds, {:3d} connections, {} requests, "
+                  "{} getstates".format(sample["hours"], sample["rss_kb"], sample["threads"], sample["fds"],
+                                        sample["connections"], len(sample["latency_ms"]),
+                                        len(sample["getstate_ms"])))
+    finally:
+        soak.stop.set()
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(15)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log.close()
+
+    if args.record:
+        with open(args.record, "w") as rfile:
+            rfile.write("seconds,hours,rss_kb,threads,fds,connections,latency_ms,getstate_ms\n")
+            for s in soak.samples:
+                rfile.write("{:.1f},{:.2f},{},{},{},{},{},{}\n".format(
+                    s["t"], s["hours"], s["rss_kb"], s["threads"], s["fds"], s["connections"],
+                    *["{:.2f}".format(statistics.median(s[m])) if s[m] else ""
+                      for m in ("latency_ms", "getstate_ms")]))
+    # allowed growth between the first and last thirds: absolute + relative * first
+    limits = {"rss_kb": (1024, 0.05), "threads": (2, 0), "fds": (3, 0), "connections": (3, 0),
+              "latency_ms": (50, 0.5), "getstate_ms": (5, 0.5)}
+    failed = False
+    print("\nmetric         first     last   growth    limit")
+    for metric, before, after, growth, limit, over in trends(soak.samples, args.warmup, limits):
+        print("{:11s} {:8.1f} {:8.1f} {:8.1f} {:8.1f}  {}".format(metric, before, after, growth, limit,
+                                                                 "FAIL" if over else "ok"))
+        failed = failed or over
+    if soak.errors:
+        print("{} workload errors".format(soak.errors))
+    shutil.rmtree(workdir, ignore_errors=True) if not failed else \
+        print("Server log kept in {}".format(log.name))
+    sys.exit(1 if failed else 0)
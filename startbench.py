@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+'''
+    File name: startbench.py
+    Python Version: 3.7
+
+    Cold-start benchmark of the clients: runs playclient.py and play.py requests against a
+    local stand-in server and reports the time from process start to the request being
+    received, with a cached and a freshly parsed configuration, and the slowest imports.
+'''
+import argparse
+import configparser
+import datetime
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import RawTextHelpFormatter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def stand_in_server(sock, received):
+    """ Accepts clients and timestamps their first byte """
+    while True:
+        client, _ = sock.accept()
+        client.recv(4)
+        received.append(time.perf_counter())
+        client.close()
+
+def run_client(command, cwd, received, fresh):
+    """ Returns the seconds from process start to the request reaching the server """
+    if fresh:
+        for name in os.listdir(cwd):
+            if name.endswith(".cache"):
+                os.remove(os.path.join(cwd, name))
+    count = len(received)
+    start = time.perf_counter()
+    subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if len(received) == count:
+        return None
+    return received[count] - start
+
+def slowest_imports(command, cwd, count=5):
+    """ Returns the slowest top level imports of a command (python -X importtime) """
+    result = subprocess.run([command[0], "-X", "importtime"] + command[1:], cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit() and not fields[2].startswith("  "):
+            imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+""" Script executed directly """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Client cold-start benchmark',
+                                     formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--runs', metavar='n', type=int, default=10,
+                        help='Runs per client and configuration state (default: 10)')
+    parser.add_argument('--config', metavar='file', type=str, default=os.path.join(HERE, 'play.ini'),
+                        help='Configuration file to benchmark with (default: play.ini)')
+    parser.add_argument('--record', metavar='file', type=str, default=None,
+                        help='Append the medians to this CSV file to track them over time')
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(16)
+    received = []
+    threading.Thread(target=stand_in_server, args=(sock, received), daemon=True).start()
+
+    workdir = tempfile.mkdtemp(prefix="startbench")
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    if not config.has_section('SERVER'):
+        config.add_section('SERVER')
+    config['SERVER']['HOST'] = "127.0.0.1"
+    config['SERVER']['PORT'] = str(sock.getsockname()[1])
+    with open(os.path.join(workdir, "play.ini"), "w") as cfile:
+        config.write(cfile)
+    for name in ("play.py", "playclient.py", "playconstants.py"):
+        shutil.copy(os.path.join(HERE, name), workdir)
+
+    clients = [("playclient.py", [sys.executable, "playclient.py", "--on", "--notime"]),
+               ("play.py", [sys.executable, "play.py", "--on", "--notime"])]
+    medians = []
+    try:
+        for name, command in clients:
+            for fresh in (False, True):
+                run_client(command, workdir, received, False) #warm the disk and bytecode caches
+                times = [run_client(command, workdir, received, fresh) for _ in range(args.runs)]
+                times = [t * 1000 for t in times if t is not None]
+                if not times:
+                    print("{}: the request never reached the server".format(name))
+                    medians.append("")
+                    continue
+                print("{} ({} config): median {:.1f} ms, min {:.1f} ms, max {:.1f} ms" \
+                      .format(name, "parsed" if fresh else "cached", statistics.median(times),
+                              min(times), max(times)))
+                medians.append("{:.1f}".format(statistics.median(times)))
+            print("  slowest imports: " + ", ".join("{} {:.1f} ms".format(module, usec / 1000)
+                                                    for usec, module in
+                                                    slowest_imports(command, workdir)))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.record:
+        new = not os.path.isfile(args.record)
+        with open(args.record, "a") as rfile:
+            if new:
+                rfile.write("date,playclient_cached,playclient_parsed,play_cached,play_parsed\n")
+            rfile.write(",".join([datetime.datetime.now().isoformat(timespec='seconds')] + medians)
+                        + "\n")